@@ -0,0 +1,195 @@
+# Benchmark do pipeline de sincronização MLM
+#
+# Uso:
+#   python -m benchmarks.bench_sync --preset small
+#   python -m benchmarks.bench_sync --preset production --output bench.json
+#   python -m benchmarks.bench_sync --preset wide --pg-url postgresql://localhost/mlm_bench --reset
+#   python -m benchmarks.bench_sync --preset production --pg-url ... --extract-workers 4 --extract-max-rows-per-second 200000
+#
+# Sem --pg-url mede apenas as etapas em memória. Com --pg-url o mesmo banco local
+# é usado como banco da operação (tabela tracked sintética) e banco MLM.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import PRESETS, generate_tracked, seed_tracked_table
+
+
+def _rss_kb():
+    """RSS atual e pico (VmHWM) do processo em KB (Linux); None se indisponível"""
+    try:
+        values = {}
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    values[key] = int(value.split()[0])
+        return values.get('VmRSS'), values.get('VmHWM')
+    except OSError:
+        return None, None
+
+
+class StageRunner:
+    """Executa etapas medindo tempo, pico de memória Python e RSS"""
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = []
+        self.failed = False
+
+    def run(self, name, func, rows=None):
+        if self.failed:
+            self.results.append({'stage': name, 'status': 'skipped'})
+            return None
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        rss_before, _ = _rss_kb()
+        start = time.perf_counter()
+        result = {'stage': name, 'status': 'ok'}
+
+        try:
+            value = func()
+        except BaseException as e:
+            if isinstance(e, KeyboardInterrupt):
+                raise
+            value = None
+            self.failed = True
+            result['status'] = 'error'
+            result['error'] = f"{type(e).__name__}: {e}"[:500]
+
+        result['seconds'] = round(time.perf_counter() - start, 6)
+        if self.trace_memory:
+            result['python_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        rss_after, rss_peak = _rss_kb()
+        if rss_after is not None:
+            result['rss_kb'] = rss_after
+            result['rss_delta_kb'] = rss_after - rss_before
+            result['rss_peak_kb'] = rss_peak
+        if value is not None and rows is not None:
+            result['rows'] = rows(value)
+
+        self.results.append(result)
+        status = result['status']
+        logging.getLogger('benchmarks').info(f"{name}: {status} em {result['seconds']:.3f}s")
+        return value
+
+
+def run_benchmark(args):
+    from src.models.sync_service import MLMSyncService
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    runner = StageRunner(trace_memory=args.trace_memory)
+    report = {
+        'benchmark': 'sync_pipeline',
+        'preset': args.preset,
+        'seed': args.seed,
+        'scale': args.scale,
+        'mode': 'postgresql' if args.pg_url else 'in_process',
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'started_at': datetime.now().isoformat()
+    }
+
+    records = runner.run(
+        'generate',
+        lambda: generate_tracked(args.preset, seed=args.seed, scale=args.scale),
+        rows=len
+    )
+
+    if args.pg_url:
+        from src.models.mlm_database import MLMDatabase
+
+        service = MLMSyncService(args.pg_url, args.pg_url)
+        if args.extract_workers > 1:
+            service.enable_parallel_extract(
+                workers=args.extract_workers,
+                range_size=args.extract_range_size,
+                max_rows_per_second=args.extract_max_rows_per_second or None
+            )
+            report['extract_workers'] = args.extract_workers
+        runner.run('seed_tracked', lambda: seed_tracked_table(service.operation_conn, records, reset=args.reset))
+        runner.run('create_tables', lambda: MLMDatabase(args.pg_url).close())
+        # Mede a extração real; os registros gerados são descartados
+        tracked_data = runner.run('extract', service.get_tracked_data, rows=len)
+        if service.extractor and service.extractor.last_run:
+            report['extract'] = service.extractor.last_run
+    else:
+        service = MLMSyncService(None, None, autoconnect=False)
+        tracked_data = records
+
+    hierarchy = runner.run(
+        'build_hierarchy',
+        lambda: service.build_infinite_hierarchy(tracked_data),
+        rows=len
+    )
+    stats = runner.run(
+        'calculate_stats',
+        lambda: service.calculate_individual_n1_to_n5_stats(hierarchy),
+        rows=len
+    )
+
+    if args.pg_url:
+        runner.run('persist_hierarchy', lambda: service.persist_hierarchy(hierarchy), rows=lambda n: n)
+        runner.run('persist_level_stats', lambda: service.persist_level_stats(stats), rows=lambda n: n)
+
+    if args.trace_memory:
+        report['python_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    _, rss_peak = _rss_kb()
+    report['rss_peak_kb'] = rss_peak
+    report['stages'] = runner.results
+    report['ok'] = not runner.failed
+    report['finished_at'] = datetime.now().isoformat()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark do pipeline de sincronização MLM')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplica o número de registros do preset')
+    parser.add_argument('--pg-url', help='PostgreSQL local para medir extração e persistência')
+    parser.add_argument('--reset', action='store_true', help='Recria a tabela tracked no banco local')
+    parser.add_argument('--extract-workers', type=int, default=1,
+                        help='Conexões da extração paralela por faixas de id (1 = consulta única)')
+    parser.add_argument('--extract-range-size', type=int, default=100000, help='Ids por faixa da extração paralela')
+    parser.add_argument('--extract-max-rows-per-second', type=float, default=0,
+                        help='Teto de vazão da extração paralela (0 = sem limite)')
+    parser.add_argument('--no-trace-memory', dest='trace_memory', action='store_false',
+                        help='Desativa tracemalloc (tempos mais próximos da produção)')
+    parser.add_argument('--output', help='Arquivo JSON de saída (padrão: stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logging.getLogger('benchmarks').setLevel(logging.INFO)
+
+    report = run_benchmark(args)
+    output = json.dumps(report, indent=2, default=str)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    return 0 if report['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
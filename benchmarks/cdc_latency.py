@@ -0,0 +1,154 @@
+# Latência ponta a ponta do CDC de tracked (LISTEN/NOTIFY + micro-lotes)
+#
+# Uso:
+#   python -m benchmarks.cdc_latency --pg-url postgresql://localhost/mlm_bench
+#   python -m benchmarks.cdc_latency --pg-url ... --events 200 --interval 0.05 --batch-window-ms 100
+#
+# O mesmo PostgreSQL local faz o papel do banco da operação (tabela tracked
+# sintética, recriada a cada execução) e do banco MLM. Mede o tempo entre o
+# COMMIT de cada INSERT em tracked e o fim do micro-lote que o persistiu.
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import PRESETS, generate_tracked, seed_tracked_table
+
+logger = logging.getLogger('benchmarks')
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(pct / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def run(args):
+    import psycopg2
+    from src.models.mlm_database import MLMDatabase
+    from src.models.sync_service import MLMSyncService
+
+    records = generate_tracked(args.preset, seed=args.seed, scale=args.scale)
+    writer = psycopg2.connect(args.pg_url)
+    writer.autocommit = True
+    seed_tracked_table(writer, records, reset=True)
+    MLMDatabase(args.pg_url).close()
+
+    service = MLMSyncService(args.pg_url, args.pg_url)
+    inserted_at = {}
+    latencies = []
+    batches = []
+    apply_batch = service.apply_tracked_changes
+
+    def timed_apply(events):
+        start = time.monotonic()
+        apply_batch(events)
+        done = time.monotonic()
+        batches.append({'events': len(events), 'apply_seconds': round(done - start, 6)})
+        for event in events:
+            if event['id'] in inserted_at:
+                latencies.append(done - inserted_at.pop(event['id']))
+
+    service.enable_cdc(
+        batch_size=args.batch_size,
+        batch_window=args.batch_window_ms / 1000.0,
+        install_trigger=True
+    )
+    service.cdc_listener.on_batch = timed_apply
+
+    full_start = time.monotonic()
+    service.sync_data()
+    full_sync_seconds = time.monotonic() - full_start
+
+    deadline = time.monotonic() + 10
+    while not service.cdc_listener.is_listening and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not service.cdc_listener.is_listening:
+        raise RuntimeError("Listener de CDC não conectou ao canal")
+
+    rng = random.Random(args.seed)
+    affiliates = sorted({record['affiliate_id'] for record in records})
+    next_id = max(record['id'] for record in records) + 1
+    next_user = max(record['referred_user_id'] for record in records) + 1
+
+    with writer.cursor() as cursor:
+        for _ in range(args.events):
+            inserted_at[next_id] = time.monotonic()
+            cursor.execute(
+                "INSERT INTO tracked (id, user_afil, user_id, tracked_type_id, created_at) VALUES (%s, %s, %s, 1, %s)",
+                (next_id, rng.choice(affiliates), next_user, datetime.now())
+            )
+            next_id += 1
+            next_user += 1
+            time.sleep(args.interval)
+
+    deadline = time.monotonic() + args.timeout
+    while inserted_at and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    service.stop_sync_worker()
+    writer.close()
+
+    return {
+        'benchmark': 'cdc_latency',
+        'preset': args.preset,
+        'tracked_rows': len(records),
+        'full_sync_seconds': round(full_sync_seconds, 3),
+        'events': args.events,
+        'applied': len(latencies),
+        'lost': len(inserted_at),
+        'batches': len(batches),
+        'batch_size': args.batch_size,
+        'batch_window_ms': args.batch_window_ms,
+        'latency_seconds': {
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': max(latencies) if latencies else None
+        },
+        'apply_seconds_p50': _percentile([batch['apply_seconds'] for batch in batches], 50),
+        'ok': not inserted_at
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Latência do CDC de tracked contra PostgreSQL local')
+    parser.add_argument('--pg-url', required=True, help='PostgreSQL local (tabela tracked é recriada)')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--events', type=int, default=50, help='INSERTs em tracked durante a medição')
+    parser.add_argument('--interval', type=float, default=0.1, help='Segundos entre INSERTs')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--batch-window-ms', type=float, default=250)
+    parser.add_argument('--timeout', type=float, default=60, help='Espera máxima pelos eventos pendentes')
+    parser.add_argument('--output', help='Arquivo JSON de saída (padrão: stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    report = run(args)
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0 if report['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
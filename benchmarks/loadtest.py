@@ -0,0 +1,413 @@
+# Teste de carga HTTP dos endpoints de leitura contra um PostgreSQL local
+#
+# Uso:
+#   python -m benchmarks.loadtest --pg-url postgresql://localhost/mlm_load --reset
+#   python -m benchmarks.loadtest --pg-url ... --concurrency 32 --duration 60 --during-sync
+#   python -m benchmarks.loadtest --base-url http://localhost:5000 --pg-url ... --skip-seed
+#
+# Popula o banco local com uma rede sintética, sobe o serviço (src/main.py) com
+# AUTO_START_SYNC=false e dispara requisições concorrentes em /hierarchy, /stats,
+# /levels e /summary. Com --during-sync repete a fase enquanto sincronizações
+# manuais rodam em paralelo.
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.synthetic import PRESETS, generate_tracked, seed_tracked_table
+
+logger = logging.getLogger('benchmarks.loadtest')
+
+# Peso de cada endpoint na mistura de requisições
+ENDPOINT_WEIGHTS = {
+    'hierarchy': 3,
+    'stats': 4,
+    'levels': 2,
+    'summary': 1
+}
+
+
+def percentile(sorted_values, pct):
+    """Percentil por posição mais próxima (lista já ordenada)"""
+    if not sorted_values:
+        return None
+    index = max(int(round(pct / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class AffiliatePicker:
+    """Sorteia afiliados: poucos "quentes" (Zipf) e cauda longa uniforme"""
+
+    def __init__(self, affiliates_by_size, hot_fraction=0.01, hot_share=0.8, miss_share=0.02, seed=7):
+        self.rng = random.Random(seed)
+        hot_count = max(int(len(affiliates_by_size) * hot_fraction), 1)
+        self.hot = affiliates_by_size[:hot_count]
+        self.tail = affiliates_by_size[hot_count:] or self.hot
+        self.hot_share = hot_share
+        self.miss_share = miss_share
+        # Pesos Zipf (1/rank) para os afiliados quentes
+        weights = [1.0 / rank for rank in range(1, len(self.hot) + 1)]
+        total = sum(weights)
+        self.cumulative = []
+        acc = 0.0
+        for weight in weights:
+            acc += weight / total
+            self.cumulative.append(acc)
+        self._lock = threading.Lock()
+
+    def pick(self):
+        with self._lock:
+            roll = self.rng.random()
+            if roll < self.miss_share:
+                # Afiliado inexistente (caminho "não encontrado")
+                return self.rng.randint(10 ** 8, 10 ** 9)
+            if roll < self.miss_share + self.hot_share:
+                point = self.rng.random()
+                for index, edge in enumerate(self.cumulative):
+                    if point <= edge:
+                        return self.hot[index]
+                return self.hot[-1]
+            return self.rng.choice(self.tail)
+
+    def level(self):
+        with self._lock:
+            return self.rng.randint(1, 5)
+
+
+class ServiceProcess:
+    """Sobe src/main.py apontando para o banco local"""
+
+    def __init__(self, pg_url, port):
+        self.pg_url = pg_url
+        self.port = port
+        self.process = None
+
+    def start(self, timeout=60):
+        env = dict(os.environ)
+        env.update({
+            'OPERATION_DB_URL': self.pg_url,
+            'MLM_DB_URL': self.pg_url,
+            'PORT': str(self.port),
+            'AUTO_START_SYNC': 'false',
+            # Carga de um único IP: com admissão ativa mediria 429/503, não as rotas
+            'ADMISSION_ENABLED': 'false'
+        })
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT_DIR, 'src', 'main.py')],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+        base_url = f"http://127.0.0.1:{self.port}"
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Serviço encerrou com código {self.process.returncode}")
+            try:
+                status, _ = request_json(base_url, 'GET', '/api/v1/sync/config')
+                if status == 200:
+                    return base_url
+            except OSError:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError("Serviço não ficou pronto a tempo")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def request_json(base_url, method, path, timeout=30):
+    parsed = urllib.parse.urlparse(base_url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    try:
+        conn.request(method, path)
+        response = conn.getresponse()
+        body = response.read()
+        return response.status, body
+    finally:
+        conn.close()
+
+
+class LoadPhase:
+    """Executa uma fase de carga e agrega latências por endpoint"""
+
+    def __init__(self, base_url, picker, concurrency, duration, timeout):
+        self.base_url = urllib.parse.urlparse(base_url)
+        self.picker = picker
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.samples = {name: [] for name in ENDPOINT_WEIGHTS}
+        self.errors = {name: 0 for name in ENDPOINT_WEIGHTS}
+        self.status_counts = {name: {} for name in ENDPOINT_WEIGHTS}
+        self._lock = threading.Lock()
+        names = list(ENDPOINT_WEIGHTS)
+        self._choices = [name for name in names for _ in range(ENDPOINT_WEIGHTS[name])]
+
+    def _path(self, endpoint):
+        if endpoint == 'summary':
+            return '/api/v1/mlm/summary'
+        affiliate_id = self.picker.pick()
+        if endpoint == 'levels':
+            return f'/api/v1/mlm/levels/{affiliate_id}/{self.picker.level()}'
+        return f'/api/v1/mlm/{endpoint}/{affiliate_id}'
+
+    def _worker(self, worker_id, deadline):
+        rng = random.Random(worker_id)
+        conn = None
+        local = {name: [] for name in ENDPOINT_WEIGHTS}
+        local_errors = {name: 0 for name in ENDPOINT_WEIGHTS}
+        local_status = {name: {} for name in ENDPOINT_WEIGHTS}
+
+        while time.time() < deadline:
+            endpoint = rng.choice(self._choices)
+            path = self._path(endpoint)
+            if conn is None:
+                # Keep-alive por worker, como um cliente HTTP real
+                conn = http.client.HTTPConnection(self.base_url.hostname, self.base_url.port, timeout=self.timeout)
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                status = str(response.status)
+                if response.status >= 400 and response.status != 404:
+                    local_errors[endpoint] += 1
+            except (OSError, http.client.HTTPException) as e:
+                status = type(e).__name__
+                local_errors[endpoint] += 1
+                conn.close()
+                conn = None
+            local[endpoint].append(time.perf_counter() - start)
+            local_status[endpoint][status] = local_status[endpoint].get(status, 0) + 1
+
+        if conn is not None:
+            conn.close()
+
+        with self._lock:
+            for name in ENDPOINT_WEIGHTS:
+                self.samples[name].extend(local[name])
+                self.errors[name] += local_errors[name]
+                for status, count in local_status[name].items():
+                    self.status_counts[name][status] = self.status_counts[name].get(status, 0) + count
+
+    def run(self):
+        deadline = time.time() + self.duration
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._worker, i, deadline) for i in range(self.concurrency)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        endpoints = {}
+        total = 0
+        for name, values in self.samples.items():
+            values.sort()
+            count = len(values)
+            total += count
+            endpoints[name] = {
+                'requests': count,
+                'errors': self.errors[name],
+                'error_rate': round(self.errors[name] / count, 6) if count else 0.0,
+                'throughput_rps': round(count / elapsed, 3) if elapsed else 0.0,
+                'p50_ms': _ms(percentile(values, 50)),
+                'p90_ms': _ms(percentile(values, 90)),
+                'p99_ms': _ms(percentile(values, 99)),
+                'max_ms': _ms(values[-1] if values else None),
+                'status_codes': self.status_counts[name]
+            }
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'concurrency': self.concurrency,
+            'total_requests': total,
+            'throughput_rps': round(total / elapsed, 3) if elapsed else 0.0,
+            'endpoints': endpoints
+        }
+
+
+def _ms(value):
+    return round(value * 1000.0, 3) if value is not None else None
+
+
+class SyncDriver:
+    """Dispara sincronizações manuais em sequência enquanto a carga roda
+
+    /sync/manual só enfileira o job: cada rodada aguarda o término (?wait= e,
+    se preciso, /sync/jobs/<job_id>) antes da próxima, e registra a duração
+    da sincronização informada pelo serviço.
+    """
+
+    WAIT_SECONDS = 300  # MAX_MANUAL_WAIT do serviço
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.stop_event = threading.Event()
+        self.runs = []
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            start = time.perf_counter()
+            try:
+                job = self._run_job()
+                run = {'status': job['status'], 'seconds': job.get('duration_seconds')}
+            except (OSError, ValueError) as e:
+                run = {'status': type(e).__name__, 'seconds': None}
+            run['wall_seconds'] = round(time.perf_counter() - start, 3)
+            self.runs.append(run)
+
+    def _run_job(self):
+        status, body = request_json(
+            self.base_url, 'POST', f'/api/v1/sync/manual?wait={self.WAIT_SECONDS}',
+            timeout=self.WAIT_SECONDS + 30
+        )
+        job = json.loads(body).get('data')
+        while job and job['status'] in ('queued', 'running'):
+            time.sleep(self.POLL_INTERVAL)
+            status, body = request_json(self.base_url, 'GET', f"/api/v1/sync/jobs/{job['job_id']}")
+            job = json.loads(body).get('data') if status == 200 else None
+        return job or {'status': f'http_{status}'}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+
+def seed_database(args, records):
+    """Popula tracked e executa uma sincronização completa em processo"""
+    from src.models.mlm_database import MLMDatabase
+    from src.models.sync_service import MLMSyncService
+
+    MLMDatabase(args.pg_url).close()
+    service = MLMSyncService(args.pg_url, args.pg_url)
+    try:
+        seed_tracked_table(service.operation_conn, records, reset=args.reset)
+        start = time.perf_counter()
+        service.sync_data()
+        return round(time.perf_counter() - start, 3)
+    finally:
+        service.operation_conn.close()
+        service.mlm_conn.close()
+
+
+def affiliates_by_network_size(records):
+    """Afiliados ordenados por número de indicações diretas (maiores primeiro)"""
+    counts = {}
+    for record in records:
+        counts[record['affiliate_id']] = counts.get(record['affiliate_id'], 0) + 1
+    return [affiliate for affiliate, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+
+
+def run_loadtest(args):
+    report = {
+        'benchmark': 'http_loadtest',
+        'preset': args.preset,
+        'seed': args.seed,
+        'scale': args.scale,
+        'started_at': datetime.now().isoformat()
+    }
+
+    records = generate_tracked(args.preset, seed=args.seed, scale=args.scale)
+    report['tracked_rows'] = len(records)
+
+    if not args.skip_seed:
+        logger.info("Populando banco local e executando sincronização inicial")
+        report['seed_sync_seconds'] = seed_database(args, records)
+
+    picker = AffiliatePicker(
+        affiliates_by_network_size(records),
+        hot_fraction=args.hot_fraction,
+        hot_share=args.hot_share,
+        seed=args.seed
+    )
+
+    service = None
+    base_url = args.base_url
+    if not base_url:
+        service = ServiceProcess(args.pg_url, args.port)
+        base_url = service.start()
+
+    try:
+        phases = {}
+        logger.info(f"Fase sem sincronização: {args.concurrency} clientes por {args.duration}s")
+        phases['idle'] = LoadPhase(base_url, picker, args.concurrency, args.duration, args.timeout).run()
+
+        if args.during_sync:
+            logger.info("Fase com sincronizações manuais em paralelo")
+            with SyncDriver(base_url) as driver:
+                phases['during_sync'] = LoadPhase(base_url, picker, args.concurrency, args.duration, args.timeout).run()
+            phases['during_sync']['sync_runs'] = driver.runs
+
+        report['phases'] = phases
+    finally:
+        if service:
+            service.stop()
+
+    report['finished_at'] = datetime.now().isoformat()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Teste de carga dos endpoints de leitura MLM')
+    parser.add_argument('--pg-url', required=True, help='PostgreSQL local (operação e MLM)')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--reset', action='store_true', help='Recria a tabela tracked no banco local')
+    parser.add_argument('--skip-seed', action='store_true', help='Usa os dados já presentes no banco')
+    parser.add_argument('--base-url', help='Usa um serviço já em execução em vez de subir um novo')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30.0, help='Segundos por fase')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Timeout por requisição')
+    parser.add_argument('--hot-fraction', type=float, default=0.01, help='Fração de afiliados "quentes"')
+    parser.add_argument('--hot-share', type=float, default=0.8, help='Fração das requisições para afiliados quentes')
+    parser.add_argument('--during-sync', action='store_true', help='Repete a fase com sincronizações em paralelo')
+    parser.add_argument('--output', help='Arquivo JSON de saída (padrão: stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    report = run_loadtest(args)
+    output = json.dumps(report, indent=2, default=str)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
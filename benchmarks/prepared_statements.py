@@ -0,0 +1,163 @@
+# Instruções preparadas x texto enviado a cada chamada nas leituras da API
+#
+# Uso:
+#   python -m benchmarks.prepared_statements --pg-url postgresql://localhost/mlm_bench --reset
+#   python -m benchmarks.prepared_statements --pg-url ... --skip-seed --iterations 5000 --output prepared.json
+#
+# Popula o banco local (mesmo processo de benchmarks.loadtest) e executa as
+# consultas de /hierarchy e /stats pelo MLMDatabase duas vezes: com
+# MLM_PREPARED_STATEMENTS desativado e ativado, alternando os mesmos
+# afiliados. Reporta latência por chamada e o "Planning Time" do EXPLAIN
+# (ANALYZE, SUMMARY) de cada modo.
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.loadtest import affiliates_by_network_size, percentile, seed_database
+from benchmarks.synthetic import PRESETS, generate_tracked
+
+logger = logging.getLogger('benchmarks.prepared_statements')
+
+# Consulta do MLMDatabase por endpoint
+ENDPOINTS = {
+    'hierarchy': ('mlm_affiliate_hierarchy', lambda db, affiliate: db.get_affiliate_hierarchy(affiliate, 5)),
+    'stats': ('mlm_affiliate_levels', lambda db, affiliate: db.calculate_affiliate_stats(affiliate))
+}
+
+
+def _ms(seconds):
+    return round(seconds * 1000.0, 4)
+
+
+def measure_calls(db, call, affiliates, iterations):
+    """Latência de cada chamada em segundos (após aquecimento)"""
+    for affiliate in affiliates[:10]:
+        call(db, affiliate)
+    timings = []
+    for index in range(iterations):
+        affiliate = affiliates[index % len(affiliates)]
+        start = time.perf_counter()
+        call(db, affiliate)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'calls': iterations,
+        'mean_ms': _ms(sum(timings) / len(timings)),
+        'p50_ms': _ms(percentile(timings, 50)),
+        'p99_ms': _ms(percentile(timings, 99))
+    }
+
+
+def planning_time(db, statement_name, affiliates, samples):
+    """Média do Planning Time (ms) reportado pelo EXPLAIN no modo do db"""
+    statement = db.statements.statements[statement_name]
+    # (afiliado, max_level) ou só o afiliado, conforme a instrução
+    params_for = lambda affiliate: (affiliate, 5)[:len(statement.param_types)]
+    total = 0.0
+    with db.connection.cursor() as cursor:
+        for index in range(samples):
+            affiliate = affiliates[index % len(affiliates)]
+            if db.statements.enabled:
+                # Garante o PREPARE na conexão e mede só o EXECUTE
+                db.statements.execute(cursor, statement_name, params_for(affiliate))
+                cursor.execute(
+                    "EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + statement.execute_sql(),
+                    params_for(affiliate)
+                )
+            else:
+                sql, params = statement.text_query(params_for(affiliate))
+                cursor.execute("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) " + sql, params)
+            total += cursor.fetchone()[0][0]['Planning Time']
+    return round(total / samples, 4)
+
+
+def run(args):
+    from src.models.mlm_database import MLMDatabase
+
+    report = {
+        'benchmark': 'prepared_statements',
+        'preset': args.preset,
+        'seed': args.seed,
+        'scale': args.scale,
+        'iterations': args.iterations,
+        'started_at': datetime.now().isoformat()
+    }
+
+    records = generate_tracked(args.preset, seed=args.seed, scale=args.scale)
+    report['tracked_rows'] = len(records)
+    if not args.skip_seed:
+        logger.info("Populando banco local e executando sincronização inicial")
+        report['seed_sync_seconds'] = seed_database(args, records)
+
+    # Mistura de afiliados grandes e comuns, igual para os dois modos
+    ranked = affiliates_by_network_size(records)
+    rng = random.Random(args.seed)
+    affiliates = ranked[:50] + rng.sample(ranked, min(len(ranked), 450))
+    rng.shuffle(affiliates)
+
+    results = {}
+    for mode, enabled in (('text', False), ('prepared', True)):
+        db = MLMDatabase(args.pg_url, prepared_statements=enabled)
+        try:
+            results[mode] = {}
+            for endpoint, (statement_name, call) in ENDPOINTS.items():
+                logger.info(f"Medindo {endpoint} ({mode})")
+                stats = measure_calls(db, call, affiliates, args.iterations)
+                stats['planning_ms'] = planning_time(db, statement_name, affiliates, args.explain_samples)
+                results[mode][endpoint] = stats
+        finally:
+            db.close()
+
+    report['results'] = results
+    report['saved_per_request'] = {
+        endpoint: {
+            'mean_ms': round(results['text'][endpoint]['mean_ms'] - results['prepared'][endpoint]['mean_ms'], 4),
+            'planning_ms': round(
+                results['text'][endpoint]['planning_ms'] - results['prepared'][endpoint]['planning_ms'], 4
+            )
+        }
+        for endpoint in ENDPOINTS
+    }
+    report['finished_at'] = datetime.now().isoformat()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Instruções preparadas x texto nas leituras da API')
+    parser.add_argument('--pg-url', required=True, help='PostgreSQL local (operação e MLM)')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--reset', action='store_true', help='Recria a tabela tracked no banco local')
+    parser.add_argument('--skip-seed', action='store_true', help='Usa os dados já presentes no banco')
+    parser.add_argument('--iterations', type=int, default=2000, help='Chamadas por endpoint e modo')
+    parser.add_argument('--explain-samples', type=int, default=50, help='EXPLAIN por endpoint e modo')
+    parser.add_argument('--output', help='Arquivo JSON de saída (padrão: stdout)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    report = run(args)
+    output = json.dumps(report, indent=2, default=str)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
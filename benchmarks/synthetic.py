@@ -0,0 +1,178 @@
+# Gerador sintético de dados no formato da tabela `tracked`
+# Determinístico por seed; não depende de acesso ao banco de produção
+
+import io
+import random
+from datetime import datetime, timedelta
+
+# Presets: número de registros (antes de --scale) e descrição
+PRESETS = {
+    'small': {'rows': 20000, 'description': 'Rede pequena para execuções rápidas'},
+    'wide': {'rows': 200000, 'description': 'Poucas raízes com fan-out muito alto'},
+    'deep': {'rows': 50000, 'description': 'Cadeias longas (profundidade na casa dos milhares)'},
+    'production': {'rows': 615000, 'description': 'Volume de produção (~615k registros)'},
+    'cycles': {'rows': 100000, 'description': 'Rede realista com ciclos e auto-indicações'}
+}
+
+BASE_DATE = datetime(2023, 1, 1)
+SPAN_DAYS = 730
+
+
+class _IdAllocator:
+    """Gera IDs de usuário únicos e não sequenciais"""
+
+    def __init__(self, rng, start=100000):
+        self.rng = rng
+        self.next_id = start
+
+    def new(self):
+        self.next_id += self.rng.randint(1, 7)
+        return self.next_id
+
+
+def _row(row_id, affiliate_id, user_id, created_at):
+    return {
+        'id': row_id,
+        'affiliate_id': affiliate_id,
+        'referred_user_id': user_id,
+        'tracked_type_id': 1,
+        'created_at': created_at
+    }
+
+
+def _grow_network(rng, ids, rows, root_rate, affiliate_rate, root_bias=0.0, roots=None):
+    """Rede com anexação preferencial: afiliados com mais indicações recebem mais"""
+    records = []
+    roots = list(roots or [])
+    pool = list(roots)  # cada ocorrência é um "bilhete" de anexação
+
+    for i in range(rows):
+        if not pool or rng.random() < root_rate:
+            affiliate_id = ids.new()
+            roots.append(affiliate_id)
+            pool.append(affiliate_id)
+        elif roots and rng.random() < root_bias:
+            affiliate_id = rng.choice(roots)
+        else:
+            affiliate_id = rng.choice(pool)
+
+        user_id = ids.new()
+        created_at = BASE_DATE + timedelta(seconds=int(SPAN_DAYS * 86400 * i / max(rows, 1)))
+        records.append((affiliate_id, user_id, created_at))
+
+        pool.append(affiliate_id)
+        if rng.random() < affiliate_rate:
+            pool.append(user_id)
+
+    return records
+
+
+def _deep_chains(rng, ids, rows, chains):
+    """Cadeias lineares: cada usuário indica o próximo, com algumas folhas"""
+    records = []
+    per_chain = max(rows // chains, 1)
+    for _ in range(chains):
+        current = ids.new()
+        for i in range(per_chain):
+            created_at = BASE_DATE + timedelta(minutes=i)
+            if rng.random() < 0.2:
+                # Folha (usuário que não indica ninguém)
+                records.append((current, ids.new(), created_at))
+            else:
+                nxt = ids.new()
+                records.append((current, nxt, created_at))
+                current = nxt
+    return records
+
+
+def _cycles(rng, ids, records, count):
+    """Injeta ciclos isolados, ciclos ligados à árvore e auto-indicações"""
+    extra = []
+    created_at = BASE_DATE + timedelta(days=SPAN_DAYS)
+
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            # Ciclo isolado A -> B -> ... -> A (sem raiz)
+            members = [ids.new() for _ in range(rng.randint(2, 6))]
+            for a, b in zip(members, members[1:] + members[:1]):
+                extra.append((a, b, created_at))
+        elif kind == 1 and records:
+            # Usuário da árvore indica quem o indicou (ciclo ligado à rede)
+            parent, user, _ = records[rng.randrange(len(records))]
+            extra.append((user, parent, created_at))
+        else:
+            # Auto-indicação
+            user = ids.new()
+            extra.append((user, user, created_at))
+
+    return records + extra
+
+
+def generate_tracked(preset='small', seed=42, scale=1.0):
+    """Gera registros no formato retornado por MLMSyncService.get_tracked_data"""
+    if preset not in PRESETS:
+        raise ValueError(f"Preset desconhecido: {preset} (disponíveis: {', '.join(PRESETS)})")
+
+    rng = random.Random(seed)
+    ids = _IdAllocator(rng)
+    rows = max(int(PRESETS[preset]['rows'] * scale), 10)
+
+    if preset == 'wide':
+        roots = [ids.new() for _ in range(10)]
+        edges = _grow_network(rng, ids, rows, root_rate=0.0, affiliate_rate=0.02, root_bias=0.9, roots=roots)
+    elif preset == 'deep':
+        edges = _deep_chains(rng, ids, rows, chains=5)
+    elif preset == 'cycles':
+        edges = _grow_network(rng, ids, rows, root_rate=0.002, affiliate_rate=0.05)
+        edges = _cycles(rng, ids, edges, count=max(rows // 1000, 3))
+    else:
+        edges = _grow_network(rng, ids, rows, root_rate=0.002, affiliate_rate=0.05)
+
+    records = [
+        _row(row_id, affiliate_id, user_id, created_at)
+        for row_id, (affiliate_id, user_id, created_at) in enumerate(edges, start=1)
+    ]
+    # Mesma ordenação da consulta real (ORDER BY user_afil, user_id)
+    records.sort(key=lambda r: (r['affiliate_id'], r['referred_user_id']))
+    return records
+
+
+def seed_tracked_table(conn, records, reset=False):
+    """Cria e popula a tabela `tracked` em um PostgreSQL local via COPY"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('tracked') IS NOT NULL")
+        exists = cursor.fetchone()[0]
+
+        if exists and not reset:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM tracked)")
+            if cursor.fetchone()[0]:
+                raise RuntimeError("Tabela tracked já possui dados; use --reset para recriá-la")
+
+        if reset:
+            cursor.execute("DROP TABLE IF EXISTS tracked")
+
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS tracked (
+                id BIGINT PRIMARY KEY,
+                user_afil BIGINT,
+                user_id BIGINT,
+                tracked_type_id INTEGER,
+                created_at TIMESTAMP
+            )
+        """)
+
+        buffer = io.StringIO()
+        for record in records:
+            buffer.write(
+                f"{record['id']},{record['affiliate_id']},{record['referred_user_id']},"
+                f"{record['tracked_type_id']},{record['created_at'].isoformat()}\n"
+            )
+        buffer.seek(0)
+        cursor.copy_expert(
+            "COPY tracked (id, user_afil, user_id, tracked_type_id, created_at) FROM STDIN WITH CSV",
+            buffer
+        )
+        cursor.execute("ANALYZE tracked")
+
+    return len(records)
@@ -10,6 +10,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from flask import Flask, jsonify, request
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
 
 # Carregar variáveis de ambiente
@@ -25,12 +26,27 @@ logger = logging.getLogger(__name__)
 # Importar módulos do MLM
 from src.models.mlm_database import MLMDatabase
 from src.models.sync_service import MLMSyncService
-from src.routes.mlm_api import mlm_bp
-from src.routes.sync_api import sync_bp
+from src.routes.mlm_api import mlm_bp, init_mlm_routes
+from src.routes.sync_api import sync_bp, init_sync_services
+from src.routes.metrics_api import metrics_bp, init_metrics_routes
+from src.routes.admin_api import admin_bp
+from src.models.query_log import query_log
+from src.models.single_flight import single_flight
+from src.models.admission import admission, RedisBackend
+from src.models.health import HealthSampler, postgres_check, sync_lag_info
+from src.models.snapshot import SnapshotStore
+from src.models.leaderboard import Leaderboard
 
 app = Flask(__name__)
 CORS(app)
 
+# Proxies reversos confiáveis à frente da aplicação (0 = conexão direta).
+# Com N > 0, request.remote_addr passa a ser o IP visto pelo proxy mais externo
+# em X-Forwarded-For; valores anteriores na cadeia, enviados pelo cliente, são ignorados.
+app.config['PROXY_FIX_HOPS'] = int(os.getenv('PROXY_FIX_HOPS', 0))
+if app.config['PROXY_FIX_HOPS'] > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_HOPS'])
+
 # Configurações
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'mlm_secret_key_2025')
 
@@ -45,29 +61,176 @@ app.config['MLM_DB_URL'] = os.getenv(
     'postgresql://localhost:5432/fature_mlm'
 )
 
+# Réplicas de leitura do banco MLM (URLs separadas por vírgula; vazio = só primário)
+app.config['MLM_DB_REPLICA_URLS'] = [
+    url.strip() for url in os.getenv('MLM_DB_REPLICA_URLS', '').split(',') if url.strip()
+]
+app.config['MLM_REPLICA_MAX_LAG'] = float(os.getenv('MLM_REPLICA_MAX_LAG', 10))
+app.config['MLM_REPLICA_CHECK_INTERVAL'] = float(os.getenv('MLM_REPLICA_CHECK_INTERVAL', 5))
+# Leituras quentes como instruções preparadas por conexão (false atrás de pgbouncer em modo transaction)
+app.config['MLM_PREPARED_STATEMENTS'] = os.getenv('MLM_PREPARED_STATEMENTS', 'true').lower() == 'true'
+
 app.config['REDIS_URL'] = os.getenv(
     'REDIS_URL',
     'redis://localhost:6379/0'
 )
 
+app.config['ADMIN_TOKEN'] = os.getenv('ADMIN_TOKEN')
+app.config['HEALTH_CHECK_INTERVAL'] = float(os.getenv('HEALTH_CHECK_INTERVAL', 15))
+app.config['HEALTH_CHECK_TIMEOUT'] = float(os.getenv('HEALTH_CHECK_TIMEOUT', 5))
+app.config['AUTO_START_SYNC'] = os.getenv('AUTO_START_SYNC', 'true').lower() == 'true'
+
+# Snapshot binário da hierarquia (vazio desativa gravação e leitura)
+app.config['SNAPSHOT_DIR'] = os.getenv('SNAPSHOT_DIR', 'data/snapshots')
+app.config['SNAPSHOT_CHECK_INTERVAL'] = float(os.getenv('SNAPSHOT_CHECK_INTERVAL', 5))
+
+# CDC de tracked via LISTEN/NOTIFY (polling continua como fallback)
+app.config['CDC_ENABLED'] = os.getenv('CDC_ENABLED', 'false').lower() == 'true'
+app.config['CDC_CHANNEL'] = os.getenv('CDC_CHANNEL', 'mlm_tracked_changes')
+app.config['CDC_BATCH_SIZE'] = int(os.getenv('CDC_BATCH_SIZE', 500))
+app.config['CDC_BATCH_WINDOW_MS'] = float(os.getenv('CDC_BATCH_WINDOW_MS', 250))
+app.config['CDC_RESYNC_INTERVAL'] = float(os.getenv('CDC_RESYNC_INTERVAL', 3600))
+app.config['CDC_INSTALL_TRIGGER'] = os.getenv('CDC_INSTALL_TRIGGER', 'false').lower() == 'true'
+
+# Motor incremental de arestas (mantém a hierarquia em memória entre sincronizações)
+app.config['INCREMENTAL_ENGINE'] = os.getenv('INCREMENTAL_ENGINE', 'true').lower() == 'true'
+
+# Volume por usuário agregado no banco da operação (desativado: total_volume = 0)
+app.config['VOLUME_ENABLED'] = os.getenv('VOLUME_ENABLED', 'false').lower() == 'true'
+app.config['VOLUME_SOURCE_TABLE'] = os.getenv('VOLUME_SOURCE_TABLE', 'transactions')
+app.config['VOLUME_USER_COLUMN'] = os.getenv('VOLUME_USER_COLUMN', 'user_id')
+app.config['VOLUME_AMOUNT_COLUMN'] = os.getenv('VOLUME_AMOUNT_COLUMN', 'amount')
+app.config['VOLUME_FILTER'] = os.getenv('VOLUME_FILTER', '')
+app.config['VOLUME_BATCH_SIZE'] = int(os.getenv('VOLUME_BATCH_SIZE', 10000))
+
+# Agendador da sincronização (jitter em fração do intervalo; 0 = 10x o intervalo)
+app.config['SYNC_JITTER'] = float(os.getenv('SYNC_JITTER', 0.1))
+app.config['SYNC_MAX_INTERVAL'] = float(os.getenv('SYNC_MAX_INTERVAL', 0))
+
+# Extração paralela de tracked por faixas de id (EXTRACT_WORKERS <= 1 = consulta única)
+app.config['EXTRACT_WORKERS'] = int(os.getenv('EXTRACT_WORKERS', 1))
+app.config['EXTRACT_RANGE_SIZE'] = int(os.getenv('EXTRACT_RANGE_SIZE', 100000))
+app.config['EXTRACT_BATCH_SIZE'] = int(os.getenv('EXTRACT_BATCH_SIZE', 10000))
+# Teto de linhas por segundo somando todas as conexões (0 = sem limite)
+app.config['EXTRACT_MAX_ROWS_PER_SECOND'] = float(os.getenv('EXTRACT_MAX_ROWS_PER_SECOND', 0))
+
+# Perfil de memória por etapa da sincronização (tracemalloc + RSS; mais lento)
+app.config['MEMORY_PROFILE'] = os.getenv('MEMORY_PROFILE', 'false').lower() == 'true'
+app.config['MEMORY_PROFILE_DIR'] = os.getenv('MEMORY_PROFILE_DIR', '')
+app.config['MEMORY_PROFILE_TOP'] = int(os.getenv('MEMORY_PROFILE_TOP', 10))
+
+# Ranking pré-calculado (posições guardadas por nível e no total N1-N5)
+app.config['LEADERBOARD_SIZE'] = int(os.getenv('LEADERBOARD_SIZE', 1000))
+
+# Sincronização particionada por rede raiz (SYNC_SHARDS <= 1 desativa)
+app.config['SYNC_SHARDS'] = int(os.getenv('SYNC_SHARDS', 0))
+app.config['SYNC_WORKER_ID'] = os.getenv('SYNC_WORKER_ID')
+app.config['SYNC_SHARD_TIMEOUT'] = float(os.getenv('SYNC_SHARD_TIMEOUT', 1800))
+app.config['SYNC_SHARD_POLL_INTERVAL'] = float(os.getenv('SYNC_SHARD_POLL_INTERVAL', 2))
+
+# Log de consultas lentas (EXPLAIN amostrado acima do limite)
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', 500))
+app.config['SLOW_QUERY_EXPLAIN_SAMPLE_RATE'] = float(os.getenv('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.1))
+app.config['SLOW_QUERY_LOG_SIZE'] = int(os.getenv('SLOW_QUERY_LOG_SIZE', 100))
+app.config['SLOW_QUERY_EXPLAIN'] = os.getenv('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true'
+
+# Controle de admissão nas rotas da API (token bucket por cliente + vagas por classe)
+# Desativado por padrão: atrás de proxy, sem PROXY_FIX_HOPS, todos os clientes teriam o IP do proxy
+app.config['ADMISSION_ENABLED'] = os.getenv('ADMISSION_ENABLED', 'false').lower() == 'true'
+app.config['ADMISSION_BACKEND'] = os.getenv('ADMISSION_BACKEND', 'memory')  # memory ou redis (REDIS_URL)
+app.config['ADMISSION_RATE'] = float(os.getenv('ADMISSION_RATE', 20))
+app.config['ADMISSION_BURST'] = float(os.getenv('ADMISSION_BURST', 40))
+app.config['ADMISSION_CHEAP_RESERVE'] = float(os.getenv('ADMISSION_CHEAP_RESERVE', 10))
+app.config['ADMISSION_STANDARD_CONCURRENCY'] = int(os.getenv('ADMISSION_STANDARD_CONCURRENCY', 8))
+app.config['ADMISSION_HEAVY_CONCURRENCY'] = int(os.getenv('ADMISSION_HEAVY_CONCURRENCY', 2))
+# Clientes identificados por X-Client-Id (pares id:token separados por vírgula);
+# sem X-Client-Token válido o cliente é o IP
+app.config['ADMISSION_CLIENT_TOKENS'] = dict(
+    (client.strip(), token.strip())
+    for client, _, token in (entry.partition(':') for entry in os.getenv('ADMISSION_CLIENT_TOKENS', '').split(','))
+    if client.strip() and token.strip()
+)
+
+# Leituras idênticas simultâneas compartilham uma consulta (single-flight)
+app.config['SINGLE_FLIGHT'] = os.getenv('SINGLE_FLIGHT', 'true').lower() == 'true'
+app.config['SINGLE_FLIGHT_TIMEOUT'] = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 30))
+
+query_log.configure(
+    threshold_ms=app.config['SLOW_QUERY_THRESHOLD_MS'],
+    sample_rate=app.config['SLOW_QUERY_EXPLAIN_SAMPLE_RATE'],
+    capacity=app.config['SLOW_QUERY_LOG_SIZE'],
+    explain=app.config['SLOW_QUERY_EXPLAIN']
+)
+single_flight.configure(
+    enabled=app.config['SINGLE_FLIGHT'],
+    wait_timeout=app.config['SINGLE_FLIGHT_TIMEOUT']
+)
+
+if app.config['ADMISSION_ENABLED'] and os.getenv('PROXY_FIX_HOPS') is None:
+    logger.warning(
+        "Controle de admissão ativo sem PROXY_FIX_HOPS: atrás de um proxy reverso todos os "
+        "clientes compartilham o mesmo token bucket (defina PROXY_FIX_HOPS, 0 se a conexão é direta)"
+    )
+
+admission_backend = None
+if app.config['ADMISSION_ENABLED'] and app.config['ADMISSION_BACKEND'] == 'redis':
+    try:
+        admission_backend = RedisBackend(app.config['REDIS_URL'])
+    except Exception as e:
+        logger.warning(f"Backend Redis do controle de admissão indisponível ({e}); usando memória")
+admission.configure(
+    enabled=app.config['ADMISSION_ENABLED'],
+    backend=admission_backend,
+    rate=app.config['ADMISSION_RATE'],
+    burst=app.config['ADMISSION_BURST'],
+    reserve=app.config['ADMISSION_CHEAP_RESERVE'],
+    standard_limit=app.config['ADMISSION_STANDARD_CONCURRENCY'],
+    heavy_limit=app.config['ADMISSION_HEAVY_CONCURRENCY'],
+    client_tokens=app.config['ADMISSION_CLIENT_TOKENS']
+)
+# /health, /metrics e admin ficam fora (nunca recebem 429/503 do controle)
+admission.install(mlm_bp)
+admission.install(sync_bp)
+
 # Registrar blueprints
 app.register_blueprint(mlm_bp, url_prefix='/api/v1/mlm')
 app.register_blueprint(sync_bp, url_prefix='/api/v1/sync')
+app.register_blueprint(metrics_bp)
+app.register_blueprint(admin_bp, url_prefix='/api/v1/admin')
 
 # Inicializar serviços
 mlm_db = None
 sync_service = None
+health_sampler = None
+snapshot_store = None
 
 def initialize_services():
     """Inicializa serviços MLM"""
-    global mlm_db, sync_service
+    global mlm_db, sync_service, health_sampler, snapshot_store
     
     try:
         logger.info("Iniciando inicialização dos serviços...")
         
+        # Amostrador de saúde com conexões próprias (probes não tocam nos bancos)
+        health_sampler = HealthSampler(
+            checks={
+                'mlm_db': postgres_check(app.config['MLM_DB_URL']),
+                'operation_db': postgres_check(app.config['OPERATION_DB_URL'])
+            },
+            interval=app.config['HEALTH_CHECK_INTERVAL'],
+            timeout=app.config['HEALTH_CHECK_TIMEOUT']
+        )
+        health_sampler.start()
+        
         # Inicializar banco MLM com tratamento de erro
         try:
-            mlm_db = MLMDatabase(app.config['MLM_DB_URL'])
+            mlm_db = MLMDatabase(
+                app.config['MLM_DB_URL'],
+                replica_urls=app.config['MLM_DB_REPLICA_URLS'],
+                max_replica_lag=app.config['MLM_REPLICA_MAX_LAG'],
+                replica_check_interval=app.config['MLM_REPLICA_CHECK_INTERVAL'],
+                prepared_statements=app.config['MLM_PREPARED_STATEMENTS']
+            )
             logger.info("Banco MLM inicializado com sucesso")
         except Exception as e:
             logger.warning(f"Erro ao inicializar banco MLM: {e}")
@@ -80,16 +243,84 @@ def initialize_services():
                 mlm_db_url=app.config['MLM_DB_URL'],
                 redis_url=app.config['REDIS_URL']
             )
+            sync_service.snapshot_dir = app.config['SNAPSHOT_DIR'] or None
+            sync_service.scheduler.jitter = app.config['SYNC_JITTER']
+            sync_service.scheduler.max_interval = app.config['SYNC_MAX_INTERVAL'] or None
+            sync_service.incremental_enabled = app.config['INCREMENTAL_ENGINE']
+            sync_service.memory_profile = app.config['MEMORY_PROFILE']
+            sync_service.memory_profile_dir = app.config['MEMORY_PROFILE_DIR'] or None
+            sync_service.memory_profile_top = app.config['MEMORY_PROFILE_TOP']
+            sync_service.leaderboard = Leaderboard(app.config['LEADERBOARD_SIZE'])
+            if app.config['VOLUME_ENABLED']:
+                sync_service.volume_source = {
+                    'table': app.config['VOLUME_SOURCE_TABLE'],
+                    'user_column': app.config['VOLUME_USER_COLUMN'],
+                    'amount_column': app.config['VOLUME_AMOUNT_COLUMN'],
+                    'filter': app.config['VOLUME_FILTER'],
+                    'batch_size': app.config['VOLUME_BATCH_SIZE']
+                }
+            
+            if app.config['EXTRACT_WORKERS'] > 1:
+                sync_service.enable_parallel_extract(
+                    workers=app.config['EXTRACT_WORKERS'],
+                    range_size=app.config['EXTRACT_RANGE_SIZE'],
+                    batch_size=app.config['EXTRACT_BATCH_SIZE'],
+                    max_rows_per_second=app.config['EXTRACT_MAX_ROWS_PER_SECOND'] or None
+                )
+            
+            # Partida a quente: última geração publicada vira baseline da
+            # primeira sincronização (incremental) e preenche last_sync
+            try:
+                sync_service.warm_start(sync_service.snapshot_dir)
+            except Exception as e:
+                logger.warning(f"Erro na partida a quente, primeira sincronização será completa: {e}")
+            
+            if app.config['SYNC_SHARDS'] > 1:
+                sync_service.enable_sharding(
+                    app.config['SYNC_SHARDS'],
+                    worker_id=app.config['SYNC_WORKER_ID'],
+                    shard_timeout=app.config['SYNC_SHARD_TIMEOUT'],
+                    poll_interval=app.config['SYNC_SHARD_POLL_INTERVAL']
+                )
+            
+            if app.config['CDC_ENABLED'] and sync_service.sharding:
+                logger.warning("CDC ignorado: incompatível com a sincronização particionada")
+            elif app.config['CDC_ENABLED']:
+                try:
+                    sync_service.enable_cdc(
+                        channel=app.config['CDC_CHANNEL'],
+                        batch_size=app.config['CDC_BATCH_SIZE'],
+                        batch_window=app.config['CDC_BATCH_WINDOW_MS'] / 1000.0,
+                        resync_interval=app.config['CDC_RESYNC_INTERVAL'],
+                        install_trigger=app.config['CDC_INSTALL_TRIGGER']
+                    )
+                except Exception as e:
+                    logger.warning(f"Erro ao ativar CDC, mantendo polling: {e}")
             
             # Iniciar worker de sincronização em thread separada
-            sync_thread = threading.Thread(target=sync_service.start_sync_worker, daemon=True)
-            sync_thread.start()
-            logger.info("Serviço de sincronização iniciado")
+            if app.config['AUTO_START_SYNC']:
+                sync_thread = threading.Thread(target=sync_service.start_sync_worker, daemon=True)
+                sync_thread.start()
+                logger.info("Serviço de sincronização iniciado")
+            else:
+                logger.info("AUTO_START_SYNC desativado - worker de sincronização não iniciado")
             
         except Exception as e:
             logger.warning(f"Erro ao inicializar serviço de sincronização: {e}")
             sync_service = None
         
+        # Snapshot mapeado em memória (compartilhado entre processos web)
+        if app.config['SNAPSHOT_DIR']:
+            snapshot_store = SnapshotStore(
+                app.config['SNAPSHOT_DIR'],
+                check_interval=app.config['SNAPSHOT_CHECK_INTERVAL']
+            )
+        
+        # Disponibilizar serviços para as rotas
+        init_mlm_routes(mlm_db, sync_service, snapshot_store)
+        init_sync_services(sync_service, mlm_db, health_sampler)
+        init_metrics_routes(mlm_db, sync_service)
+        
         logger.info("Inicialização dos serviços concluída")
         
     except Exception as e:
@@ -112,11 +343,23 @@ def index():
         ],
         'endpoints': {
             'health': '/health',
+            'metrics': '/metrics',
             'mlm_hierarchy': '/api/v1/mlm/hierarchy/{affiliate_id}',
             'mlm_stats': '/api/v1/mlm/stats/{affiliate_id}',
             'mlm_commissions': '/api/v1/mlm/commissions/{affiliate_id}',
+            'mlm_upline': '/api/v1/mlm/upline/{affiliate_id}',
+            'mlm_edges': '/api/v1/mlm/edges',
+            'mlm_export': '/api/v1/mlm/export/{hierarchy|levels}',
+            'mlm_leaderboard': '/api/v1/mlm/leaderboard',
+            'mlm_affiliate_search': '/api/v1/mlm/affiliates/search',
             'sync_manual': '/api/v1/sync/manual',
-            'sync_status': '/api/v1/sync/status'
+            'sync_status': '/api/v1/sync/status',
+            'sync_job': '/api/v1/sync/jobs/{job_id}',
+            'sync_queue': '/api/v1/sync/queue',
+            'sync_memory_profile': '/api/v1/sync/memory-profile',
+            'sync_shadow': '/api/v1/sync/shadow',
+            'slow_queries': '/api/v1/admin/slow-queries',
+            'single_flight': '/api/v1/admin/single-flight'
         },
         'timestamp': datetime.now().isoformat()
     })
@@ -125,16 +368,11 @@ def index():
 def health_check():
     """Health check endpoint"""
     try:
-        # Verificar se os serviços estão inicializados
-        mlm_status = False
-        sync_status = False
-        
-        if mlm_db:
-            try:
-                mlm_status = mlm_db.check_connection()
-            except:
-                mlm_status = False
+        # Resultado em cache do amostrador: o probe não executa consultas
+        checks = health_sampler.snapshot() if health_sampler else None
+        mlm_status = bool(mlm_db and health_sampler and health_sampler.is_ok('mlm_db'))
         
+        sync_status = False
         if sync_service:
             try:
                 sync_status = hasattr(sync_service, 'is_running') and sync_service.is_running
@@ -150,6 +388,8 @@ def health_check():
                 'mlm_database': 'connected' if mlm_status else 'initializing',
                 'sync_service': 'running' if sync_status else 'initializing'
             },
+            'checks': checks,
+            'sync': sync_lag_info(sync_service),
             'message': 'Service is operational'
         })
         
@@ -0,0 +1,377 @@
+# Controle de admissão das rotas da API (limite por cliente e por classe de rota)
+#
+# As rotas pesadas (hierarquia recursiva, exportação, sincronização manual)
+# disputam a mesma conexão do banco com as baratas. Sem limite, um pico nas
+# pesadas deixa todas as requisições esperando até o timeout. Aqui cada
+# requisição passa por duas verificações antes de chegar à rota:
+#
+# - Token bucket por cliente (X-Client-Id autenticado ou IP): taxa rate e
+#   rajada burst.
+#   O custo depende da classe (barata 1, padrão 2, pesada 5) e as classes
+#   padrão/pesada não podem gastar os últimos reserve tokens, guardados para
+#   as baratas. Sem token: 429 com Retry-After.
+# - Limite de concorrência por classe (barata sem limite): com todas as vagas
+#   ocupadas a resposta é 503 imediato com Retry-After, sem fila.
+#
+# O estado fica em memória do processo ou no Redis (compartilhado entre os
+# processos web, com scripts Lua atômicos). Se o Redis falhar, o limite
+# continua valendo por processo, com o estado em memória.
+
+import hmac
+import math
+import threading
+import time
+import uuid
+import logging
+
+from flask import g, jsonify, request
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_DECISIONS = registry.counter(
+    'mlm_admission_decisions_total',
+    'Decisões do controle de admissão por classe de rota e resultado',
+    ('route_class', 'result')
+)
+ADMISSION_IN_FLIGHT = registry.gauge(
+    'mlm_admission_in_flight',
+    'Requisições admitidas em andamento neste processo por classe de rota',
+    ('route_class',)
+)
+ADMISSION_BACKEND_ERRORS = registry.counter(
+    'mlm_admission_backend_errors_total',
+    'Falhas do backend compartilhado (decisão tomada com o estado em memória)'
+)
+
+CHEAP = 'cheap'
+STANDARD = 'standard'
+HEAVY = 'heavy'
+ROUTE_CLASSES = (CHEAP, STANDARD, HEAVY)
+
+# Tokens consumidos por requisição de cada classe
+COSTS = {CHEAP: 1, STANDARD: 2, HEAVY: 5}
+
+# Endpoint Flask -> classe (demais rotas dos blueprints: padrão)
+ENDPOINT_CLASSES = {
+    'mlm.health_check': CHEAP,
+    'mlm.get_leaderboard': CHEAP,
+    'mlm.get_upline': CHEAP,
+    'mlm.get_summary': CHEAP,
+    'sync.sync_health': CHEAP,
+    'sync.sync_job': CHEAP,
+    'sync.sync_queue': CHEAP,
+    'sync.sync_memory_profile': CHEAP,
+    'mlm.get_hierarchy': HEAVY,
+    'mlm.export_dataset': HEAVY,
+    'sync.manual_sync': HEAVY,
+    'sync.sync_shadow': HEAVY
+}
+
+LEASE_TTL = 300  # segundos; vaga no Redis de processo que morreu sem liberar
+
+
+class MemoryBackend:
+    """Estado em memória do processo (um worker; também usado em testes)"""
+
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # cliente -> (tokens, instante)
+        self._slots = {route_class: set() for route_class in ROUTE_CLASSES}
+        self._last_sweep = time.monotonic()
+
+    def take(self, client, rate, burst, cost, floor):
+        """(admitido, espera em segundos até haver tokens)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens - cost >= floor:
+                self._buckets[client] = (tokens - cost, now)
+                allowed, wait = True, 0.0
+            else:
+                self._buckets[client] = (tokens, now)
+                allowed, wait = False, (cost + floor - tokens) / rate
+            self._sweep(now, rate, burst)
+        return allowed, wait
+
+    def _sweep(self, now, rate, burst):
+        # Buckets parados tempo suficiente para encher são iguais a um novo
+        refill = burst / rate
+        if now - self._last_sweep < refill:
+            return
+        self._last_sweep = now
+        for client, (_, updated) in list(self._buckets.items()):
+            if now - updated >= refill:
+                del self._buckets[client]
+
+    def acquire(self, route_class, limit):
+        """Identificador da vaga ou None se a classe está no limite"""
+        with self._lock:
+            slots = self._slots[route_class]
+            if len(slots) >= limit:
+                return None
+            lease = uuid.uuid4().hex
+            slots.add(lease)
+            return lease
+
+    def release(self, route_class, lease):
+        with self._lock:
+            self._slots[route_class].discard(lease)
+
+    def in_flight(self):
+        with self._lock:
+            return {route_class: len(slots) for route_class, slots in self._slots.items()}
+
+
+# KEYS[1] bucket; ARGV rate, burst, custo, piso, agora (s), ttl (ms)
+_TAKE_SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local floor = tonumber(ARGV[4])
+local now = tonumber(ARGV[5])
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local wait = 0
+if tokens - cost >= floor then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost + floor - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], ARGV[6])
+return {allowed, tostring(wait)}
+"""
+
+# KEYS[1] vagas (sorted set lease -> instante); ARGV limite, agora, ttl (s), lease
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[2]) - tonumber(ARGV[3]))
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class RedisBackend:
+    """Estado compartilhado entre processos no Redis; falhas caem para a memória"""
+
+    name = 'redis'
+
+    def __init__(self, redis_url, prefix='mlm:admission'):
+        import redis
+        self._errors = (redis.RedisError,)
+        self.client = redis.Redis.from_url(redis_url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.prefix = prefix
+        self.fallback = MemoryBackend()
+        self._take = self.client.register_script(_TAKE_SCRIPT)
+        self._acquire = self.client.register_script(_ACQUIRE_SCRIPT)
+        self._last_warning = 0.0
+
+    def _failed(self, e):
+        ADMISSION_BACKEND_ERRORS.inc()
+        now = time.monotonic()
+        if now - self._last_warning >= 60:
+            self._last_warning = now
+            logger.warning(f"Redis indisponível para controle de admissão ({e}); usando estado local")
+
+    def take(self, client, rate, burst, cost, floor):
+        ttl_ms = max(1000, int(math.ceil(burst / rate * 1000)))
+        try:
+            allowed, wait = self._take(
+                keys=[f"{self.prefix}:bucket:{client}"],
+                args=[rate, burst, cost, floor, time.time(), ttl_ms]
+            )
+            return bool(allowed), float(wait)
+        except self._errors as e:
+            self._failed(e)
+            return self.fallback.take(client, rate, burst, cost, floor)
+
+    def acquire(self, route_class, limit):
+        lease = uuid.uuid4().hex
+        try:
+            acquired = self._acquire(
+                keys=[f"{self.prefix}:slots:{route_class}"],
+                args=[limit, time.time(), LEASE_TTL, lease]
+            )
+            return f"redis:{lease}" if acquired else None
+        except self._errors as e:
+            self._failed(e)
+            return self.fallback.acquire(route_class, limit)
+
+    def release(self, route_class, lease):
+        if not lease.startswith('redis:'):
+            return self.fallback.release(route_class, lease)
+        try:
+            self.client.zrem(f"{self.prefix}:slots:{route_class}", lease[len('redis:'):])
+        except self._errors as e:
+            # A vaga expira sozinha após LEASE_TTL
+            self._failed(e)
+
+    def in_flight(self):
+        try:
+            return {
+                route_class: self.client.zcard(f"{self.prefix}:slots:{route_class}")
+                for route_class in ROUTE_CLASSES
+            }
+        except self._errors as e:
+            self._failed(e)
+            return self.fallback.in_flight()
+
+
+def client_key(client_tokens=None):
+    """Cliente da requisição: X-Client-Id com X-Client-Token válido, ou o IP
+
+    Cabeçalhos enviados pelo próprio cliente não escolhem o bucket: o IP é
+    request.remote_addr, que atrás de proxies confiáveis o ProxyFix
+    (PROXY_FIX_HOPS) substitui pelo IP visto pelo proxy mais externo.
+    """
+    client = request.headers.get('X-Client-Id')
+    token = (client_tokens or {}).get(client) if client else None
+    if token and hmac.compare_digest(request.headers.get('X-Client-Token', ''), token):
+        return f"id:{client}"
+    return f"ip:{request.remote_addr}"
+
+
+class AdmissionController:
+    """Token bucket por cliente e vagas por classe de rota, aplicados nos blueprints"""
+
+    def __init__(self):
+        self.enabled = False
+        self.backend = MemoryBackend()
+        self.rate = 20.0  # tokens por segundo por cliente
+        self.burst = 40.0
+        self.reserve = 10.0  # tokens que só rotas baratas podem gastar
+        self.limits = {CHEAP: None, STANDARD: 8, HEAVY: 2}  # None = sem limite
+        self.retry_after = 1  # segundos sugeridos no 503
+        self.client_tokens = {}  # X-Client-Id -> X-Client-Token
+
+    def configure(self, enabled=None, backend=None, rate=None, burst=None, reserve=None,
+                  standard_limit=None, heavy_limit=None, client_tokens=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if backend is not None:
+            self.backend = backend
+        if rate is not None:
+            self.rate = max(0.001, float(rate))
+        if burst is not None:
+            self.burst = max(float(COSTS[HEAVY]), float(burst))
+        if reserve is not None:
+            self.reserve = max(0.0, float(reserve))
+        # Reserva maior que a rajada bloquearia as rotas padrão/pesadas para sempre
+        self.reserve = min(self.reserve, self.burst - COSTS[HEAVY])
+        if standard_limit is not None:
+            self.limits[STANDARD] = standard_limit or None
+        if heavy_limit is not None:
+            self.limits[HEAVY] = heavy_limit or None
+        if client_tokens is not None:
+            self.client_tokens = dict(client_tokens)
+
+    def route_class(self, endpoint):
+        return ENDPOINT_CLASSES.get(endpoint, STANDARD)
+
+    def admit(self, client, route_class):
+        """(None, lease) se admitido; (resposta de erro, None) caso contrário"""
+        # Vaga antes dos tokens: rejeição por sobrecarga não gasta a cota do cliente
+        limit = self.limits.get(route_class)
+        lease = None
+        if limit is not None:
+            lease = self.backend.acquire(route_class, limit)
+            if lease is None:
+                ADMISSION_DECISIONS.inc(route_class=route_class, result='overloaded')
+                return self._reject(503, 'Serviço sobrecarregado para esta classe de rota', route_class,
+                                    self.retry_after), None
+
+        floor = 0.0 if route_class == CHEAP else self.reserve
+        allowed, wait = self.backend.take(client, self.rate, self.burst, COSTS[route_class], floor)
+        if not allowed:
+            if lease is not None:
+                self.backend.release(route_class, lease)
+            ADMISSION_DECISIONS.inc(route_class=route_class, result='rate_limited')
+            return self._reject(429, 'Limite de requisições do cliente excedido', route_class,
+                                max(1, int(math.ceil(wait)))), None
+
+        ADMISSION_DECISIONS.inc(route_class=route_class, result='admitted')
+        return None, lease
+
+    def _reject(self, status, message, route_class, retry_after):
+        response = jsonify({
+            'status': 'error',
+            'message': message,
+            'route_class': route_class,
+            'retry_after': retry_after
+        })
+        response.status_code = status
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    def install(self, blueprint):
+        """Registra a verificação antes das rotas do blueprint"""
+        blueprint.before_request(self._before_request)
+        blueprint.after_request(self._after_request)
+        blueprint.teardown_request(self._teardown_request)
+
+    def _before_request(self):
+        if not self.enabled or request.endpoint is None:
+            return None
+        route_class = self.route_class(request.endpoint)
+        rejection, lease = self.admit(client_key(self.client_tokens), route_class)
+        if rejection is not None:
+            return rejection
+        g.admission = (route_class, lease)
+        ADMISSION_IN_FLIGHT.inc(route_class=route_class)
+        return None
+
+    def _after_request(self, response):
+        admitted = g.pop('admission', None)
+        if admitted is None:
+            return response
+        route_class, lease = admitted
+        released = []
+
+        def release():
+            # Em respostas em streaming só roda quando o corpo termina de ser enviado
+            if released:
+                return
+            released.append(True)
+            ADMISSION_IN_FLIGHT.dec(route_class=route_class)
+            if lease is not None:
+                self.backend.release(route_class, lease)
+
+        response.call_on_close(release)
+        return response
+
+    def _teardown_request(self, error=None):
+        # Sem after_request (exceção fora dos handlers): libera aqui
+        admitted = g.pop('admission', None)
+        if admitted is None:
+            return
+        route_class, lease = admitted
+        ADMISSION_IN_FLIGHT.dec(route_class=route_class)
+        if lease is not None:
+            self.backend.release(route_class, lease)
+
+    def status(self):
+        return {
+            'enabled': self.enabled,
+            'backend': self.backend.name,
+            'rate': self.rate,
+            'burst': self.burst,
+            'reserve': self.reserve,
+            'costs': COSTS,
+            'limits': self.limits,
+            'in_flight': self.backend.in_flight() if self.enabled else None
+        }
+
+
+admission = AdmissionController()
@@ -0,0 +1,201 @@
+# Estatísticas por afiliado em linha única (mlm_affiliate_stats) e busca por faixas
+#
+# mlm_levels guarda seis linhas por afiliado (N1..N5 e total), então filtros
+# como "N1 >= 10 e total entre 100 e 1000" exigem juntar/pivotar a tabela
+# inteira. A sincronização mantém também uma linha larga por afiliado
+# (N1..N5, total N1-N5, além de N5 e volume), gravada junto com mlm_levels.
+#
+# Cada campo ordenável tem um índice (campo, affiliate_id) com INCLUDE das
+# demais colunas: a busca lê só o índice (index-only scan), filtra as faixas
+# no próprio índice e pagina por keyset (posição do último item), sem OFFSET.
+
+import base64
+import json
+import logging
+from decimal import Decimal
+
+import psycopg2.extras
+
+logger = logging.getLogger(__name__)
+
+# Parâmetro da API -> coluna de mlm_affiliate_stats
+SEARCH_FIELDS = {
+    'n1': 'n1',
+    'n2': 'n2',
+    'n3': 'n3',
+    'n4': 'n4',
+    'n5': 'n5',
+    'total': 'total_n1_to_n5',
+    'beyond_n5': 'beyond_n5',
+    'volume': 'total_volume'
+}
+# Ordenações servidas por índice (campo, affiliate_id) INCLUDE (...)
+SORT_FIELDS = ('total', 'n1', 'beyond_n5', 'volume', 'affiliate_id')
+DEFAULT_SORT = 'total'
+MAX_LIMIT = 500
+
+STATS_COLUMNS = ('n1', 'n2', 'n3', 'n4', 'n5', 'total_n1_to_n5', 'beyond_n5', 'total_volume')
+
+UPSERT_STATS = """
+    INSERT INTO mlm_affiliate_stats (
+        affiliate_id, n1, n2, n3, n4, n5,
+        total_n1_to_n5, beyond_n5, total_volume, updated_at
+    ) VALUES %s
+    ON CONFLICT (affiliate_id) DO UPDATE SET
+        n1 = EXCLUDED.n1,
+        n2 = EXCLUDED.n2,
+        n3 = EXCLUDED.n3,
+        n4 = EXCLUDED.n4,
+        n5 = EXCLUDED.n5,
+        total_n1_to_n5 = EXCLUDED.total_n1_to_n5,
+        beyond_n5 = EXCLUDED.beyond_n5,
+        total_volume = EXCLUDED.total_volume,
+        updated_at = EXCLUDED.updated_at
+"""
+
+# Pivot das linhas de níveis (staging da geração particionada ou mlm_levels)
+PIVOT_LEVELS = """
+    SELECT
+        affiliate_id,
+        COALESCE(MAX(direct_count) FILTER (WHERE level = 1), 0) AS n1,
+        COALESCE(MAX(direct_count) FILTER (WHERE level = 2), 0) AS n2,
+        COALESCE(MAX(direct_count) FILTER (WHERE level = 3), 0) AS n3,
+        COALESCE(MAX(direct_count) FILTER (WHERE level = 4), 0) AS n4,
+        COALESCE(MAX(direct_count) FILTER (WHERE level = 5), 0) AS n5,
+        COALESCE(MAX(direct_count) FILTER (WHERE level = 0), 0) AS total_n1_to_n5,
+        COALESCE(MAX(indirect_count) FILTER (WHERE level = 0), 0) AS beyond_n5,
+        COALESCE(MAX(total_volume) FILTER (WHERE level = 0), 0) AS total_volume
+    FROM {source}
+    {where}
+    GROUP BY affiliate_id
+"""
+
+
+def upsert_affiliate_stats(cursor, values):
+    """Grava linhas (affiliate_id, N1..N5, total, além de N5, volume, updated_at)"""
+    psycopg2.extras.execute_values(cursor, UPSERT_STATS, values, page_size=1000)
+    return len(values)
+
+
+def publish_from_staging(cursor, generation):
+    """Troca mlm_affiliate_stats pela geração particionada (transação da publicação)"""
+    cursor.execute("""
+        DELETE FROM mlm_affiliate_stats s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM mlm_levels_staging l
+            WHERE l.generation = %s AND l.affiliate_id = s.affiliate_id
+        )
+    """, (generation,))
+    deleted = cursor.rowcount
+    pivot = PIVOT_LEVELS.format(source='mlm_levels_staging', where='WHERE generation = %s')
+    cursor.execute(f"""
+        INSERT INTO mlm_affiliate_stats (
+            affiliate_id, n1, n2, n3, n4, n5,
+            total_n1_to_n5, beyond_n5, total_volume, updated_at
+        )
+        SELECT p.*, CURRENT_TIMESTAMP FROM ({pivot}) p
+        ON CONFLICT (affiliate_id) DO UPDATE SET
+            n1 = EXCLUDED.n1,
+            n2 = EXCLUDED.n2,
+            n3 = EXCLUDED.n3,
+            n4 = EXCLUDED.n4,
+            n5 = EXCLUDED.n5,
+            total_n1_to_n5 = EXCLUDED.total_n1_to_n5,
+            beyond_n5 = EXCLUDED.beyond_n5,
+            total_volume = EXCLUDED.total_volume,
+            updated_at = EXCLUDED.updated_at
+        WHERE (mlm_affiliate_stats.n1, mlm_affiliate_stats.n2, mlm_affiliate_stats.n3,
+               mlm_affiliate_stats.n4, mlm_affiliate_stats.n5, mlm_affiliate_stats.total_n1_to_n5,
+               mlm_affiliate_stats.beyond_n5, mlm_affiliate_stats.total_volume)
+            IS DISTINCT FROM
+              (EXCLUDED.n1, EXCLUDED.n2, EXCLUDED.n3, EXCLUDED.n4, EXCLUDED.n5,
+               EXCLUDED.total_n1_to_n5, EXCLUDED.beyond_n5, EXCLUDED.total_volume)
+    """, (generation,))
+    return deleted + cursor.rowcount
+
+
+def parse_value(field, raw):
+    """Valor de um campo de busca (inteiro; volume decimal); ValueError se inválido"""
+    try:
+        value = Decimal(raw) if field == 'volume' else int(raw)
+    except (TypeError, ValueError, ArithmeticError):
+        raise ValueError(f"Valor inválido para {field}: {raw!r}")
+    if isinstance(value, Decimal) and not value.is_finite():
+        raise ValueError(f"Valor inválido para {field}: {raw!r}")
+    return value
+
+
+def encode_cursor(sort, row):
+    """Cursor opaco com a posição do último item (valor da ordenação, affiliate_id)"""
+    value = row['affiliate_id'] if sort == 'affiliate_id' else row[SEARCH_FIELDS[sort]]
+    payload = json.dumps([sort, str(value), row['affiliate_id']])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(sort, cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        cursor_sort, value, affiliate_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor inválido")
+    if cursor_sort != sort:
+        raise ValueError("Cursor pertence a outra ordenação")
+    # Cursor vem do cliente: só chega ao SQL com os tipos da coluna
+    if not isinstance(value, str) or type(affiliate_id) is not int:
+        raise ValueError("Cursor inválido")
+    try:
+        value = parse_value(sort, value)
+    except ValueError:
+        raise ValueError("Cursor inválido")
+    return value, affiliate_id
+
+
+def build_search(filters=None, sort=DEFAULT_SORT, order='desc', after=None, limit=50):
+    """SQL e parâmetros da busca; filters: {campo: (mínimo, máximo)} com None = aberto"""
+    if sort not in SORT_FIELDS:
+        raise ValueError(f"Ordenação inválida: {sort} (disponíveis: {', '.join(SORT_FIELDS)})")
+    if order not in ('asc', 'desc'):
+        raise ValueError("order deve ser asc ou desc")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit deve estar entre 1 e {MAX_LIMIT}")
+
+    conditions = []
+    params = []
+    for field, (minimum, maximum) in (filters or {}).items():
+        if field not in SEARCH_FIELDS:
+            raise ValueError(f"Filtro desconhecido: {field}")
+        column = SEARCH_FIELDS[field]
+        if minimum is not None:
+            conditions.append(f"{column} >= %s")
+            params.append(minimum)
+        if maximum is not None:
+            conditions.append(f"{column} <= %s")
+            params.append(maximum)
+
+    comparison = '<' if order == 'desc' else '>'
+    if sort == 'affiliate_id':
+        order_by = f"affiliate_id {order.upper()}"
+        if after:
+            _, affiliate_id = decode_cursor(sort, after)
+            conditions.append(f"affiliate_id {comparison} %s")
+            params.append(affiliate_id)
+    else:
+        column = SEARCH_FIELDS[sort]
+        # Mesma direção nas duas chaves: varredura do índice (coluna, affiliate_id)
+        order_by = f"{column} {order.upper()}, affiliate_id {order.upper()}"
+        if after:
+            value, affiliate_id = decode_cursor(sort, after)
+            conditions.append(f"({column}, affiliate_id) {comparison} (%s, %s)")
+            params.extend([value, affiliate_id])
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    # Uma linha a mais indica se há próxima página
+    params.append(limit + 1)
+    query = f"""
+        SELECT affiliate_id, {', '.join(STATS_COLUMNS)}
+        FROM mlm_affiliate_stats
+        {where}
+        ORDER BY {order_by}
+        LIMIT %s
+    """
+    return query, params
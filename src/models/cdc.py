@@ -0,0 +1,200 @@
+# Captura de mudanças (CDC) da tabela tracked via LISTEN/NOTIFY
+#
+# Um trigger no banco da operação publica cada INSERT/UPDATE/DELETE de tracked
+# no canal configurado. O listener mantém conexão própria, agrupa as
+# notificações em micro-lotes (por tamanho ou janela de tempo) e entrega cada
+# lote ao serviço de sincronização. Se o canal cair, o listener reconecta com
+# backoff e pede uma sincronização completa (eventos do intervalo se perderam);
+# enquanto isso o serviço volta ao polling.
+
+import json
+import select
+import threading
+import time
+import logging
+
+import psycopg2
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNEL = 'mlm_tracked_changes'
+
+CDC_EVENTS = registry.counter(
+    'mlm_cdc_events_total',
+    'Notificacoes de mudanca em tracked recebidas',
+    ('op',)
+)
+CDC_BATCHES = registry.counter(
+    'mlm_cdc_batches_total',
+    'Micro-lotes de CDC aplicados',
+    ('status',)
+)
+CDC_LISTENING = registry.gauge(
+    'mlm_cdc_listening',
+    'Listener de CDC conectado ao canal (1 = sim)'
+)
+
+
+def tracked_trigger_sql(channel=DEFAULT_CHANNEL):
+    """DDL do trigger de notificação em tracked (idempotente)"""
+    return [
+        f"""
+        CREATE OR REPLACE FUNCTION mlm_tracked_notify() RETURNS trigger AS $$
+        DECLARE
+            rec tracked%ROWTYPE;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                rec := OLD;
+            ELSE
+                rec := NEW;
+            END IF;
+            PERFORM pg_notify('{channel}', json_build_object(
+                'op', TG_OP,
+                'id', rec.id,
+                'affiliate_id', rec.user_afil,
+                'referred_user_id', rec.user_id,
+                'tracked_type_id', rec.tracked_type_id,
+                'created_at', rec.created_at
+            )::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        "DROP TRIGGER IF EXISTS trg_mlm_tracked_notify ON tracked;",
+        """
+        CREATE TRIGGER trg_mlm_tracked_notify
+        AFTER INSERT OR UPDATE OR DELETE ON tracked
+        FOR EACH ROW EXECUTE FUNCTION mlm_tracked_notify();
+        """
+    ]
+
+
+def install_tracked_trigger(connection, channel=DEFAULT_CHANNEL):
+    """Instala o trigger de CDC em tracked (requer permissão de DDL no banco da operação)"""
+    with connection.cursor() as cursor:
+        for statement in tracked_trigger_sql(channel):
+            cursor.execute(statement)
+    logger.info(f"Trigger de CDC instalado em tracked (canal {channel})")
+
+
+def parse_event(payload):
+    """Converte payload JSON do trigger em evento (None se inválido)"""
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logger.warning(f"Payload de CDC inválido: {payload[:200]}")
+        return None
+    if 'op' not in event or 'id' not in event:
+        return None
+    return event
+
+
+class TrackedChangeListener:
+    """Escuta o canal de CDC e entrega micro-lotes de eventos"""
+
+    def __init__(self, dsn, on_batch, on_resync=None, channel=DEFAULT_CHANNEL,
+                 batch_size=500, batch_window=0.25, reconnect_delay=5.0):
+        self.dsn = dsn
+        self.on_batch = on_batch
+        self.on_resync = on_resync
+        self.channel = channel
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.reconnect_delay = reconnect_delay
+
+        self.is_listening = False
+        self.last_event_at = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._connection = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='cdc-listener', daemon=True)
+        self._thread.start()
+        logger.info(f"Listener de CDC iniciado (canal {self.channel}, lote {self.batch_size}, janela {self.batch_window}s)")
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _connect(self):
+        connection = psycopg2.connect(self.dsn, application_name='mlm-cdc-listener')
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+        return connection
+
+    def _set_listening(self, listening):
+        self.is_listening = listening
+        CDC_LISTENING.set(1 if listening else 0)
+
+    def _run(self):
+        delay = self.reconnect_delay
+        first_connect = True
+        while not self._stop_event.is_set():
+            try:
+                self._connection = self._connect()
+                self._set_listening(True)
+                delay = self.reconnect_delay
+                if not first_connect and self.on_resync:
+                    # Eventos emitidos enquanto desconectado foram perdidos
+                    self.on_resync('reconnect')
+                first_connect = False
+                self._listen_loop()
+            except Exception as e:
+                logger.error(f"Erro no listener de CDC: {e}")
+            finally:
+                self._set_listening(False)
+                if self._connection is not None:
+                    try:
+                        self._connection.close()
+                    except Exception:
+                        pass
+                    self._connection = None
+
+            if self.on_resync and not self._stop_event.is_set():
+                self.on_resync('disconnect')
+            self._stop_event.wait(delay)
+            delay = min(delay * 2, 300)
+
+    def _listen_loop(self):
+        pending = []
+        first_at = None
+        while not self._stop_event.is_set():
+            if pending:
+                timeout = max(self.batch_window - (time.monotonic() - first_at), 0)
+            else:
+                timeout = 1.0
+
+            readable, _, _ = select.select([self._connection], [], [], timeout)
+            if readable:
+                self._connection.poll()
+                while self._connection.notifies:
+                    notify = self._connection.notifies.pop(0)
+                    event = parse_event(notify.payload)
+                    if event is None:
+                        continue
+                    CDC_EVENTS.inc(op=event['op'].lower())
+                    if not pending:
+                        first_at = time.monotonic()
+                    pending.append(event)
+
+            if pending and (len(pending) >= self.batch_size or time.monotonic() - first_at >= self.batch_window):
+                self._deliver(pending)
+                pending = []
+                first_at = None
+
+    def _deliver(self, events):
+        self.last_event_at = time.time()
+        try:
+            self.on_batch(events)
+            CDC_BATCHES.inc(status='applied')
+        except Exception as e:
+            CDC_BATCHES.inc(status='failed')
+            logger.error(f"Erro ao aplicar micro-lote de CDC ({len(events)} eventos): {e}")
+            if self.on_resync:
+                self.on_resync('apply_failed')
@@ -0,0 +1,252 @@
+# Exportação em massa de mlm_hierarchy e mlm_levels (CSV ou NDJSON, em streaming)
+#
+# Cada exportação usa uma conexão própria em transação REPEATABLE READ READ
+# ONLY: o arquivo inteiro sai de um único snapshot, e a geração publicada é
+# lida no mesmo snapshot. CSV vem de COPY ... TO STDOUT (o servidor formata;
+# uma thread escreve os blocos numa fila limitada que a resposta consome) e
+# NDJSON de um cursor no servidor lido em lotes. Nos dois casos a memória do
+# processo é constante, independente do tamanho das tabelas.
+#
+# Fixar geração: as sincronizações gravam mlm_hierarchy/mlm_levels fora de
+# uma transação única, então um snapshot tirado com uma geração em gravação
+# (ou que falhou no meio) pode misturar duas gerações. Com geração fixada, a
+# exportação só começa se o snapshot contém exatamente a geração pedida, já
+# publicada e sem gravação posterior incompleta (a sincronização particionada
+# publica numa transação só e não conta).
+
+import json
+import queue
+import threading
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+import logging
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from src.models.metrics import registry
+from src.models.query_log import instrumented_connect
+
+logger = logging.getLogger(__name__)
+
+EXPORT_ROWS = registry.counter(
+    'mlm_export_rows_total',
+    'Linhas exportadas por conjunto',
+    ('dataset',)
+)
+EXPORT_BYTES = registry.counter(
+    'mlm_export_bytes_total',
+    'Bytes enviados pelas exportações por conjunto e formato (após compressão)',
+    ('dataset', 'format')
+)
+EXPORTS_IN_FLIGHT = registry.gauge(
+    'mlm_exports_in_flight',
+    'Exportações em andamento'
+)
+
+# Conjunto -> colunas e ordenação (chaves únicas, servidas pelo índice)
+DATASETS = {
+    'hierarchy': {
+        'table': 'mlm_hierarchy',
+        'columns': (
+            'affiliate_id', 'parent_id', 'level', 'path', 'total_downline',
+            'direct_referrals', 'status', 'created_at', 'updated_at'
+        ),
+        'order_by': 'affiliate_id'
+    },
+    'levels': {
+        'table': 'mlm_levels',
+        'columns': (
+            'affiliate_id', 'level', 'direct_count', 'indirect_count', 'total_volume',
+            'commission_rate', 'commission_earned', 'new_1d', 'new_7d', 'new_30d', 'last_calculated'
+        ),
+        'order_by': 'affiliate_id, level'
+    }
+}
+FORMATS = ('csv', 'ndjson')
+
+COPY_CHUNK_QUEUE = 64  # blocos do COPY em espera (limita a memória por exportação)
+FETCH_SIZE = 5000  # linhas por ida ao servidor no NDJSON
+FLUSH_BYTES = 64 * 1024  # agrupa linhas NDJSON antes de enviar
+
+
+class ExportConflict(Exception):
+    """Geração pedida não está (ou não está só ela) no snapshot da exportação"""
+
+    def __init__(self, message, generation=None, retry=False):
+        super().__init__(message)
+        self.generation = generation
+        self.retry = retry  # True: geração em gravação, tentar de novo depois
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Tipo não serializável: {type(value).__name__}")
+
+
+def _select(dataset):
+    spec = DATASETS[dataset]
+    return f"SELECT {', '.join(spec['columns'])} FROM {spec['table']} ORDER BY {spec['order_by']}"
+
+
+class Export:
+    """Exportação aberta: snapshot fixado e geração conhecida antes do primeiro byte"""
+
+    def __init__(self, db_url, dataset, fmt='csv', generation=None, compress=False):
+        if dataset not in DATASETS:
+            raise ValueError(f"Conjunto desconhecido: {dataset} (disponíveis: {', '.join(sorted(DATASETS))})")
+        if fmt not in FORMATS:
+            raise ValueError(f"Formato desconhecido: {fmt} (disponíveis: {', '.join(FORMATS)})")
+        self.dataset = dataset
+        self.format = fmt
+        self.compress = compress
+        self.generation = None
+        self.dirty = False  # gravação incompleta após a geração publicada (só sem geração fixada)
+        self.conn = instrumented_connect(db_url, 'mlm_export')
+        try:
+            self.conn.set_session(
+                isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True
+            )
+            self._pin(generation)
+        except Exception:
+            self.conn.close()
+            raise
+
+    def _pin(self, requested):
+        """Lê a geração publicada no snapshot e valida a geração pedida"""
+        with self.conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT
+                    (SELECT MAX(generation) FROM mlm_generations WHERE status = 'published'),
+                    EXISTS (
+                        SELECT 1 FROM mlm_generations
+                        WHERE status IN ('running', 'failed') AND shard_count IS NULL
+                            AND generation > COALESCE(
+                                (SELECT MAX(generation) FROM mlm_generations WHERE status = 'published'), 0
+                            )
+                    )
+            """)
+            self.generation, self.dirty = cursor.fetchone()
+        if requested is None:
+            return
+        if self.generation != requested:
+            raise ExportConflict(
+                f"Geração {requested} não é a publicada (atual: {self.generation})",
+                generation=self.generation
+            )
+        if self.dirty:
+            raise ExportConflict(
+                f"Gravação posterior à geração {self.generation} em andamento ou incompleta; tente novamente",
+                generation=self.generation,
+                retry=True
+            )
+
+    def stream(self):
+        """Gera os bytes da exportação e fecha a conexão ao terminar (ou se o cliente sair)"""
+        source = self._csv_chunks() if self.format == 'csv' else self._ndjson_chunks()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.compress else None  # 31 = gzip
+        EXPORTS_IN_FLIGHT.inc()
+        try:
+            for chunk in source:
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                    if not chunk:
+                        continue
+                EXPORT_BYTES.inc(len(chunk), dataset=self.dataset, format=self.format)
+                yield chunk
+            if compressor:
+                tail = compressor.flush()
+                EXPORT_BYTES.inc(len(tail), dataset=self.dataset, format=self.format)
+                yield tail
+        finally:
+            source.close()
+            EXPORTS_IN_FLIGHT.dec()
+            self.close()
+
+    def close(self):
+        """Fecha a conexão (e o snapshot); chamado também quando o corpo nunca é lido (HEAD)"""
+        if not self.conn.closed:
+            self.conn.close()
+
+    def _csv_chunks(self):
+        chunks = queue.Queue(maxsize=COPY_CHUNK_QUEUE)
+        cancelled = threading.Event()
+        done = object()
+        failure = []
+
+        class QueueWriter:
+            # copy_expert chama write() com cada bloco recebido do servidor
+            def write(self, data):
+                while not cancelled.is_set():
+                    try:
+                        chunks.put(data if isinstance(data, bytes) else data.encode(), timeout=1)
+                        return
+                    except queue.Full:
+                        continue
+                raise RuntimeError("Exportação cancelada pelo cliente")
+
+        def copy():
+            try:
+                with self.conn.cursor() as cursor:
+                    cursor.copy_expert(
+                        f"COPY ({_select(self.dataset)}) TO STDOUT WITH (FORMAT csv, HEADER)",
+                        QueueWriter()
+                    )
+                    EXPORT_ROWS.inc(max(cursor.rowcount, 0), dataset=self.dataset)
+            except Exception as e:
+                if not cancelled.is_set():
+                    failure.append(e)
+            finally:
+                while True:
+                    try:
+                        chunks.put(done, timeout=1)
+                        break
+                    except queue.Full:
+                        if cancelled.is_set():
+                            break
+
+        thread = threading.Thread(target=copy, name=f'export-{self.dataset}', daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            if thread.is_alive():
+                # Cliente saiu no meio: interrompe o COPY no servidor e esvazia a fila
+                cancelled.set()
+                self.conn.cancel()
+                while thread.is_alive():
+                    try:
+                        chunks.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+        if failure:
+            logger.error(f"Erro na exportação CSV de {self.dataset}: {failure[0]}")
+            raise failure[0]
+
+    def _ndjson_chunks(self):
+        buffer = []
+        size = 0
+        rows = 0
+        with self.conn.cursor(name=f'mlm_export_{self.dataset}', cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.itersize = FETCH_SIZE
+            cursor.execute(_select(self.dataset))
+            for row in cursor:
+                line = json.dumps(row, default=_json_default, separators=(',', ':')) + '\n'
+                buffer.append(line)
+                size += len(line)
+                rows += 1
+                if size >= FLUSH_BYTES:
+                    yield ''.join(buffer).encode()
+                    buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer).encode()
+        EXPORT_ROWS.inc(rows, dataset=self.dataset)
@@ -0,0 +1,179 @@
+# Amostrador de saúde em background
+#
+# Verifica as dependências em intervalo próprio, com timeout, usando conexões
+# curtas e dedicadas. Os endpoints de health servem apenas o resultado em cache,
+# sem tocar nas conexões usadas pela API ou pela sincronização.
+
+import psycopg2
+import threading
+import time
+from datetime import datetime
+import logging
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_UP = registry.gauge(
+    'mlm_health_check_up',
+    'Resultado da ultima verificacao de dependencia (1 = ok)',
+    ('check',)
+)
+HEALTH_CHECK_LATENCY = registry.gauge(
+    'mlm_health_check_latency_seconds',
+    'Latencia da ultima verificacao de dependencia',
+    ('check',)
+)
+
+
+def postgres_check(db_url):
+    """Cria verificação que abre conexão dedicada e executa SELECT 1"""
+    def check(timeout):
+        conn = psycopg2.connect(
+            db_url,
+            connect_timeout=max(int(timeout), 1),
+            options=f"-c statement_timeout={int(timeout * 1000)}"
+        )
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+        finally:
+            conn.close()
+    return check
+
+
+def sync_lag_info(sync_service):
+    """Atraso da sincronização (agora - last_sync) e duração da última execução"""
+    if not sync_service:
+        return {
+            'sync_service_running': False,
+            'last_sync': None,
+            'sync_lag_seconds': None,
+            'last_sync_duration_seconds': None,
+            'sync_interval': None
+        }
+
+    last_sync = sync_service.last_sync
+    return {
+        'sync_service_running': sync_service.is_running,
+        'last_sync': last_sync.isoformat() if last_sync else None,
+        'sync_lag_seconds': round((datetime.now() - last_sync).total_seconds(), 3) if last_sync else None,
+        'last_sync_duration_seconds': getattr(sync_service, 'last_sync_duration', None),
+        'sync_interval': sync_service.sync_interval
+    }
+
+
+class HealthSampler:
+    """Executa verificações periódicas e mantém o último resultado em cache"""
+
+    def __init__(self, checks, interval=15, timeout=5):
+        self.checks = dict(checks)
+        self.interval = interval
+        self.timeout = timeout
+        self._results = {}
+        self._sampled_at = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Inicia thread de amostragem (primeira amostra imediata)"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='health-sampler', daemon=True)
+        self._thread.start()
+        logger.info(f"Amostrador de saúde iniciado (intervalo {self.interval}s, timeout {self.timeout}s)")
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sample_once()
+            except Exception as e:
+                logger.error(f"Erro no amostrador de saúde: {e}")
+            self._stop_event.wait(self.interval)
+
+    def _run_check(self, name, check):
+        """Executa uma verificação em thread própria para garantir o timeout"""
+        outcome = {}
+
+        def target():
+            try:
+                check(self.timeout)
+                outcome['ok'] = True
+            except Exception as e:
+                outcome['ok'] = False
+                outcome['error'] = str(e).strip()
+
+        start = time.perf_counter()
+        worker = threading.Thread(target=target, name=f'health-check-{name}', daemon=True)
+        worker.start()
+        worker.join(self.timeout)
+        latency = time.perf_counter() - start
+
+        if worker.is_alive():
+            outcome = {'ok': False, 'error': f'timeout após {self.timeout}s'}
+
+        result = {
+            'ok': outcome.get('ok', False),
+            'latency_ms': round(latency * 1000.0, 3),
+            'error': outcome.get('error'),
+            'checked_at': datetime.now().isoformat()
+        }
+        HEALTH_CHECK_UP.set(1 if result['ok'] else 0, check=name)
+        HEALTH_CHECK_LATENCY.set(latency, check=name)
+        return result
+
+    def sample_once(self):
+        """Executa todas as verificações (em paralelo) e atualiza o cache"""
+        results = {}
+        threads = []
+
+        def run(name, check):
+            results[name] = self._run_check(name, check)
+
+        for name, check in self.checks.items():
+            thread = threading.Thread(target=run, args=(name, check), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        with self._lock:
+            self._results = results
+            self._sampled_at = datetime.now()
+
+        failed = [name for name, result in results.items() if not result['ok']]
+        if failed:
+            logger.warning(f"Verificações de saúde com falha: {', '.join(failed)}")
+        return results
+
+    def snapshot(self):
+        """Último resultado em cache (não executa verificações)"""
+        with self._lock:
+            results = dict(self._results)
+            sampled_at = self._sampled_at
+
+        age = (datetime.now() - sampled_at).total_seconds() if sampled_at else None
+        return {
+            'checks': results,
+            'sampled_at': sampled_at.isoformat() if sampled_at else None,
+            'sample_age_seconds': round(age, 3) if age is not None else None,
+            # Amostrador travado ou parado: resultado não deve ser confiado
+            'stale': age is None or age > self.interval * 3 + self.timeout,
+            'interval_seconds': self.interval
+        }
+
+    def is_ok(self, name):
+        """True se a última amostra da verificação foi bem-sucedida e não está velha"""
+        with self._lock:
+            result = self._results.get(name)
+            sampled_at = self._sampled_at
+        if not result or not sampled_at:
+            return False
+        age = (datetime.now() - sampled_at).total_seconds()
+        return result['ok'] and age <= self.interval * 3 + self.timeout
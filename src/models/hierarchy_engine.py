@@ -0,0 +1,355 @@
+# Motor incremental da hierarquia MLM
+#
+# Mantém em memória as listas de indicações, os referidores de cada usuário e as
+# contagens N1-N5 calculadas na última sincronização. Uma aresta (referidor ->
+# indicado) inserida, removida ou movida altera apenas:
+#   - N1..N5 e total dos até 5 ancestros do referidor (perfil da subárvore movida
+#     deslocado pela distância);
+#   - beyond_n5 dos ancestros acima disso (N6+ não tem limite de profundidade);
+#   - métricas por nível (volume e indicações novas em 1/7/30 dias) dos mesmos
+#     5 ancestros, somando o valor próprio da indicação (volume do indicado;
+#     janela da aresta referidor -> indicado) e o da sua subárvore;
+#   - nível e path das linhas de hierarquia da subárvore movida.
+# As contagens seguem exatamente calculate_individual_n1_to_n5_stats.
+
+from collections import defaultdict
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_LEVEL = 5
+TOTAL = 5   # índice do total N1-N5 em counts
+BEYOND = 6  # índice de N6+ em counts
+
+# Janelas de crescimento (indicações novas por nível), ancoradas na sincronização
+GROWTH_WINDOWS = (('new_1d', 1), ('new_7d', 7), ('new_30d', 30))
+WINDOW_METRICS = tuple(name for name, _ in GROWTH_WINDOWS)
+
+# Métricas somadas por nível: nome -> chave em individual_stats
+LEVEL_METRICS = {
+    'volume': 'level_volumes',
+    **{name: f'level_{name}' for name, _ in GROWTH_WINDOWS}
+}
+
+
+class EdgeConflict(Exception):
+    """Operação inválida para o estado atual (ciclo, aresta inexistente, etc.)"""
+
+
+class ChangeSet:
+    """Linhas a persistir após um lote de operações"""
+
+    def __init__(self):
+        self.hierarchy_upserts = {}
+        self.hierarchy_deletes = []
+        self.level_upserts = {}
+        self.level_deletes = []
+
+    def __len__(self):
+        return (len(self.hierarchy_upserts) + len(self.hierarchy_deletes)
+                + len(self.level_upserts) + len(self.level_deletes))
+
+
+class HierarchyEngine:
+    """Aplica inserção, remoção e re-parent de arestas ajustando só os afetados"""
+
+    def __init__(self, global_hierarchy, individual_stats, node_values=None, window_cutoffs=None,
+                 edge_values=None):
+        self.children = {}
+        self.parents = defaultdict(list)
+        self.primary_parent = {}
+        self.info = {}  # afiliado -> [parent_id, nível global, path]
+        self.counts = {}  # afiliado -> [N1..N5, total, além de N5]
+        # métrica -> afiliado -> [valor N1..N5]; métrica -> usuário -> valor próprio;
+        # janela -> (referidor, indicado) -> 1 se a indicação caiu na janela
+        self.level_values = {name: {} for name in LEVEL_METRICS}
+        self.node_values = {
+            name: dict((node_values or {}).get(name) or {})
+            for name in LEVEL_METRICS if name not in WINDOW_METRICS
+        }
+        self.edge_values = {name: dict((edge_values or {}).get(name) or {}) for name in WINDOW_METRICS}
+        self.window_cutoffs = window_cutoffs or {}
+
+        for affiliate_id, data in global_hierarchy.items():
+            children = list(data.get('children', []))
+            self.children[affiliate_id] = children
+            for child_id in children:
+                self.parents[child_id].append(affiliate_id)
+            self.info[affiliate_id] = [data.get('parent_id'), data.get('global_level'), data.get('path')]
+            if data.get('parent_id') is not None:
+                self.primary_parent[affiliate_id] = data['parent_id']
+
+        for affiliate_id, stats in individual_stats.items():
+            self.counts[affiliate_id] = [
+                *(stats['level_counts'].get(level, 0) for level in range(1, MAX_LEVEL + 1)),
+                stats['total_n1_to_n5'],
+                stats['beyond_n5']
+            ]
+            for name, key in LEVEL_METRICS.items():
+                per_level = stats.get(key, {})
+                self.level_values[name][affiliate_id] = [per_level.get(level, 0) for level in range(1, MAX_LEVEL + 1)]
+
+        self._dirty_hierarchy = set()
+        self._dirty_levels = set()
+
+    def __len__(self):
+        return len(self.info)
+
+    # Consultas
+
+    def is_affiliate(self, node_id):
+        return node_id in self.info
+
+    def parent_of(self, node_id):
+        parent_id = self.primary_parent.get(node_id)
+        if parent_id is None and self.parents.get(node_id):
+            parent_id = self.parents[node_id][0]
+        return parent_id
+
+    def _is_ancestor(self, candidate, node_id):
+        """True se candidate alcança node_id descendo pelas indicações"""
+        stack = [node_id]
+        seen = {node_id}
+        while stack:
+            current = stack.pop()
+            for parent_id in self.parents.get(current, ()):
+                if parent_id == candidate:
+                    return True
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    stack.append(parent_id)
+        return False
+
+    def hierarchy_row(self, affiliate_id):
+        parent_id, global_level, path = self.info[affiliate_id]
+        direct = len(self.children.get(affiliate_id, ()))
+        return (parent_id, global_level, path, direct, direct)
+
+    def level_row(self, affiliate_id):
+        """Contagens seguidas das métricas por nível, na ordem de LEVEL_METRICS"""
+        row = list(self.counts[affiliate_id])
+        for name in LEVEL_METRICS:
+            row.extend(self.level_values[name][affiliate_id])
+        return tuple(row)
+
+    # Propagação
+
+    def _own_value(self, name, parent_id, child_id):
+        """Valor que a indicação parent_id -> child_id soma no nível do indicado"""
+        if name in self.edge_values:
+            return self.edge_values[name].get((parent_id, child_id), 0)
+        return self.node_values[name].get(child_id, 0)
+
+    def _profile(self, node_id):
+        """Tamanho da subárvore por profundidade relativa: [S0..S5] e restante (S6+)"""
+        counts = self.counts.get(node_id)
+        if counts is None:
+            return [1, 0, 0, 0, 0, 0], 0
+        return [1, *counts[:MAX_LEVEL]], counts[BEYOND]
+
+    def _propagate(self, parent_id, child_id, sign):
+        """Soma (sign=1) ou subtrai (sign=-1) a subárvore de child_id nos ancestros"""
+        profile, rest = self._profile(child_id)
+        subtree_size = sum(profile) + rest
+        metric_profiles = [
+            (self.level_values[name], [self._own_value(name, parent_id, child_id),
+                                       *self.level_values[name].get(child_id, [0] * MAX_LEVEL)])
+            for name in LEVEL_METRICS
+        ]
+
+        layer = {parent_id: 1}
+        distance = 0
+        while layer:
+            for node_id, paths in layer.items():
+                counts = self.counts.get(node_id)
+                if counts is None:
+                    continue  # fora da hierarquia calculada (não alcançado na sincronização)
+                if distance < MAX_LEVEL:
+                    for depth, size in enumerate(profile):
+                        level = distance + 1 + depth
+                        delta = sign * paths * size
+                        if level <= MAX_LEVEL:
+                            counts[level - 1] += delta
+                            counts[TOTAL] += delta
+                        else:
+                            counts[BEYOND] += delta
+                    counts[BEYOND] += sign * paths * rest
+                    for level_values, metric_profile in metric_profiles:
+                        values = level_values[node_id]
+                        for depth, value in enumerate(metric_profile[:MAX_LEVEL - distance]):
+                            values[distance + depth] += sign * paths * value
+                else:
+                    counts[BEYOND] += sign * paths * subtree_size
+                self._dirty_levels.add(node_id)
+
+            # Usuários com mais de um referidor contam sob cada um (como no cálculo completo)
+            next_layer = defaultdict(int)
+            for node_id, paths in layer.items():
+                for ancestor_id in self.parents.get(node_id, ()):
+                    next_layer[ancestor_id] += paths
+            layer = next_layer
+            distance += 1
+
+    def _refresh_subtree(self, root_id):
+        """Recalcula parent_id, nível e path das linhas a partir de root_id"""
+        stack = [root_id]
+        while stack:
+            node_id = stack.pop()
+            if node_id not in self.info:
+                continue
+            parent_id = self.parent_of(node_id)
+            parent_info = self.info.get(parent_id) if parent_id is not None else None
+            if parent_info:
+                row = [parent_id, parent_info[1] + 1, f"{parent_info[2]}.{node_id}"]
+            else:
+                row = [parent_id, 1, str(node_id)]
+            if self.info[node_id] != row:
+                self.info[node_id] = row
+                self._dirty_hierarchy.add(node_id)
+                stack.extend(
+                    child_id for child_id in set(self.children.get(node_id, ()))
+                    if self.parent_of(child_id) == node_id
+                )
+
+    # Operações
+
+    def _joined_values(self, created_at):
+        """Indicadores de janela (1 ou None) para uma indicação feita em created_at"""
+        values = {}
+        for name, _ in GROWTH_WINDOWS:
+            cutoff = self.window_cutoffs.get(name)
+            values[name] = 1 if cutoff is not None and created_at >= cutoff else None
+        return values
+
+    def _set_edge_values(self, parent_id, child_id, values):
+        for name, value in values.items():
+            if value:
+                self.edge_values[name][(parent_id, child_id)] = value
+            else:
+                self.edge_values[name].pop((parent_id, child_id), None)
+
+    def insert_edge(self, parent_id, child_id, allow_multiple=False, created_at=None, windows=None):
+        """Insere indicação; janelas da aresta por created_at ou, ao mover/restaurar, por windows"""
+        if parent_id == child_id:
+            raise EdgeConflict(f"Auto-indicação não permitida ({child_id})")
+        if self.parents.get(child_id) and not allow_multiple:
+            raise EdgeConflict(f"Usuário {child_id} já possui referidor; use reparent")
+        if self._is_ancestor(child_id, parent_id):
+            raise EdgeConflict(f"Aresta {parent_id} -> {child_id} criaria ciclo")
+
+        if parent_id not in self.info:
+            # Primeira indicação: usuário passa a ser afiliado
+            self.children[parent_id] = []
+            self.counts[parent_id] = [0] * 7
+            for level_values in self.level_values.values():
+                level_values[parent_id] = [0] * MAX_LEVEL
+            self.info[parent_id] = [None, None, None]
+            self._dirty_hierarchy.add(parent_id)
+            self._refresh_subtree(parent_id)
+
+        if created_at is not None:
+            windows = self._joined_values(created_at)
+        if windows is not None:
+            self._set_edge_values(parent_id, child_id, windows)
+        self.children[parent_id].append(child_id)
+        self.parents[child_id].append(parent_id)
+        self.primary_parent[child_id] = parent_id
+        self._dirty_hierarchy.add(parent_id)
+        self._propagate(parent_id, child_id, 1)
+        self._refresh_subtree(child_id)
+
+    def remove_edge(self, parent_id, child_id):
+        """Remove indicação; devolve as janelas da aresta removida"""
+        children = self.children.get(parent_id)
+        if not children or child_id not in children:
+            raise EdgeConflict(f"Aresta {parent_id} -> {child_id} não existe")
+
+        self._propagate(parent_id, child_id, -1)
+        windows = {name: self.edge_values[name].get((parent_id, child_id)) for name in WINDOW_METRICS}
+        children.remove(child_id)
+        if child_id not in children:
+            self._set_edge_values(parent_id, child_id, dict.fromkeys(WINDOW_METRICS))
+        self.parents[child_id].remove(parent_id)
+        if not self.parents[child_id]:
+            del self.parents[child_id]
+        if self.primary_parent.get(child_id) == parent_id:
+            del self.primary_parent[child_id]
+        self._dirty_hierarchy.add(parent_id)
+
+        if not children:
+            # Sem indicações: deixa de ser afiliado (linhas removidas)
+            del self.children[parent_id]
+            del self.info[parent_id]
+            del self.counts[parent_id]
+            for level_values in self.level_values.values():
+                del level_values[parent_id]
+            self._dirty_levels.add(parent_id)
+        self._refresh_subtree(child_id)
+        return windows
+
+    def reparent(self, child_id, new_parent_id):
+        old_parent_id = self.parent_of(child_id)
+        if old_parent_id is None:
+            raise EdgeConflict(f"Usuário {child_id} não possui referidor; use insert")
+        if old_parent_id == new_parent_id:
+            return
+        if new_parent_id == child_id or self._is_ancestor(child_id, new_parent_id):
+            raise EdgeConflict(f"Mover {child_id} para {new_parent_id} criaria ciclo")
+        # A indicação muda de referidor mantendo a data (janelas)
+        windows = self.remove_edge(old_parent_id, child_id)
+        self.insert_edge(new_parent_id, child_id, windows=windows)
+        return old_parent_id
+
+    def apply(self, operations):
+        """Aplica operações em ordem; em conflito desfaz o lote inteiro"""
+        applied = []
+        try:
+            for index, operation in enumerate(operations):
+                op = operation['op']
+                if op == 'insert':
+                    self.insert_edge(operation['parent_id'], operation['child_id'],
+                                     operation.get('allow_multiple', False),
+                                     operation.get('created_at'))
+                    applied.append(('remove', operation['parent_id'], operation['child_id'], None))
+                elif op == 'remove':
+                    windows = self.remove_edge(operation['parent_id'], operation['child_id'])
+                    applied.append(('insert', operation['parent_id'], operation['child_id'], windows))
+                elif op == 'reparent':
+                    old_parent_id = self.reparent(operation['child_id'], operation['parent_id'])
+                    if old_parent_id is not None:
+                        applied.append(('reparent', old_parent_id, operation['child_id'], None))
+                else:
+                    raise EdgeConflict(f"Operação desconhecida: {op}")
+        except EdgeConflict as e:
+            self._undo(applied)
+            e.index = index
+            raise
+
+        return self._collect_changes()
+
+    def _undo(self, applied):
+        for op, parent_id, child_id, windows in reversed(applied):
+            if op == 'remove':
+                self.remove_edge(parent_id, child_id)
+            elif op == 'insert':
+                self.insert_edge(parent_id, child_id, allow_multiple=True, windows=windows)
+            else:
+                self.reparent(child_id, parent_id)
+        self._dirty_hierarchy.clear()
+        self._dirty_levels.clear()
+
+    def _collect_changes(self):
+        changes = ChangeSet()
+        for affiliate_id in self._dirty_hierarchy:
+            if affiliate_id in self.info:
+                changes.hierarchy_upserts[affiliate_id] = self.hierarchy_row(affiliate_id)
+            else:
+                changes.hierarchy_deletes.append(affiliate_id)
+        for affiliate_id in self._dirty_levels:
+            if affiliate_id in self.counts:
+                changes.level_upserts[affiliate_id] = self.level_row(affiliate_id)
+            else:
+                changes.level_deletes.append(affiliate_id)
+        self._dirty_hierarchy.clear()
+        self._dirty_levels.clear()
+        return changes
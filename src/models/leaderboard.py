@@ -0,0 +1,208 @@
+# Ranking pré-calculado dos maiores afiliados por tamanho de rede
+#
+# A sincronização mantém em mlm_leaderboard os size primeiros afiliados por
+# total N1-N5 (level 0, como em mlm_levels) e por nível N1..N5, já com a
+# posição gravada. A seleção é feita com heap (heapq.nlargest) sobre as linhas
+# de níveis já agregadas: O(n log size), sem ordenar todos os afiliados. A
+# página do ranking é uma faixa da chave primária (level, rank), com custo
+# constante em qualquer página.
+#
+# Empates: maior valor primeiro e, no mesmo valor, menor affiliate_id.
+# Afiliados com contagem zero no nível não entram no ranking.
+#
+# Atualização incremental (arestas/CDC): os afiliados alterados são
+# atualizados no próprio quadro (entram, sobem, descem ou saem), sem varrer os
+# demais. Cada quadro cheio guarda um teto para quem ficou de fora (maior
+# posição possível de um não membro); a seleção completa só é refeita quando
+# um membro sai ou cai até esse teto, porque aí o substituto é desconhecido.
+
+import heapq
+import logging
+
+import psycopg2.extras
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_REBUILDS = registry.counter(
+    'mlm_leaderboard_rebuilds_total',
+    'Quadros do ranking recalculados por origem (in_place = atualizado sem nova seleção)',
+    ('source',)
+)
+
+LEADERBOARD_LEVELS = (0, 1, 2, 3, 4, 5)  # 0 = total N1-N5
+DEFAULT_SIZE = 1000
+TOTAL_INDEX = 5  # posição do total N1-N5 na linha de níveis (N1..N5 vêm antes)
+
+
+def level_value(row, level):
+    """Contagem do nível na linha de níveis (level 0 = total N1-N5)"""
+    return row[TOTAL_INDEX] if level == 0 else row[level - 1]
+
+
+def _order(entry):
+    affiliate_id, value = entry
+    return (value, -affiliate_id)
+
+
+def top_k(rows, level, size):
+    """[(affiliate_id, valor)] dos size maiores no nível, em ordem de posição"""
+    candidates = (
+        (affiliate_id, level_value(row, level))
+        for affiliate_id, row in rows.items()
+    )
+    return heapq.nlargest(size, (entry for entry in candidates if entry[1] > 0), key=_order)
+
+
+def _select(rows, level, size):
+    """Quadro e teto dos não membros (ordem do primeiro de fora; None = ninguém de fora)"""
+    board = top_k(rows, level, size + 1)
+    ceiling = _order(board.pop()) if len(board) > size else None
+    return board, ceiling
+
+
+class Leaderboard:
+    """Quadros do ranking em memória, gravados em mlm_leaderboard"""
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = max(1, int(size))
+        self.boards = {}  # level -> [(affiliate_id, valor)] em ordem de posição
+        self._members = {}  # level -> {affiliate_id: valor} dos membros do quadro
+        # level -> ordem máxima possível de um não membro (None = todos com valor estão no quadro)
+        self._ceilings = {}
+
+    def rebuild(self, rows, levels=LEADERBOARD_LEVELS):
+        """Recalcula os quadros a partir das linhas de níveis (affiliate_id -> linha)"""
+        for level in levels:
+            board, ceiling = _select(rows, level, self.size)
+            self.boards[level] = board
+            self._members[level] = dict(board)
+            self._ceilings[level] = ceiling
+        return list(levels)
+
+    def clear(self):
+        self.boards = {}
+        self._members = {}
+        self._ceilings = {}
+
+    def update(self, rows, upserts, deletes):
+        """Aplica linhas alteradas e removidas nos quadros; rows já inclui as alterações
+
+        Devolve (quadros alterados, quadros que exigiram nova seleção completa).
+        """
+        changed = []
+        reselected = []
+        for level in LEADERBOARD_LEVELS:
+            if level not in self.boards:
+                self.rebuild(rows, [level])
+                changed.append(level)
+                reselected.append(level)
+                continue
+            result = self._update_level(level, upserts, deletes)
+            if result is None:
+                self.rebuild(rows, [level])
+                reselected.append(level)
+            if result is not False:
+                changed.append(level)
+        return changed, reselected
+
+    def _update_level(self, level, upserts, deletes):
+        """True se o quadro mudou, False se não, None se precisa de nova seleção"""
+        members = self._members[level]
+        ceiling = self._ceilings[level]
+        modified = False
+
+        for affiliate_id in deletes:
+            if affiliate_id in members:
+                if ceiling is not None:
+                    return None  # vaga aberta com candidatos de fora desconhecidos
+                del members[affiliate_id]
+                modified = True
+
+        for affiliate_id, row in upserts.items():
+            value = level_value(row, level)
+            key = (value, -affiliate_id)
+            if affiliate_id in members:
+                if ceiling is not None and (value <= 0 or key <= ceiling):
+                    return None  # saiu ou caiu até o teto: algum não membro pode passar
+                if value <= 0:
+                    del members[affiliate_id]
+                    modified = True
+                elif members[affiliate_id] != value:
+                    members[affiliate_id] = value
+                    modified = True
+            elif value > 0:
+                if len(members) < self.size:
+                    members[affiliate_id] = value
+                    modified = True
+                    continue
+                last = min(members.items(), key=_order)
+                if key > _order(last):
+                    # Entra no lugar do último, que passa a ser o maior de fora
+                    del members[last[0]]
+                    members[affiliate_id] = value
+                    ceiling = _order(last) if ceiling is None else max(ceiling, _order(last))
+                    modified = True
+                elif ceiling is None or key > ceiling:
+                    ceiling = key
+
+        self._ceilings[level] = ceiling
+        if modified:
+            self.boards[level] = sorted(members.items(), key=_order, reverse=True)
+        return modified
+
+    def persist(self, cursor, generation, levels=LEADERBOARD_LEVELS):
+        """Troca os quadros informados em mlm_leaderboard numa transação"""
+        levels = list(levels)
+        if not levels:
+            return 0
+        values = [
+            (level, rank, affiliate_id, value, generation)
+            for level in levels
+            for rank, (affiliate_id, value) in enumerate(self.boards.get(level, []), start=1)
+        ]
+        cursor.execute("BEGIN")
+        try:
+            cursor.execute("DELETE FROM mlm_leaderboard WHERE level = ANY(%s)", (levels,))
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO mlm_leaderboard (level, rank, affiliate_id, value, generation)
+                VALUES %s
+            """, values, page_size=1000)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        return len(values)
+
+    def status(self):
+        return {
+            'size': self.size,
+            'boards': {
+                str(level): {
+                    'entries': len(board),
+                    'leader': board[0][0] if board else None,
+                    'cutoff': board[-1][1] if board else None
+                }
+                for level, board in sorted(self.boards.items())
+            }
+        }
+
+
+def persist_from_staging(cursor, generation, size):
+    """Ranking da geração particionada calculado no banco (transação da publicação)"""
+    cursor.execute("DELETE FROM mlm_leaderboard")
+    cursor.execute("""
+        INSERT INTO mlm_leaderboard (level, rank, affiliate_id, value, generation)
+        SELECT level, rank, affiliate_id, direct_count, generation
+        FROM (
+            SELECT
+                level, affiliate_id, direct_count, generation,
+                row_number() OVER (PARTITION BY level ORDER BY direct_count DESC, affiliate_id) AS rank
+            FROM mlm_levels_staging
+            WHERE generation = %s AND level BETWEEN 0 AND 5 AND direct_count > 0
+        ) ranked
+        WHERE rank <= %s
+    """, (generation, size))
+    LEADERBOARD_REBUILDS.inc(len(LEADERBOARD_LEVELS), source='sharded')
+    return cursor.rowcount
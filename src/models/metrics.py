@@ -0,0 +1,351 @@
+# Métricas no formato de exposição do Prometheus
+# Registro leve e thread-safe, sem dependências externas
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Buckets padrão (segundos) para latência de requisições e consultas
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Etapas da sincronização podem levar minutos
+SYNC_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+def _format_value(value):
+    """Formata valor numérico no padrão do Prometheus"""
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value))
+
+
+def _escape_label(value):
+    """Escapa valor de label conforme o formato de texto"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    """Base das métricas com labels"""
+
+    type_name = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        unknown = set(labels) - set(self.labelnames)
+        if unknown:
+            raise ValueError(f"Labels desconhecidos para {self.name}: {sorted(unknown)}")
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _labels_text(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.extend(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+    def get(self, **labels):
+        """Retorna valor atual de uma série"""
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def series(self):
+        """Retorna cópia de todas as séries (labels -> valor)"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}"
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{self._labels_text(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Contador monotônico"""
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Contadores só podem ser incrementados")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """Valor que pode subir ou descer"""
+
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Histograma com buckets cumulativos"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self._values[key] = data
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['buckets'][i] += 1
+            data['sum'] += value
+            data['count'] += 1
+
+    def get(self, **labels):
+        """Retorna (count, sum) de uma série"""
+        with self._lock:
+            data = self._values.get(self._key(labels))
+            if data is None:
+                return 0, 0.0
+            return data['count'], data['sum']
+
+    def series(self):
+        with self._lock:
+            return {
+                key: {'buckets': list(data['buckets']), 'sum': data['sum'], 'count': data['count']}
+                for key, data in self._values.items()
+            }
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}"
+        ]
+        with self._lock:
+            for key, data in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, data['buckets']):
+                    labels = self._labels_text(key, [('le', _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {_format_value(count)}")
+                labels = self._labels_text(key, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {_format_value(data['count'])}")
+                lines.append(f"{self.name}_sum{self._labels_text(key)} {_format_value(data['sum'])}")
+                lines.append(f"{self.name}_count{self._labels_text(key)} {_format_value(data['count'])}")
+        return lines
+
+
+class MetricsRegistry:
+    """Registro de métricas e coletores executados a cada scrape"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Métrica já registrada: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector):
+        """Registra função chamada antes de cada renderização (atualiza gauges)"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self):
+        """Gera texto no formato de exposição do Prometheus"""
+        with self._lock:
+            collectors = list(self._collectors)
+            metrics = list(self._metrics.values())
+
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f"Erro em coletor de métricas: {e}")
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Registro global do processo
+registry = MetricsRegistry()
+
+# Rotas HTTP
+HTTP_REQUEST_DURATION = registry.histogram(
+    'mlm_http_request_duration_seconds',
+    'Latencia das requisicoes HTTP por rota',
+    ('blueprint', 'route', 'method')
+)
+HTTP_REQUESTS = registry.counter(
+    'mlm_http_requests_total',
+    'Total de requisicoes HTTP por rota e status',
+    ('blueprint', 'route', 'method', 'status')
+)
+HTTP_REQUEST_ERRORS = registry.counter(
+    'mlm_http_request_errors_total',
+    'Total de respostas 5xx por rota',
+    ('blueprint', 'route', 'method')
+)
+
+# Consultas do MLMDatabase
+DB_QUERY_DURATION = registry.histogram(
+    'mlm_db_query_duration_seconds',
+    'Duracao das consultas do MLMDatabase por metodo',
+    ('method',)
+)
+DB_QUERY_ERRORS = registry.counter(
+    'mlm_db_query_errors_total',
+    'Total de erros nas consultas do MLMDatabase por metodo',
+    ('method',)
+)
+DB_QUERIES_IN_FLIGHT = registry.gauge(
+    'mlm_db_queries_in_flight',
+    'Consultas em execucao por metodo (uso da conexao compartilhada)',
+    ('method',)
+)
+DB_CONNECTIONS = registry.gauge(
+    'mlm_db_connections',
+    'Conexoes de banco por componente e estado',
+    ('component', 'state')
+)
+
+# Sincronização
+SYNC_STAGE_DURATION = registry.histogram(
+    'mlm_sync_stage_duration_seconds',
+    'Duracao das etapas da sincronizacao',
+    ('stage',),
+    buckets=SYNC_BUCKETS
+)
+SYNC_STAGE_ROWS = registry.gauge(
+    'mlm_sync_stage_rows',
+    'Linhas processadas na ultima execucao de cada etapa',
+    ('stage',)
+)
+SYNC_RUNS = registry.counter(
+    'mlm_sync_runs_total',
+    'Total de sincronizacoes por status',
+    ('status',)
+)
+SYNC_LAST_SUCCESS = registry.gauge(
+    'mlm_sync_last_success_timestamp_seconds',
+    'Timestamp Unix da ultima sincronizacao concluida'
+)
+
+# Caches
+CACHE_REQUESTS = registry.counter(
+    'mlm_cache_requests_total',
+    'Consultas a caches internos por resultado (hit/miss)',
+    ('cache', 'result')
+)
+CACHE_HIT_RATIO = registry.gauge(
+    'mlm_cache_hit_ratio',
+    'Taxa de acerto acumulada de cada cache',
+    ('cache',)
+)
+
+
+def record_cache(cache, hit):
+    """Registra acerto ou falha de um cache"""
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def _collect_cache_ratios():
+    totals = {}
+    for (cache, result), value in CACHE_REQUESTS.series().items():
+        hits, total = totals.get(cache, (0.0, 0.0))
+        totals[cache] = (hits + (value if result == 'hit' else 0.0), total + value)
+    for cache, (hits, total) in totals.items():
+        CACHE_HIT_RATIO.set(hits / total if total else 0.0, cache=cache)
+
+
+registry.register_collector(_collect_cache_ratios)
+
+
+def observe_query(method):
+    """Decorator que mede duração e erros de um método de consulta"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            DB_QUERIES_IN_FLIGHT.inc(method=method)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                DB_QUERY_ERRORS.inc(method=method)
+                raise
+            finally:
+                DB_QUERY_DURATION.observe(time.perf_counter() - start, method=method)
+                DB_QUERIES_IN_FLIGHT.dec(method=method)
+        return wrapper
+    return decorator
+
+
+class StageResult:
+    """Resultado mutável de uma etapa (linhas processadas)"""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.rows = None
+        self.duration = None
+
+
+@contextmanager
+def track_stage(stage):
+    """Mede duração e linhas de uma etapa da sincronização"""
+    result = StageResult(stage)
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result.duration = time.perf_counter() - start
+        SYNC_STAGE_DURATION.observe(result.duration, stage=stage)
+        if result.rows is not None:
+            SYNC_STAGE_ROWS.set(result.rows, stage=stage)
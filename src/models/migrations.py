@@ -0,0 +1,564 @@
+# Migrações versionadas do banco MLM
+#
+# Cada migração é aplicada uma única vez e registrada em mlm_schema_version.
+# Na inicialização, se o schema já está na versão atual, apenas uma consulta
+# é executada (nenhum DDL). Índices são criados com CREATE INDEX CONCURRENTLY
+# para não bloquear escrita nas tabelas durante o deploy.
+#
+# Uso manual (antes do deploy):
+#   python -m src.models.migrations postgresql://...
+
+import sys
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Chave do advisory lock que serializa migrações entre processos
+MIGRATION_LOCK_KEY = 827615001
+
+
+class Migration:
+    """Migração ordenada; concurrent=True executa fora de transação (CONCURRENTLY)"""
+
+    def __init__(self, version, description, statements, concurrent=False):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.concurrent = concurrent
+
+
+def _index(name, definition):
+    """Índice criado com CONCURRENTLY (nome usado para limpar builds inválidos)"""
+    return (name, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition}")
+
+
+MIGRATIONS = [
+    Migration(1, 'Tabelas base do MLM', [
+        """
+        CREATE TABLE IF NOT EXISTS mlm_hierarchy (
+            id SERIAL PRIMARY KEY,
+            affiliate_id INTEGER NOT NULL,
+            parent_id INTEGER,
+            level INTEGER NOT NULL CHECK (level >= 1 AND level <= 5),
+            path TEXT NOT NULL,
+            total_downline INTEGER DEFAULT 0,
+            direct_referrals INTEGER DEFAULT 0,
+            status VARCHAR(20) DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+            CONSTRAINT unique_affiliate UNIQUE (affiliate_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mlm_levels (
+            id SERIAL PRIMARY KEY,
+            affiliate_id INTEGER NOT NULL,
+            level INTEGER NOT NULL CHECK (level >= 1 AND level <= 5),
+            direct_count INTEGER DEFAULT 0,
+            indirect_count INTEGER DEFAULT 0,
+            total_volume DECIMAL(15,2) DEFAULT 0.00,
+            commission_rate DECIMAL(5,4) DEFAULT 0.0000,
+            commission_earned DECIMAL(15,2) DEFAULT 0.00,
+            last_calculated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+            CONSTRAINT unique_affiliate_level UNIQUE (affiliate_id, level)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mlm_commissions (
+            id SERIAL PRIMARY KEY,
+            transaction_id VARCHAR(100),
+            affiliate_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            commission_amount DECIMAL(15,2) NOT NULL,
+            commission_rate DECIMAL(5,4) NOT NULL,
+            base_amount DECIMAL(15,2) NOT NULL,
+            calculation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            payment_status VARCHAR(20) DEFAULT 'pending',
+            payment_date TIMESTAMP
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mlm_sync_log (
+            id SERIAL PRIMARY KEY,
+            sync_type VARCHAR(50) NOT NULL,
+            records_processed INTEGER DEFAULT 0,
+            records_updated INTEGER DEFAULT 0,
+            records_inserted INTEGER DEFAULT 0,
+            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            end_time TIMESTAMP,
+            status VARCHAR(20) DEFAULT 'running',
+            error_message TEXT
+        );
+        """
+    ]),
+    Migration(2, 'Índices base do MLM', [
+        _index('idx_mlm_hierarchy_parent', 'ON mlm_hierarchy(parent_id)'),
+        _index('idx_mlm_hierarchy_level', 'ON mlm_hierarchy(level)'),
+        _index('idx_mlm_hierarchy_path', "ON mlm_hierarchy USING GIN (string_to_array(path, '.'))"),
+        _index('idx_mlm_levels_affiliate', 'ON mlm_levels(affiliate_id)'),
+        _index('idx_mlm_levels_level', 'ON mlm_levels(level)'),
+        _index('idx_mlm_commissions_affiliate', 'ON mlm_commissions(affiliate_id)'),
+        _index('idx_mlm_commissions_date', 'ON mlm_commissions(calculation_date)'),
+        _index('idx_mlm_sync_log_date', 'ON mlm_sync_log(start_time)')
+    ], concurrent=True),
+    # A sincronização grava a hierarquia infinita (nível global > 5) e a linha
+    # de total em mlm_levels com level = 0; os CHECKs originais rejeitavam ambos
+    Migration(3, 'Ajusta CHECKs de nível ao que a sincronização grava', [
+        "ALTER TABLE mlm_hierarchy DROP CONSTRAINT IF EXISTS mlm_hierarchy_level_check;",
+        "ALTER TABLE mlm_hierarchy ADD CONSTRAINT mlm_hierarchy_level_check CHECK (level >= 1);",
+        "ALTER TABLE mlm_levels DROP CONSTRAINT IF EXISTS mlm_levels_level_check;",
+        "ALTER TABLE mlm_levels ADD CONSTRAINT mlm_levels_level_check CHECK (level >= 0 AND level <= 5);"
+    ]),
+    # mlm_commissions particionada por mês em calculation_date, com BRIN para
+    # varreduras por período e rollup diário mantido por trigger
+    Migration(4, 'Particiona mlm_commissions por mês e cria rollups diários', [
+        "ALTER TABLE mlm_commissions RENAME TO mlm_commissions_legacy;",
+        "DROP INDEX IF EXISTS idx_mlm_commissions_affiliate;",
+        "DROP INDEX IF EXISTS idx_mlm_commissions_date;",
+        """
+        CREATE TABLE mlm_commissions (
+            id BIGSERIAL,
+            transaction_id VARCHAR(100),
+            affiliate_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            commission_amount DECIMAL(15,2) NOT NULL,
+            commission_rate DECIMAL(5,4) NOT NULL,
+            base_amount DECIMAL(15,2) NOT NULL,
+            calculation_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            payment_status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            payment_date TIMESTAMP,
+
+            PRIMARY KEY (id, calculation_date)
+        ) PARTITION BY RANGE (calculation_date);
+        """,
+        "CREATE TABLE mlm_commissions_default PARTITION OF mlm_commissions DEFAULT;",
+        "CREATE INDEX idx_mlm_commissions_date_brin ON mlm_commissions USING BRIN (calculation_date);",
+        "CREATE INDEX idx_mlm_commissions_affiliate_date ON mlm_commissions (affiliate_id, calculation_date);",
+        """
+        CREATE OR REPLACE FUNCTION mlm_ensure_commission_partition(p_month DATE) RETURNS TEXT AS $$
+        DECLARE
+            v_start DATE := date_trunc('month', p_month)::date;
+            v_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::date;
+            v_name TEXT := 'mlm_commissions_' || to_char(v_start, 'YYYYMM');
+        BEGIN
+            IF to_regclass(v_name) IS NOT NULL THEN
+                RETURN v_name;
+            END IF;
+
+            EXECUTE format('CREATE TABLE %I (LIKE mlm_commissions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name);
+
+            -- Linhas que caíram na partição default antes da partição existir;
+            -- a movimentação não altera totais, então o rollup é suspenso
+            PERFORM set_config('mlm.skip_rollup', 'on', true);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM mlm_commissions_default
+                                WHERE calculation_date >= %L AND calculation_date < %L
+                                RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved',
+                v_start, v_end, v_name
+            );
+            PERFORM set_config('mlm.skip_rollup', 'off', true);
+
+            EXECUTE format(
+                'ALTER TABLE mlm_commissions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                v_name, v_start, v_end
+            );
+            RETURN v_name;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        # Partições do histórico existente até 3 meses à frente
+        """
+        SELECT mlm_ensure_commission_partition(month::date)
+        FROM generate_series(
+            date_trunc('month', COALESCE((SELECT MIN(calculation_date) FROM mlm_commissions_legacy), now())),
+            date_trunc('month', now()) + INTERVAL '3 months',
+            INTERVAL '1 month'
+        ) AS month;
+        """,
+        """
+        INSERT INTO mlm_commissions (
+            id, transaction_id, affiliate_id, level, commission_amount, commission_rate,
+            base_amount, calculation_date, payment_status, payment_date
+        )
+        SELECT
+            id, transaction_id, affiliate_id, level, commission_amount, commission_rate,
+            base_amount, COALESCE(calculation_date, CURRENT_TIMESTAMP),
+            COALESCE(payment_status, 'pending'), payment_date
+        FROM mlm_commissions_legacy;
+        """,
+        # A tabela antiga (renomeada) ainda é dona de mlm_commissions_id_seq; a
+        # sequência da nova tabela é a que pg_get_serial_sequence devolve
+        """
+        SELECT setval(
+            pg_get_serial_sequence('mlm_commissions', 'id'),
+            COALESCE((SELECT MAX(id) FROM mlm_commissions), 0) + 1,
+            false
+        );
+        """,
+        "DROP TABLE mlm_commissions_legacy;",
+        """
+        CREATE TABLE mlm_commission_daily_rollup (
+            day DATE NOT NULL,
+            affiliate_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            payment_status VARCHAR(20) NOT NULL,
+            commission_count INTEGER NOT NULL DEFAULT 0,
+            commission_total DECIMAL(18,2) NOT NULL DEFAULT 0,
+            base_total DECIMAL(18,2) NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+            PRIMARY KEY (affiliate_id, day, level, payment_status)
+        );
+        """,
+        "CREATE INDEX idx_mlm_commission_rollup_day ON mlm_commission_daily_rollup USING BRIN (day);",
+        """
+        INSERT INTO mlm_commission_daily_rollup (
+            day, affiliate_id, level, payment_status, commission_count, commission_total, base_total
+        )
+        SELECT
+            calculation_date::date, affiliate_id, level, payment_status,
+            COUNT(*), SUM(commission_amount), SUM(base_amount)
+        FROM mlm_commissions
+        GROUP BY 1, 2, 3, 4;
+        """,
+        # Mantém o rollup incrementalmente: subtrai OLD e soma NEW
+        # (UPDATE que troca de partição chega como DELETE + INSERT)
+        """
+        CREATE OR REPLACE FUNCTION mlm_commission_rollup_trigger() RETURNS TRIGGER AS $$
+        BEGIN
+            IF current_setting('mlm.skip_rollup', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE mlm_commission_daily_rollup
+                SET commission_count = commission_count - 1,
+                    commission_total = commission_total - OLD.commission_amount,
+                    base_total = base_total - OLD.base_amount,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE affiliate_id = OLD.affiliate_id
+                    AND day = OLD.calculation_date::date
+                    AND level = OLD.level
+                    AND payment_status = OLD.payment_status;
+            END IF;
+
+            IF TG_OP IN ('UPDATE', 'INSERT') THEN
+                INSERT INTO mlm_commission_daily_rollup (
+                    day, affiliate_id, level, payment_status, commission_count, commission_total, base_total
+                ) VALUES (
+                    NEW.calculation_date::date, NEW.affiliate_id, NEW.level, NEW.payment_status,
+                    1, NEW.commission_amount, NEW.base_amount
+                )
+                ON CONFLICT (affiliate_id, day, level, payment_status)
+                DO UPDATE SET
+                    commission_count = mlm_commission_daily_rollup.commission_count + 1,
+                    commission_total = mlm_commission_daily_rollup.commission_total + EXCLUDED.commission_total,
+                    base_total = mlm_commission_daily_rollup.base_total + EXCLUDED.base_total,
+                    updated_at = CURRENT_TIMESTAMP;
+            END IF;
+
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE TRIGGER trg_mlm_commission_rollup
+        AFTER INSERT OR DELETE OR UPDATE OF affiliate_id, level, commission_amount, base_amount,
+            calculation_date, payment_status
+        ON mlm_commissions
+        FOR EACH ROW EXECUTE FUNCTION mlm_commission_rollup_trigger();
+        """
+    ]),
+    # Cada sincronização gera uma geração; publicada apenas quando concluída
+    Migration(5, 'Tabela de gerações da sincronização', [
+        """
+        CREATE TABLE IF NOT EXISTS mlm_generations (
+            generation BIGSERIAL PRIMARY KEY,
+            sync_type VARCHAR(50) NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'running',
+            affiliates INTEGER,
+            snapshot_file TEXT,
+            error_message TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_mlm_generations_published
+        ON mlm_generations (generation DESC) WHERE status = 'published';
+        """
+    ]),
+    # Indicações novas por nível em janelas de 1/7/30 dias (tracked.created_at)
+    Migration(6, 'Janelas de crescimento em mlm_levels', [
+        "ALTER TABLE mlm_levels ADD COLUMN IF NOT EXISTS new_1d INTEGER NOT NULL DEFAULT 0;",
+        "ALTER TABLE mlm_levels ADD COLUMN IF NOT EXISTS new_7d INTEGER NOT NULL DEFAULT 0;",
+        "ALTER TABLE mlm_levels ADD COLUMN IF NOT EXISTS new_30d INTEGER NOT NULL DEFAULT 0;"
+    ]),
+    # Sincronização particionada: shards por geração e staging (publicado pelo coordenador)
+    Migration(7, 'Shards da sincronização e tabelas de staging', [
+        "ALTER TABLE mlm_generations ADD COLUMN IF NOT EXISTS shard_count INTEGER;",
+        "ALTER TABLE mlm_generations ADD COLUMN IF NOT EXISTS operation_snapshot TEXT;",
+        """
+        CREATE TABLE IF NOT EXISTS mlm_sync_shards (
+            generation BIGINT NOT NULL REFERENCES mlm_generations (generation) ON DELETE CASCADE,
+            shard INTEGER NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            affiliates INTEGER,
+            error_message TEXT,
+            started_at TIMESTAMP,
+            completed_at TIMESTAMP,
+            PRIMARY KEY (generation, shard)
+        );
+        """,
+        """
+        CREATE UNLOGGED TABLE IF NOT EXISTS mlm_hierarchy_staging (
+            generation BIGINT NOT NULL,
+            shard INTEGER NOT NULL,
+            affiliate_id INTEGER NOT NULL,
+            parent_id INTEGER,
+            level INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            total_downline INTEGER DEFAULT 0,
+            direct_referrals INTEGER DEFAULT 0,
+            PRIMARY KEY (generation, affiliate_id)
+        );
+        """,
+        """
+        CREATE UNLOGGED TABLE IF NOT EXISTS mlm_levels_staging (
+            generation BIGINT NOT NULL,
+            shard INTEGER NOT NULL,
+            affiliate_id INTEGER NOT NULL,
+            level INTEGER NOT NULL,
+            direct_count INTEGER DEFAULT 0,
+            indirect_count INTEGER DEFAULT 0,
+            total_volume DECIMAL(15,2) DEFAULT 0.00,
+            commission_rate DECIMAL(5,4) DEFAULT 0.0000,
+            commission_earned DECIMAL(15,2) DEFAULT 0.00,
+            new_1d INTEGER NOT NULL DEFAULT 0,
+            new_7d INTEGER NOT NULL DEFAULT 0,
+            new_30d INTEGER NOT NULL DEFAULT 0,
+            last_calculated TIMESTAMP,
+            PRIMARY KEY (generation, affiliate_id, level)
+        );
+        """
+    ]),
+    # Ranking pré-calculado pela sincronização (level 0 = total N1-N5); a
+    # página é uma faixa da chave primária. Carga inicial a partir de mlm_levels
+    Migration(8, 'Ranking de afiliados por tamanho de rede', [
+        """
+        CREATE TABLE IF NOT EXISTS mlm_leaderboard (
+            level SMALLINT NOT NULL CHECK (level >= 0 AND level <= 5),
+            rank INTEGER NOT NULL,
+            affiliate_id INTEGER NOT NULL,
+            value INTEGER NOT NULL,
+            generation BIGINT,
+            PRIMARY KEY (level, rank)
+        );
+        """,
+        """
+        INSERT INTO mlm_leaderboard (level, rank, affiliate_id, value, generation)
+        SELECT level, rank, affiliate_id, direct_count,
+               (SELECT MAX(generation) FROM mlm_generations WHERE status = 'published')
+        FROM (
+            SELECT
+                level, affiliate_id, direct_count,
+                row_number() OVER (PARTITION BY level ORDER BY direct_count DESC, affiliate_id) AS rank
+            FROM mlm_levels
+            WHERE direct_count > 0
+        ) ranked
+        WHERE rank <= 1000
+        ON CONFLICT DO NOTHING;
+        """
+    ]),
+    # Uma linha por afiliado (N1..N5, total, além de N5, volume) para busca por
+    # faixas sem pivotar mlm_levels; carga inicial a partir de mlm_levels
+    Migration(9, 'Estatísticas por afiliado em linha única', [
+        """
+        CREATE TABLE IF NOT EXISTS mlm_affiliate_stats (
+            affiliate_id INTEGER PRIMARY KEY,
+            n1 INTEGER NOT NULL DEFAULT 0,
+            n2 INTEGER NOT NULL DEFAULT 0,
+            n3 INTEGER NOT NULL DEFAULT 0,
+            n4 INTEGER NOT NULL DEFAULT 0,
+            n5 INTEGER NOT NULL DEFAULT 0,
+            total_n1_to_n5 INTEGER NOT NULL DEFAULT 0,
+            beyond_n5 INTEGER NOT NULL DEFAULT 0,
+            total_volume DECIMAL(15,2) NOT NULL DEFAULT 0.00,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+        """
+        INSERT INTO mlm_affiliate_stats (
+            affiliate_id, n1, n2, n3, n4, n5, total_n1_to_n5, beyond_n5, total_volume
+        )
+        SELECT
+            affiliate_id,
+            COALESCE(MAX(direct_count) FILTER (WHERE level = 1), 0),
+            COALESCE(MAX(direct_count) FILTER (WHERE level = 2), 0),
+            COALESCE(MAX(direct_count) FILTER (WHERE level = 3), 0),
+            COALESCE(MAX(direct_count) FILTER (WHERE level = 4), 0),
+            COALESCE(MAX(direct_count) FILTER (WHERE level = 5), 0),
+            COALESCE(MAX(direct_count) FILTER (WHERE level = 0), 0),
+            COALESCE(MAX(indirect_count) FILTER (WHERE level = 0), 0),
+            COALESCE(MAX(total_volume) FILTER (WHERE level = 0), 0)
+        FROM mlm_levels
+        GROUP BY affiliate_id
+        ON CONFLICT (affiliate_id) DO NOTHING;
+        """
+    ]),
+    # Índices de cobertura por campo ordenável: (campo, affiliate_id) para o
+    # keyset e INCLUDE das demais colunas para index-only scan nos filtros
+    Migration(10, 'Índices de cobertura da busca de afiliados', [
+        _index('idx_mlm_affiliate_stats_total',
+               'ON mlm_affiliate_stats (total_n1_to_n5, affiliate_id) '
+               'INCLUDE (n1, n2, n3, n4, n5, beyond_n5, total_volume)'),
+        _index('idx_mlm_affiliate_stats_n1',
+               'ON mlm_affiliate_stats (n1, affiliate_id) '
+               'INCLUDE (n2, n3, n4, n5, total_n1_to_n5, beyond_n5, total_volume)'),
+        _index('idx_mlm_affiliate_stats_beyond',
+               'ON mlm_affiliate_stats (beyond_n5, affiliate_id) '
+               'INCLUDE (n1, n2, n3, n4, n5, total_n1_to_n5, total_volume)'),
+        _index('idx_mlm_affiliate_stats_volume',
+               'ON mlm_affiliate_stats (total_volume, affiliate_id) '
+               'INCLUDE (n1, n2, n3, n4, n5, total_n1_to_n5, beyond_n5)')
+    ], concurrent=True),
+    # Rede -> shard calculada uma vez pelo coordenador; cada worker lê só os
+    # afiliados do seu shard em tracked
+    Migration(11, 'Cria mlm_sync_shard_affiliates', [
+        """
+        CREATE UNLOGGED TABLE IF NOT EXISTS mlm_sync_shard_affiliates (
+            generation BIGINT NOT NULL,
+            shard INTEGER NOT NULL,
+            affiliate_id INTEGER NOT NULL,
+            PRIMARY KEY (generation, shard, affiliate_id)
+        );
+        """
+    ])
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+class MigrationRunner:
+    """Aplica migrações pendentes em uma conexão autocommit"""
+
+    def __init__(self, connection, migrations=None):
+        self.connection = connection
+        self.migrations = sorted(migrations or MIGRATIONS, key=lambda m: m.version)
+
+    def current_version(self):
+        """Versão aplicada (0 se a tabela de controle não existe)"""
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('mlm_schema_version') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                return 0
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM mlm_schema_version")
+            return cursor.fetchone()[0]
+
+    def pending(self, current=None):
+        if current is None:
+            current = self.current_version()
+        return [m for m in self.migrations if m.version > current]
+
+    def apply(self):
+        """Aplica migrações pendentes; retorna a versão final do schema"""
+        current = self.current_version()
+        if not self.pending(current):
+            logger.info(f"Schema MLM atualizado (versão {current}) - nenhum DDL executado")
+            return current
+
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            # Outro processo pode ter migrado enquanto aguardávamos o lock
+            current = self.current_version()
+            self._ensure_version_table()
+            for migration in self.pending(current):
+                self._apply_one(migration)
+                current = migration.version
+        finally:
+            with self.connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+
+        return current
+
+    def _ensure_version_table(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS mlm_schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    duration_ms INTEGER
+                );
+            """)
+
+    def _apply_one(self, migration):
+        logger.info(f"Aplicando migração {migration.version}: {migration.description}")
+        start = time.perf_counter()
+
+        if migration.concurrent:
+            # CONCURRENTLY não pode rodar em transação: uma instrução por vez
+            with self.connection.cursor() as cursor:
+                for name, statement in migration.statements:
+                    self._drop_invalid_index(cursor, name)
+                    cursor.execute(statement)
+                self._record(cursor, migration, start)
+        else:
+            autocommit = self.connection.autocommit
+            self.connection.autocommit = False
+            try:
+                with self.connection.cursor() as cursor:
+                    for statement in migration.statements:
+                        cursor.execute(statement)
+                    self._record(cursor, migration, start)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+            finally:
+                self.connection.autocommit = autocommit
+
+        logger.info(f"Migração {migration.version} aplicada em {time.perf_counter() - start:.2f}s")
+
+    def _drop_invalid_index(self, cursor, name):
+        """Remove índice deixado inválido por um CREATE INDEX CONCURRENTLY interrompido"""
+        cursor.execute("""
+            SELECT 1
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND NOT i.indisvalid
+        """, (name,))
+        if cursor.fetchone():
+            logger.warning(f"Removendo índice inválido {name} antes de recriá-lo")
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    def _record(self, cursor, migration, start):
+        cursor.execute("""
+            INSERT INTO mlm_schema_version (version, description, duration_ms)
+            VALUES (%s, %s, %s)
+        """, (migration.version, migration.description, int((time.perf_counter() - start) * 1000)))
+
+
+if __name__ == '__main__':
+    import os
+    import psycopg2
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_url = sys.argv[1] if len(sys.argv) > 1 else os.getenv('MLM_DB_URL')
+    if not db_url:
+        print("Uso: python -m src.models.migrations <MLM_DB_URL>")
+        sys.exit(1)
+
+    conn = psycopg2.connect(db_url)
+    conn.autocommit = True
+    try:
+        version = MigrationRunner(conn).apply()
+        print(f"Schema MLM na versão {version}")
+    finally:
+        conn.close()
@@ -3,27 +3,142 @@ import psycopg2.extras
 from datetime import datetime
 import logging
 
+from src.models.metrics import observe_query
+from src.models.single_flight import coalesce
+from src.models.query_log import instrumented_connect
+from src.models.migrations import MigrationRunner
+from src.models.replicas import ReplicaRouter, run_on_replica
+from src.models.affiliate_stats import build_search, DEFAULT_SORT
+from src.models.prepared import PreparedStatement, PreparedStatements
+
 logger = logging.getLogger(__name__)
 
+# Meses à frente com partição de mlm_commissions já criada
+COMMISSION_PARTITION_MONTHS_AHEAD = 3
+
+# Leituras quentes da API, preparadas uma vez por conexão ($n = parâmetros)
+HOT_STATEMENTS = (
+    PreparedStatement('mlm_affiliate_hierarchy', ('integer', 'integer'), """
+        WITH RECURSIVE affiliate_tree AS (
+            -- Caso base: afiliado raiz
+            SELECT 
+                affiliate_id,
+                parent_id,
+                level,
+                path,
+                created_at,
+                updated_at,
+                1 as depth
+            FROM mlm_hierarchy 
+            WHERE affiliate_id = $1
+
+            UNION ALL
+
+            -- Recursão: descendentes
+            SELECT 
+                h.affiliate_id,
+                h.parent_id,
+                h.level,
+                h.path,
+                h.created_at,
+                h.updated_at,
+                at.depth + 1
+            FROM mlm_hierarchy h
+            INNER JOIN affiliate_tree at ON h.parent_id = at.affiliate_id
+            WHERE at.depth < $2
+        )
+        SELECT 
+            at.*,
+            l.direct_count,
+            l.indirect_count,
+            l.total_volume,
+            l.commission_earned
+        FROM affiliate_tree at
+        LEFT JOIN mlm_levels l ON at.affiliate_id = l.affiliate_id 
+            AND l.level = at.depth
+        ORDER BY at.depth, at.affiliate_id
+    """),
+    PreparedStatement('mlm_affiliate_levels', ('integer',), """
+        SELECT 
+            level,
+            direct_count,
+            indirect_count,
+            total_volume,
+            commission_rate,
+            commission_earned,
+            new_1d,
+            new_7d,
+            new_30d,
+            last_calculated
+        FROM mlm_levels 
+        WHERE affiliate_id = $1
+        ORDER BY level
+    """),
+    PreparedStatement('mlm_leaderboard_page', ('smallint', 'integer', 'integer'), """
+        SELECT rank, affiliate_id, value, generation
+        FROM mlm_leaderboard
+        WHERE level = $1 AND rank > $2
+        ORDER BY rank
+        LIMIT $3
+    """),
+    PreparedStatement('mlm_sync_status', (), """
+        SELECT 
+            sync_type,
+            records_processed,
+            records_updated,
+            records_inserted,
+            start_time,
+            end_time,
+            status,
+            error_message
+        FROM mlm_sync_log 
+        ORDER BY start_time DESC 
+        LIMIT 10
+    """),
+)
+
+
+def ensure_commission_partitions(connection, months_ahead=COMMISSION_PARTITION_MONTHS_AHEAD):
+    """Garante partições mensais de mlm_commissions do mês atual até months_ahead"""
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT mlm_ensure_commission_partition(
+                (date_trunc('month', now()) + make_interval(months => g))::date
+            )
+            FROM generate_series(0, %s) AS g;
+        """, (months_ahead,))
+        return [row[0] for row in cursor.fetchall()]
+
+
 class MLMDatabase:
     """Classe para gerenciar conexões e operações do banco MLM"""
     
-    def __init__(self, db_url):
+    def __init__(self, db_url, replica_urls=None, max_replica_lag=10.0, replica_check_interval=5.0,
+                 prepared_statements=True):
         self.db_url = db_url
         self.connection = None
+        self.schema_version = None
+        # Leituras quentes preparadas por conexão (desativar atrás de pooler em modo transaction)
+        self.statements = PreparedStatements(HOT_STATEMENTS, enabled=prepared_statements)
+        # Leituras da API em réplicas (escritas e migrações sempre no primário)
+        self.replicas = ReplicaRouter(
+            replica_urls, max_lag=max_replica_lag, check_interval=replica_check_interval
+        ) if replica_urls else None
         self.connect()
-        self.create_tables()
+        self.apply_migrations()
+        self.ensure_commission_partitions()
     
     def connect(self):
         """Estabelece conexão com o banco MLM"""
         try:
-            self.connection = psycopg2.connect(self.db_url)
+            self.connection = instrumented_connect(self.db_url, 'mlm_api')
             self.connection.autocommit = True
             logger.info("Conexão com banco MLM estabelecida")
         except Exception as e:
             logger.error(f"Erro ao conectar com banco MLM: {e}")
             raise
     
+    @observe_query('check_connection')
     def check_connection(self):
         """Verifica se a conexão está ativa"""
         try:
@@ -32,181 +147,185 @@ class MLMDatabase:
             
             with self.connection.cursor() as cursor:
                 cursor.execute("SELECT 1")
-                return True
+            # Migração aplicada por outro nó também invalida as instruções preparadas
+            self.statements.invalidate(MigrationRunner(self.connection).current_version())
+            return True
         except Exception as e:
             logger.error(f"Erro na verificação de conexão: {e}")
             return False
     
-    def create_tables(self):
-        """Cria tabelas do banco MLM se não existirem"""
+    def apply_migrations(self):
+        """Aplica migrações pendentes do schema (sem DDL quando já atualizado)"""
         try:
-            with self.connection.cursor() as cursor:
-                # Tabela de hierarquia MLM
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS mlm_hierarchy (
-                        id SERIAL PRIMARY KEY,
-                        affiliate_id INTEGER NOT NULL,
-                        parent_id INTEGER,
-                        level INTEGER NOT NULL CHECK (level >= 1 AND level <= 5),
-                        path TEXT NOT NULL,
-                        total_downline INTEGER DEFAULT 0,
-                        direct_referrals INTEGER DEFAULT 0,
-                        status VARCHAR(20) DEFAULT 'active',
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        
-                        CONSTRAINT unique_affiliate UNIQUE (affiliate_id)
-                    );
-                """)
-                
-                # Tabela de níveis MLM
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS mlm_levels (
-                        id SERIAL PRIMARY KEY,
-                        affiliate_id INTEGER NOT NULL,
-                        level INTEGER NOT NULL CHECK (level >= 1 AND level <= 5),
-                        direct_count INTEGER DEFAULT 0,
-                        indirect_count INTEGER DEFAULT 0,
-                        total_volume DECIMAL(15,2) DEFAULT 0.00,
-                        commission_rate DECIMAL(5,4) DEFAULT 0.0000,
-                        commission_earned DECIMAL(15,2) DEFAULT 0.00,
-                        last_calculated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        
-                        CONSTRAINT unique_affiliate_level UNIQUE (affiliate_id, level)
-                    );
-                """)
-                
-                # Tabela de comissões MLM
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS mlm_commissions (
-                        id SERIAL PRIMARY KEY,
-                        transaction_id VARCHAR(100),
-                        affiliate_id INTEGER NOT NULL,
-                        level INTEGER NOT NULL,
-                        commission_amount DECIMAL(15,2) NOT NULL,
-                        commission_rate DECIMAL(5,4) NOT NULL,
-                        base_amount DECIMAL(15,2) NOT NULL,
-                        calculation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        payment_status VARCHAR(20) DEFAULT 'pending',
-                        payment_date TIMESTAMP
-                    );
-                """)
-                
-                # Tabela de sincronização
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS mlm_sync_log (
-                        id SERIAL PRIMARY KEY,
-                        sync_type VARCHAR(50) NOT NULL,
-                        records_processed INTEGER DEFAULT 0,
-                        records_updated INTEGER DEFAULT 0,
-                        records_inserted INTEGER DEFAULT 0,
-                        start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        end_time TIMESTAMP,
-                        status VARCHAR(20) DEFAULT 'running',
-                        error_message TEXT
-                    );
-                """)
-                
-                # Criar índices
-                self.create_indexes()
+            self.schema_version = MigrationRunner(self.connection).apply()
+            self.statements.invalidate(self.schema_version)
+        except Exception as e:
+            logger.error(f"Erro ao aplicar migrações: {e}")
+            raise
+    
+    def ensure_commission_partitions(self, months_ahead=COMMISSION_PARTITION_MONTHS_AHEAD):
+        """Cria partições mensais futuras de mlm_commissions"""
+        try:
+            return ensure_commission_partitions(self.connection, months_ahead)
+        except Exception as e:
+            logger.warning(f"Erro ao criar partições de comissões: {e}")
+            return []
+    
+    @coalesce('get_affiliate_hierarchy')
+    @observe_query('get_affiliate_hierarchy')
+    def get_affiliate_hierarchy(self, affiliate_id, max_level=5):
+        """Obtém hierarquia completa de um afiliado (réplica quando disponível)"""
+        try:
+            return run_on_replica(self.replicas, self.connection,
+                                  lambda connection: self._fetch_hierarchy(connection, affiliate_id, max_level))
+        except Exception as e:
+            logger.error(f"Erro ao buscar hierarquia: {e}")
+            raise
+    
+    def _fetch_hierarchy(self, connection, affiliate_id, max_level):
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            self.statements.execute(cursor, 'mlm_affiliate_hierarchy', (affiliate_id, max_level))
+
+            return cursor.fetchall()
+    
+    @coalesce('get_affiliate_upline')
+    @observe_query('get_affiliate_upline')
+    def get_affiliate_upline(self, affiliate_id, max_depth=None):
+        """Obtém ancestrais de um afiliado a partir do path (None se ausente)"""
+        try:
+            with self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(
+                    "SELECT path FROM mlm_hierarchy WHERE affiliate_id = %s",
+                    (affiliate_id,)
+                )
+                result = cursor.fetchone()
+                if not result:
+                    return None
                 
-                logger.info("Tabelas MLM criadas/verificadas com sucesso")
+                # path vai da raiz ao afiliado; upline é do mais próximo à raiz
+                upline = [int(node) for node in result['path'].split('.')[:-1]][::-1]
+                return upline[:max_depth] if max_depth else upline
                 
         except Exception as e:
-            logger.error(f"Erro ao criar tabelas: {e}")
+            logger.error(f"Erro ao buscar upline: {e}")
             raise
     
-    def create_indexes(self):
-        """Cria índices para otimização de performance"""
-        indexes = [
-            "CREATE INDEX IF NOT EXISTS idx_mlm_hierarchy_parent ON mlm_hierarchy(parent_id);",
-            "CREATE INDEX IF NOT EXISTS idx_mlm_hierarchy_level ON mlm_hierarchy(level);",
-            "CREATE INDEX IF NOT EXISTS idx_mlm_hierarchy_path ON mlm_hierarchy USING GIN (string_to_array(path, '.'));",
-            "CREATE INDEX IF NOT EXISTS idx_mlm_levels_affiliate ON mlm_levels(affiliate_id);",
-            "CREATE INDEX IF NOT EXISTS idx_mlm_levels_level ON mlm_levels(level);",
-            "CREATE INDEX IF NOT EXISTS idx_mlm_commissions_affiliate ON mlm_commissions(affiliate_id);",
-            "CREATE INDEX IF NOT EXISTS idx_mlm_commissions_date ON mlm_commissions(calculation_date);",
-            "CREATE INDEX IF NOT EXISTS idx_mlm_sync_log_date ON mlm_sync_log(start_time);"
-        ]
-        
-        with self.connection.cursor() as cursor:
-            for index_sql in indexes:
-                try:
-                    cursor.execute(index_sql)
-                except Exception as e:
-                    logger.warning(f"Erro ao criar índice: {e}")
+    @coalesce('calculate_affiliate_stats')
+    @observe_query('calculate_affiliate_stats')
+    def calculate_affiliate_stats(self, affiliate_id):
+        """Calcula estatísticas MLM para um afiliado (réplica quando disponível)"""
+        try:
+            return run_on_replica(self.replicas, self.connection,
+                                  lambda connection: self._fetch_level_stats(connection, affiliate_id))
+        except Exception as e:
+            logger.error(f"Erro ao calcular estatísticas: {e}")
+            raise
     
-    def get_affiliate_hierarchy(self, affiliate_id, max_level=5):
-        """Obtém hierarquia completa de um afiliado"""
+    def _fetch_level_stats(self, connection, affiliate_id):
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            self.statements.execute(cursor, 'mlm_affiliate_levels', (affiliate_id,))
+            
+            return cursor.fetchall()
+    
+    @coalesce('get_leaderboard')
+    @observe_query('get_leaderboard')
+    def get_leaderboard(self, level=0, offset=0, limit=50):
+        """Faixa do ranking pré-calculado (level 0 = total N1-N5) pela chave (level, rank)"""
+        try:
+            return run_on_replica(self.replicas, self.connection,
+                                  lambda connection: self._fetch_leaderboard(connection, level, offset, limit))
+        except Exception as e:
+            logger.error(f"Erro ao buscar ranking: {e}")
+            raise
+    
+    def _fetch_leaderboard(self, connection, level, offset, limit):
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            self.statements.execute(cursor, 'mlm_leaderboard_page', (level, offset, limit))
+            
+            return cursor.fetchall()
+    
+    @coalesce('search_affiliates')
+    @observe_query('search_affiliates')
+    def search_affiliates(self, filters=None, sort=DEFAULT_SORT, order='desc', after=None, limit=50):
+        """Busca em mlm_affiliate_stats por faixas (limit + 1 linhas; ValueError em parâmetro inválido)"""
+        query, params = build_search(filters, sort, order, after, limit)
+        try:
+            return run_on_replica(self.replicas, self.connection,
+                                  lambda connection: self._fetch_search(connection, query, params))
+        except Exception as e:
+            logger.error(f"Erro na busca de afiliados: {e}")
+            raise
+    
+    def _fetch_search(self, connection, query, params):
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(query, params)
+            
+            return cursor.fetchall()
+    
+    @coalesce('get_commission_summary')
+    @observe_query('get_commission_summary')
+    def get_commission_summary(self, affiliate_id, start_date=None, end_date=None, level=None, status=None):
+        """Resumo de comissões por nível e status a partir do rollup diário"""
         try:
             with self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute("""
-                    WITH RECURSIVE affiliate_tree AS (
-                        -- Caso base: afiliado raiz
-                        SELECT 
-                            affiliate_id,
-                            parent_id,
-                            level,
-                            path,
-                            1 as depth
-                        FROM mlm_hierarchy 
-                        WHERE affiliate_id = %s
-                        
-                        UNION ALL
-                        
-                        -- Recursão: descendentes
-                        SELECT 
-                            h.affiliate_id,
-                            h.parent_id,
-                            h.level,
-                            h.path,
-                            at.depth + 1
-                        FROM mlm_hierarchy h
-                        INNER JOIN affiliate_tree at ON h.parent_id = at.affiliate_id
-                        WHERE at.depth < %s
-                    )
                     SELECT 
-                        at.*,
-                        l.direct_count,
-                        l.indirect_count,
-                        l.total_volume,
-                        l.commission_earned
-                    FROM affiliate_tree at
-                    LEFT JOIN mlm_levels l ON at.affiliate_id = l.affiliate_id 
-                        AND l.level = at.depth
-                    ORDER BY at.depth, at.affiliate_id;
-                """, (affiliate_id, max_level))
+                        level,
+                        payment_status,
+                        SUM(commission_count) as total_transactions,
+                        SUM(commission_total) as total_amount,
+                        SUM(base_total) as base_amount
+                    FROM mlm_commission_daily_rollup
+                    WHERE affiliate_id = %s
+                        AND (%s::date IS NULL OR day >= %s::date)
+                        AND (%s::date IS NULL OR day <= %s::date)
+                        AND (%s::integer IS NULL OR level = %s::integer)
+                        AND (%s::text IS NULL OR payment_status = %s::text)
+                    GROUP BY level, payment_status
+                    HAVING SUM(commission_count) > 0
+                    ORDER BY level, payment_status;
+                """, (affiliate_id, start_date, start_date, end_date, end_date, level, level, status, status))
                 
                 return cursor.fetchall()
                 
         except Exception as e:
-            logger.error(f"Erro ao buscar hierarquia: {e}")
+            logger.error(f"Erro ao buscar resumo de comissões: {e}")
             raise
     
-    def calculate_affiliate_stats(self, affiliate_id):
-        """Calcula estatísticas MLM para um afiliado"""
+    @coalesce('get_commissions')
+    @observe_query('get_commissions')
+    def get_commissions(self, affiliate_id, start_date=None, end_date=None, level=None, status=None, limit=100):
+        """Comissões individuais mais recentes (poda de partições pelo período)"""
         try:
             with self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                 cursor.execute("""
                     SELECT 
+                        id,
+                        transaction_id,
                         level,
-                        direct_count,
-                        indirect_count,
-                        total_volume,
+                        commission_amount,
                         commission_rate,
-                        commission_earned,
-                        last_calculated
-                    FROM mlm_levels 
+                        base_amount,
+                        calculation_date,
+                        payment_status,
+                        payment_date
+                    FROM mlm_commissions
                     WHERE affiliate_id = %s
-                    ORDER BY level;
-                """, (affiliate_id,))
+                        AND calculation_date >= COALESCE(%s::date, '-infinity'::timestamp)
+                        AND calculation_date < COALESCE(%s::date + 1, 'infinity'::timestamp)
+                        AND (%s::integer IS NULL OR level = %s::integer)
+                        AND (%s::text IS NULL OR payment_status = %s::text)
+                    ORDER BY calculation_date DESC
+                    LIMIT %s;
+                """, (affiliate_id, start_date, end_date, level, level, status, status, limit))
                 
                 return cursor.fetchall()
                 
         except Exception as e:
-            logger.error(f"Erro ao calcular estatísticas: {e}")
+            logger.error(f"Erro ao buscar comissões: {e}")
             raise
     
+    @observe_query('insert_hierarchy_record')
     def insert_hierarchy_record(self, affiliate_id, parent_id, level, path):
         """Insere registro na hierarquia MLM"""
         try:
@@ -226,6 +345,7 @@ class MLMDatabase:
             logger.error(f"Erro ao inserir hierarquia: {e}")
             raise
     
+    @observe_query('update_level_stats')
     def update_level_stats(self, affiliate_id, level, direct_count, indirect_count, total_volume=0):
         """Atualiza estatísticas de nível"""
         try:
@@ -245,6 +365,7 @@ class MLMDatabase:
             logger.error(f"Erro ao atualizar estatísticas: {e}")
             raise
     
+    @observe_query('log_sync_operation')
     def log_sync_operation(self, sync_type, records_processed=0, records_updated=0, records_inserted=0, status='completed', error_message=None):
         """Registra operação de sincronização"""
         try:
@@ -258,33 +379,26 @@ class MLMDatabase:
         except Exception as e:
             logger.error(f"Erro ao registrar log de sincronização: {e}")
     
+    @coalesce('get_sync_status')
+    @observe_query('get_sync_status')
     def get_sync_status(self):
-        """Obtém status das últimas sincronizações"""
+        """Obtém status das últimas sincronizações (réplica quando disponível)"""
         try:
-            with self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-                cursor.execute("""
-                    SELECT 
-                        sync_type,
-                        records_processed,
-                        records_updated,
-                        records_inserted,
-                        start_time,
-                        end_time,
-                        status,
-                        error_message
-                    FROM mlm_sync_log 
-                    ORDER BY start_time DESC 
-                    LIMIT 10;
-                """)
-                
-                return cursor.fetchall()
-                
+            return run_on_replica(self.replicas, self.connection, self._fetch_sync_status)
         except Exception as e:
             logger.error(f"Erro ao buscar status de sincronização: {e}")
             return []
     
+    def _fetch_sync_status(self, connection):
+        with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            self.statements.execute(cursor, 'mlm_sync_status')
+            
+            return cursor.fetchall()
+    
     def close(self):
         """Fecha conexão com o banco"""
+        if self.replicas:
+            self.replicas.close()
         if self.connection and not self.connection.closed:
             self.connection.close()
             logger.info("Conexão com banco MLM fechada")
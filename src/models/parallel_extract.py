@@ -0,0 +1,226 @@
+# Extração paralela de tracked por faixas de id
+#
+# A consulta única (ORDER BY user_afil, user_id) ordena a tabela inteira no
+# banco da operação e lê tudo por uma conexão. Aqui tracked é dividida em
+# faixas de id lidas por várias conexões, sem ORDER BY; a ordem do builder
+# é refeita em memória ao juntar as faixas. Todas as conexões leem o mesmo
+# snapshot (pg_export_snapshot ou o snapshot da geração particionada), então
+# o resultado é o de uma única leitura consistente.
+#
+# Cuidado com o banco de produção: o número de conexões é o de workers, cada
+# faixa é lida em lotes por cursor no servidor e um limite de linhas por
+# segundo (compartilhado entre os workers) segura a vazão total.
+
+import queue
+import threading
+import time
+import logging
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+
+from src.models.metrics import registry
+from src.models.query_log import instrumented_connect
+
+logger = logging.getLogger(__name__)
+
+EXTRACT_ROWS = registry.counter(
+    'mlm_extract_rows_total',
+    'Linhas de tracked lidas pela extração paralela'
+)
+EXTRACT_THROUGHPUT = registry.gauge(
+    'mlm_extract_rows_per_second',
+    'Vazão da última extração paralela (linhas por segundo)'
+)
+EXTRACT_THROTTLED = registry.counter(
+    'mlm_extract_throttled_seconds_total',
+    'Tempo de espera imposto pelo limite de linhas por segundo'
+)
+
+RANGE_QUERY = """
+    SELECT
+        id,
+        user_afil as affiliate_id,
+        user_id as referred_user_id,
+        tracked_type_id,
+        created_at
+    FROM tracked
+    WHERE id >= %s AND id < %s
+        AND tracked_type_id = 1
+        AND user_afil IS NOT NULL
+        AND user_id IS NOT NULL
+"""
+
+
+def tracked_order(record):
+    """Ordem da consulta única (user_afil, user_id), com id para desempate estável"""
+    return (record['affiliate_id'], record['referred_user_id'], record['id'])
+
+
+def id_ranges(min_id, max_id, range_size):
+    """Faixas [início, fim) cobrindo min_id..max_id"""
+    if min_id is None:
+        return []
+    return [(start, min(start + range_size, max_id + 1)) for start in range(min_id, max_id + 1, range_size)]
+
+
+class RowRateLimiter:
+    """Limite de linhas por segundo compartilhado entre threads (None = sem limite)"""
+
+    def __init__(self, rows_per_second=None):
+        self.rows_per_second = rows_per_second
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, rows):
+        """Espera até que rows linhas caibam na vazão configurada; devolve a espera"""
+        if not self.rows_per_second or rows <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + rows / self.rows_per_second
+        wait = start - now
+        if wait > 0:
+            time.sleep(wait)
+            EXTRACT_THROTTLED.inc(wait)
+        return max(wait, 0.0)
+
+
+class ParallelExtractor:
+    """Lê tracked em faixas de id por várias conexões no mesmo snapshot"""
+
+    def __init__(self, dsn, workers=4, range_size=100000, batch_size=10000, max_rows_per_second=None):
+        self.dsn = dsn
+        self.workers = max(1, int(workers))
+        self.range_size = max(1, int(range_size))
+        self.batch_size = max(1, int(batch_size))
+        self.limiter = RowRateLimiter(max_rows_per_second or None)
+        self.last_run = None
+
+    def _connect(self):
+        conn = instrumented_connect(self.dsn, 'sync_extract')
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        return conn
+
+    def extract(self, snapshot_id=None):
+        """Registros de tracked na ordem da consulta única"""
+        start = time.perf_counter()
+        exporter = None
+        try:
+            exporter = self._connect()
+            with exporter.cursor() as cursor:
+                if snapshot_id:
+                    cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                else:
+                    # Snapshot mantido aberto por esta transação até o fim das faixas
+                    cursor.execute("SELECT pg_export_snapshot()")
+                    snapshot_id = cursor.fetchone()[0]
+                cursor.execute("SELECT MIN(id), MAX(id) FROM tracked")
+                min_id, max_id = cursor.fetchone()
+
+            ranges = id_ranges(min_id, max_id, self.range_size)
+            parts, throttled = self._read_ranges(snapshot_id, ranges)
+        finally:
+            if exporter is not None:
+                # Fechar descarta a transação (e libera o snapshot exportado)
+                exporter.close()
+
+        records = []
+        for part in parts:
+            records.extend(part)
+        del parts
+        records.sort(key=tracked_order)
+        seconds = time.perf_counter() - start
+        throughput = len(records) / seconds if seconds > 0 else 0.0
+
+        EXTRACT_ROWS.inc(len(records))
+        EXTRACT_THROUGHPUT.set(round(throughput, 1))
+        self.last_run = {
+            'rows': len(records),
+            'ranges': len(ranges),
+            'workers': min(self.workers, len(ranges)) if ranges else 0,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(throughput, 1),
+            'throttled_seconds': round(throttled, 3)
+        }
+        logger.info(
+            f"Extração paralela: {len(records)} registros em {len(ranges)} faixas "
+            f"({self.last_run['workers']} conexões) em {seconds:.2f}s ({throughput:.0f} linhas/s)"
+        )
+        return records
+
+    def _read_ranges(self, snapshot_id, ranges):
+        pending = queue.Queue()
+        for item in ranges:
+            pending.put(item)
+        parts = []
+        errors = []
+        throttled = []
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def worker():
+            waited = 0.0
+            conn = None
+            try:
+                conn = self._connect()
+                with conn.cursor() as cursor:
+                    cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                while not failed.is_set():
+                    try:
+                        low, high = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    rows, range_waited = self._read_range(conn, low, high)
+                    waited += range_waited
+                    with lock:
+                        parts.append(rows)
+            except Exception as e:
+                failed.set()
+                with lock:
+                    errors.append(e)
+            finally:
+                if conn is not None:
+                    conn.close()
+                with lock:
+                    throttled.append(waited)
+
+        threads = [
+            threading.Thread(target=worker, name=f'tracked-extract-{index}', daemon=True)
+            for index in range(min(self.workers, len(ranges)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            logger.error(f"Erro na extração paralela: {errors[0]}")
+            raise errors[0]
+        return parts, sum(throttled)
+
+    def _read_range(self, conn, low, high):
+        rows = []
+        waited = 0.0
+        # Cursor no servidor: a faixa chega em lotes e o limite de vazão vale por lote
+        with conn.cursor(name=f'tracked_{low}', cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.itersize = self.batch_size
+            cursor.execute(RANGE_QUERY, (low, high))
+            while True:
+                batch = cursor.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                waited += self.limiter.acquire(len(batch))
+                rows.extend(batch)
+        return rows, waited
+
+    def status(self):
+        return {
+            'workers': self.workers,
+            'range_size': self.range_size,
+            'batch_size': self.batch_size,
+            'max_rows_per_second': self.limiter.rows_per_second,
+            'last_run': self.last_run
+        }
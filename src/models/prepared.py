@@ -0,0 +1,118 @@
+# Instruções preparadas no servidor para as leituras quentes da API
+#
+# Cada conexão (primário ou réplica) prepara a instrução na primeira execução
+# e depois só envia EXECUTE nome(parâmetros): parse e análise acontecem uma
+# vez por conexão. O conjunto preparado fica na própria conexão, então uma
+# reconexão começa vazia. Após migrações (versão do schema diferente da usada
+# no PREPARE) a conexão faz DEALLOCATE ALL e prepara de novo; instrução
+# descartada pelo servidor ou com tipo de resultado alterado é preparada de
+# novo uma vez antes de propagar o erro.
+
+import re
+import threading
+import logging
+
+import psycopg2
+import psycopg2.errors
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+_PARAM_RE = re.compile(r'\$(\d+)')
+
+PREPARED_STATEMENTS = registry.counter(
+    'mlm_prepared_statements_total',
+    'Instruções preparadas por nome e motivo (primeira execução, migração ou erro)',
+    ('statement', 'reason')
+)
+
+
+class PreparedStatement:
+    """Instrução nomeada com tipos dos parâmetros ($1, $2, ...)"""
+
+    def __init__(self, name, param_types, sql):
+        self.name = name
+        self.param_types = tuple(param_types)
+        self.sql = sql
+
+    def prepare_sql(self):
+        types = f"({', '.join(self.param_types)})" if self.param_types else ''
+        return f"PREPARE {self.name}{types} AS {self.sql}"
+
+    def text_query(self, params=()):
+        """Texto equivalente para envio direto, com os parâmetros nomeados"""
+        sql = _PARAM_RE.sub(lambda match: f"%(p{match.group(1)})s", self.sql)
+        return sql, {f"p{index}": value for index, value in enumerate(params, 1)}
+
+    def execute_sql(self):
+        if not self.param_types:
+            return f"EXECUTE {self.name}"
+        return f"EXECUTE {self.name}({', '.join(['%s'] * len(self.param_types))})"
+
+
+class PreparedStatements:
+    """Prepara sob demanda, por conexão, e invalida quando o schema muda"""
+
+    ATTRIBUTE = 'mlm_prepared'
+
+    def __init__(self, statements, schema_version=None, enabled=True):
+        self.statements = {statement.name: statement for statement in statements}
+        self.schema_version = schema_version
+        self.enabled = enabled
+        self._lock = threading.Lock()
+
+    def invalidate(self, schema_version):
+        """Nova versão do schema: cada conexão descarta e prepara de novo no próximo uso"""
+        with self._lock:
+            if schema_version != self.schema_version:
+                logger.info(f"Instruções preparadas invalidadas (schema {self.schema_version} -> {schema_version})")
+            self.schema_version = schema_version
+
+    def _prepared(self, cursor, statement):
+        """Nomes preparados na conexão do cursor, preparando a instrução se preciso"""
+        connection = cursor.connection
+        with self._lock:
+            state = getattr(connection, self.ATTRIBUTE, None)
+            reason = 'first_use'
+            if state is not None and state[0] != self.schema_version:
+                cursor.execute("DEALLOCATE ALL")
+                state = None
+                reason = 'migration'
+            if state is None:
+                state = (self.schema_version, set())
+                setattr(connection, self.ATTRIBUTE, state)
+            prepared = state[1]
+            if statement.name not in prepared:
+                self._prepare(cursor, statement, prepared, reason)
+            return prepared
+
+    def _prepare(self, cursor, statement, prepared, reason):
+        cursor.execute(statement.prepare_sql())
+        prepared.add(statement.name)
+        PREPARED_STATEMENTS.inc(statement=statement.name, reason=reason)
+
+    def execute(self, cursor, name, params=()):
+        """Executa a instrução nomeada no cursor (texto direto se desativado)"""
+        statement = self.statements[name]
+        if not self.enabled:
+            # Mesmo texto enviado a cada chamada (ex.: pgbouncer em modo transaction)
+            cursor.execute(*statement.text_query(params))
+            return
+
+        prepared = self._prepared(cursor, statement)
+        try:
+            cursor.execute(statement.execute_sql(), params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # Servidor descartou a instrução (ex.: DISCARD ALL de um pooler)
+            with self._lock:
+                prepared.clear()
+                self._prepare(cursor, statement, prepared, 'missing')
+            cursor.execute(statement.execute_sql(), params)
+        except psycopg2.errors.FeatureNotSupported:
+            # "cached plan must not change result type": DDL alterou as colunas
+            with self._lock:
+                cursor.execute(f"DEALLOCATE {statement.name}")
+                prepared.discard(statement.name)
+                self._prepare(cursor, statement, prepared, 'schema_changed')
+            cursor.execute(statement.execute_sql(), params)
@@ -0,0 +1,285 @@
+# Instrumentação de consultas: tempos por instrução e log de consultas lentas
+# com captura amostrada de EXPLAIN (ANALYZE, BUFFERS)
+
+import psycopg2
+import psycopg2.extensions
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import logging
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERIES = registry.counter(
+    'mlm_slow_queries_total',
+    'Total de consultas acima do limite de lentidao por componente',
+    ('component',)
+)
+EXPLAINS_CAPTURED = registry.counter(
+    'mlm_slow_query_explains_total',
+    'Total de planos EXPLAIN capturados por componente e resultado',
+    ('component', 'result')
+)
+
+_COMMENT_RE = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_SPACE_RE = re.compile(r'\s+')
+_READ_RE = re.compile(r'^\s*(SELECT|WITH)\b', re.I)
+_WRITE_RE = re.compile(r'^\s*(INSERT|UPDATE|DELETE)\b', re.I)
+_DML_RE = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE)\b', re.I)
+_EXECUTE_RE = re.compile(r'^\s*EXECUTE\b', re.I)
+# Funções com efeito colateral: ANALYZE executaria de novo (lock obtido duas
+# vezes, sequência avançada, NOTIFY repetido, snapshot exportado...)
+_VOLATILE_RE = re.compile(
+    r'\b(pg_advisory\w*|pg_try_advisory\w*|setval|nextval|set_config|pg_notify|'
+    r'pg_export_snapshot|pg_sleep\w*|pg_terminate_backend|pg_cancel_backend|'
+    r'pg_reload_conf|pg_switch_wal|pg_create_\w+|pg_drop_replication_slot|'
+    r'pg_logical_emit_message|pg_stat_reset\w*|pg_current_xact_id|txid_current|'
+    r'lo_\w+|dblink\w*|mlm_\w+)\s*\(',
+    re.I
+)
+# SELECT ... INTO cria tabela; FOR UPDATE/SHARE bloqueia linhas
+_SIDE_EFFECT_RE = re.compile(r'\bINTO\b|\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b', re.I)
+
+MAX_QUERY_TEXT = 4000
+MAX_FINGERPRINTS = 500
+
+
+def _query_text(query, cursor):
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+    if hasattr(query, 'as_string'):
+        # psycopg2.sql.Composed
+        return query.as_string(cursor)
+    return str(query)
+
+
+def fingerprint(query_text):
+    """Normaliza a instrução (sem comentários e espaços extras) para agrupamento"""
+    text = _COMMENT_RE.sub(' ', query_text)
+    return _SPACE_RE.sub(' ', text).strip()[:200]
+
+
+def explain_mode(query_text):
+    """Define como capturar o plano: 'analyze' só para leituras sem efeito colateral"""
+    text = _COMMENT_RE.sub(' ', query_text)
+    if _READ_RE.match(text):
+        # CTEs com escrita e funções voláteis não podem ser reexecutadas com ANALYZE
+        if _DML_RE.search(text) or _VOLATILE_RE.search(text) or _SIDE_EFFECT_RE.search(text):
+            return 'plan'
+        return 'analyze'
+    if _WRITE_RE.match(text) or _EXECUTE_RE.match(text):
+        # Instrução preparada pode ser escrita: só o plano
+        return 'plan'
+    return None
+
+
+class SlowQueryLog:
+    """Registra tempos por instrução e guarda consultas lentas em um ring buffer"""
+
+    def __init__(self, threshold_ms=500.0, sample_rate=0.1, capacity=100, explain=True):
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.explain = explain
+        self._entries = deque(maxlen=capacity)
+        self._stats = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def configure(self, threshold_ms=None, sample_rate=None, capacity=None, explain=None):
+        """Atualiza configuração em tempo de execução"""
+        with self._lock:
+            if threshold_ms is not None:
+                self.threshold_ms = float(threshold_ms)
+            if sample_rate is not None:
+                self.sample_rate = max(0.0, min(1.0, float(sample_rate)))
+            if explain is not None:
+                self.explain = bool(explain)
+            if capacity is not None and capacity != self._entries.maxlen:
+                self._entries = deque(self._entries, maxlen=int(capacity))
+
+    def observe(self, cursor, component, query, duration):
+        """Chamado pelo cursor instrumentado após cada execução bem-sucedida"""
+        try:
+            text = _query_text(query, cursor)
+        except Exception:
+            return
+        duration_ms = duration * 1000.0
+        # Cache de normalização: as mesmas instruções se repetem milhares de vezes
+        key = self._fingerprints.get(text)
+        if key is None:
+            if len(self._fingerprints) >= MAX_FINGERPRINTS * 2:
+                self._fingerprints.clear()
+            key = self._fingerprints[text] = fingerprint(text)
+
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) >= MAX_FINGERPRINTS:
+                    # Descarta a instrução menos usada para limitar memória
+                    least = min(self._stats, key=lambda k: self._stats[k]['calls'])
+                    del self._stats[least]
+                stats = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'slow_calls': 0, 'components': set()}
+                self._stats[key] = stats
+            stats['calls'] += 1
+            stats['total_ms'] += duration_ms
+            stats['max_ms'] = max(stats['max_ms'], duration_ms)
+            stats['components'].add(component)
+            is_slow = duration_ms >= self.threshold_ms
+            if is_slow:
+                stats['slow_calls'] += 1
+            sampled = is_slow and self.explain and random.random() < self.sample_rate
+
+        if not is_slow:
+            return
+
+        SLOW_QUERIES.inc(component=component)
+        logger.warning(f"Consulta lenta ({duration_ms:.1f}ms) em {component}: {key[:120]}")
+
+        bound_query = getattr(cursor, 'query', None)
+        entry = {
+            'timestamp': datetime.now().isoformat(),
+            'component': component,
+            'fingerprint': key,
+            'query': _query_text(bound_query, cursor)[:MAX_QUERY_TEXT] if bound_query else text[:MAX_QUERY_TEXT],
+            'duration_ms': round(duration_ms, 3),
+            'explain_mode': None,
+            'plan': None,
+            'explain_error': None
+        }
+
+        if sampled and bound_query:
+            self._capture_plan(cursor, component, bound_query, text, entry)
+
+        self._entries.append(entry)
+
+    def _capture_plan(self, cursor, component, bound_query, text, entry):
+        mode = explain_mode(text)
+        if mode is None or getattr(cursor, 'name', None):
+            return
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if mode == 'analyze' else 'FORMAT JSON'
+        if isinstance(bound_query, str):
+            bound_query = bound_query.encode('utf-8')
+        # Em transação (exportação, sessões de réplica, BEGIN explícito) o EXPLAIN
+        # roda num savepoint: uma falha dele não pode abortar a transação de quem chamou
+        status = cursor.connection.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return
+        in_transaction = status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        try:
+            # Cursor cru da conexão: não passa novamente pela instrumentação
+            with psycopg2.extensions.connection.cursor(cursor.connection) as explain_cursor:
+                if in_transaction:
+                    explain_cursor.execute("SAVEPOINT mlm_explain")
+                try:
+                    explain_cursor.execute(f"EXPLAIN ({options}) ".encode('utf-8') + bound_query)
+                    entry['plan'] = explain_cursor.fetchone()[0]
+                except Exception:
+                    if in_transaction:
+                        explain_cursor.execute("ROLLBACK TO SAVEPOINT mlm_explain")
+                    raise
+                finally:
+                    if in_transaction:
+                        explain_cursor.execute("RELEASE SAVEPOINT mlm_explain")
+            entry['explain_mode'] = mode
+            EXPLAINS_CAPTURED.inc(component=component, result='captured')
+        except Exception as e:
+            entry['explain_error'] = str(e)
+            EXPLAINS_CAPTURED.inc(component=component, result='failed')
+            logger.warning(f"Erro ao capturar EXPLAIN: {e}")
+
+    def entries(self, limit=None):
+        """Consultas lentas mais recentes primeiro"""
+        items = list(self._entries)
+        items.reverse()
+        return items[:limit] if limit else items
+
+    def stats(self, limit=50):
+        """Instruções ordenadas por tempo total"""
+        with self._lock:
+            rows = [
+                {
+                    'fingerprint': key,
+                    'calls': data['calls'],
+                    'total_ms': round(data['total_ms'], 3),
+                    'avg_ms': round(data['total_ms'] / data['calls'], 3) if data['calls'] else 0.0,
+                    'max_ms': round(data['max_ms'], 3),
+                    'slow_calls': data['slow_calls'],
+                    'components': sorted(data['components'])
+                }
+                for key, data in self._stats.items()
+            ]
+        rows.sort(key=lambda row: row['total_ms'], reverse=True)
+        return rows[:limit]
+
+    def settings(self):
+        return {
+            'threshold_ms': self.threshold_ms,
+            'sample_rate': self.sample_rate,
+            'capacity': self._entries.maxlen,
+            'explain': self.explain
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats.clear()
+            self._fingerprints.clear()
+
+
+# Log global do processo (configurado no main.py)
+query_log = SlowQueryLog()
+
+
+class _InstrumentedCursorMixin:
+    """Mede execute/executemany e repassa ao log de consultas"""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        result = super().execute(query, vars)
+        self.connection.query_log.observe(self, self.connection.component, query, time.perf_counter() - start)
+        return result
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        result = super().executemany(query, vars_list)
+        self.connection.query_log.observe(self, self.connection.component, query, time.perf_counter() - start)
+        return result
+
+
+_cursor_classes = {}
+_cursor_classes_lock = threading.Lock()
+
+
+def _instrumented_cursor_class(base):
+    with _cursor_classes_lock:
+        cls = _cursor_classes.get(base)
+        if cls is None:
+            cls = type(f"Instrumented{base.__name__}", (_InstrumentedCursorMixin, base), {})
+            _cursor_classes[base] = cls
+        return cls
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Conexão cujos cursores são instrumentados (preserva cursor_factory)"""
+
+    component = 'unknown'
+    query_log = query_log
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _instrumented_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+
+def instrumented_connect(dsn, component, log=None, **kwargs):
+    """Abre conexão psycopg2 instrumentada para o componente informado"""
+    conn = psycopg2.connect(dsn, connection_factory=InstrumentedConnection, **kwargs)
+    conn.component = component
+    if log is not None:
+        conn.query_log = log
+    return conn
@@ -0,0 +1,198 @@
+# Roteamento de leituras para réplicas do banco MLM
+#
+# Leituras da API vão para uma réplica saudável com atraso de replicação
+# abaixo do limite, em rodízio; sem réplica elegível (todas caídas ou
+# atrasadas) a leitura volta ao primário. Escritas nunca passam por aqui.
+# Saúde e atraso são verificados no caminho da leitura, no máximo a cada
+# check_interval segundos por réplica (sem thread própria). A verificação roda
+# fora do lock do roteador e a conexão tem connect_timeout, então uma réplica
+# inalcançável atrasa só a requisição que a verifica.
+#
+# Atraso: réplica com receptor de WAL ativo que já aplicou todo o WAL recebido
+# está em dia (0), mesmo que o primário esteja ocioso; senão, agora - horário da
+# última transação aplicada. Sem receptor de WAL (réplica desconectada do
+# primário) o WAL recebido não diz nada sobre o primário, então vale sempre o
+# horário da última transação aplicada, e sem transação aplicada a réplica
+# fica fora. Instância que não está em recovery (ex.: segundo PostgreSQL local
+# em testes) tem atraso 0.
+
+import threading
+import time
+import logging
+
+import psycopg2
+
+from src.models.metrics import registry
+from src.models.query_log import instrumented_connect
+
+logger = logging.getLogger(__name__)
+
+# status só é visível com pg_read_all_stats; sem o privilégio a linha do
+# receptor existe (pid) com status nulo e é tratada como conectada
+REPLICA_LAG_QUERY = """
+    SELECT
+        CASE
+            WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN receiving AND pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        END,
+        NOT pg_is_in_recovery() OR receiving
+    FROM (
+        SELECT EXISTS (
+            SELECT 1 FROM pg_stat_wal_receiver WHERE COALESCE(status, 'streaming') = 'streaming'
+        ) AS receiving
+    ) wal_receiver
+"""
+CONNECT_TIMEOUT = 3  # segundos
+
+DB_READS = registry.counter(
+    'mlm_db_reads_total',
+    'Leituras da API por destino (réplica, primário ou fallback para o primário)',
+    ('target',)
+)
+REPLICA_LAG = registry.gauge(
+    'mlm_replica_lag_seconds',
+    'Atraso de replicação medido por réplica',
+    ('replica',)
+)
+REPLICA_HEALTHY = registry.gauge(
+    'mlm_replica_healthy',
+    'Réplica elegível para leituras (1 = sim)',
+    ('replica',)
+)
+
+
+class Replica:
+    """Conexão de leitura com estado de saúde e atraso"""
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.connection = None
+        self.healthy = False
+        self.lag_seconds = None
+        self.receiving = None  # receptor de WAL ativo na última verificação
+        self.checked_at = 0.0
+        self.checking = False  # verificação em andamento (fora do lock do roteador)
+        self.last_error = None
+
+    def status(self):
+        return {
+            'name': self.name,
+            'healthy': self.healthy,
+            'lag_seconds': self.lag_seconds,
+            'wal_receiver': self.receiving,
+            'connected': bool(self.connection and not self.connection.closed),
+            'last_error': self.last_error
+        }
+
+
+class ReplicaRouter:
+    """Escolhe a réplica de cada leitura (None = usar o primário)"""
+
+    def __init__(self, urls, max_lag=10.0, check_interval=5.0, connect_timeout=CONNECT_TIMEOUT):
+        self.replicas = [Replica(f"replica-{i}", url) for i, url in enumerate(urls)]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.connect_timeout = connect_timeout
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _check(self, replica):
+        """Reconecta se preciso e mede o atraso de replicação"""
+        replica.checked_at = time.monotonic()
+        try:
+            if replica.connection is None or replica.connection.closed:
+                connection = instrumented_connect(
+                    replica.url, 'mlm_replica', connect_timeout=self.connect_timeout
+                )
+                connection.autocommit = True
+                replica.connection = connection
+            with replica.connection.cursor() as cursor:
+                cursor.execute(REPLICA_LAG_QUERY)
+                lag, receiving = cursor.fetchone()
+            replica.receiving = receiving
+            if lag is None:
+                # Sem receptor de WAL e sem transação aplicada: atraso desconhecido
+                replica.lag_seconds = None
+                replica.healthy = False
+                replica.last_error = "sem receptor de WAL e sem transação aplicada"
+            else:
+                lag = float(lag)
+                replica.lag_seconds = lag
+                replica.healthy = lag <= self.max_lag
+                if replica.healthy:
+                    replica.last_error = None
+                else:
+                    replica.last_error = f"atraso de {lag:.1f}s" + ('' if receiving else ' (sem receptor de WAL)')
+                REPLICA_LAG.set(lag, replica=replica.name)
+        except Exception as e:
+            self._mark_down(replica, e)
+        REPLICA_HEALTHY.set(1 if replica.healthy else 0, replica=replica.name)
+
+    def _mark_down(self, replica, error):
+        if replica.healthy or replica.last_error is None:
+            logger.warning(f"Réplica {replica.name} indisponível: {error}")
+        replica.healthy = False
+        replica.last_error = str(error)
+        REPLICA_HEALTHY.set(0, replica=replica.name)
+
+    def acquire(self):
+        """Réplica elegível em rodízio (None quando nenhuma está saudável e em dia)"""
+        count = len(self.replicas)
+        offset = 0
+        checked = set()
+        while offset < count:
+            with self._lock:
+                replica = self.replicas[(self._next + offset) % count]
+                due = (
+                    replica.name not in checked and not replica.checking
+                    and time.monotonic() - replica.checked_at >= self.check_interval
+                )
+                if due:
+                    # Só esta requisição verifica; as demais usam o último estado
+                    replica.checking = True
+                elif replica.healthy:
+                    self._next = (self._next + offset + 1) % count
+                    return replica
+                else:
+                    offset += 1
+                    continue
+            checked.add(replica.name)
+            try:
+                self._check(replica)
+            finally:
+                with self._lock:
+                    replica.checking = False
+        return None
+
+    def mark_failed(self, replica, error):
+        """Erro de conexão durante a leitura: réplica sai até a próxima verificação"""
+        with self._lock:
+            self._mark_down(replica, error)
+            replica.checked_at = time.monotonic()
+
+    def status(self):
+        return {
+            'max_lag_seconds': self.max_lag,
+            'replicas': [replica.status() for replica in self.replicas]
+        }
+
+    def close(self):
+        for replica in self.replicas:
+            if replica.connection is not None and not replica.connection.closed:
+                replica.connection.close()
+
+
+def run_on_replica(router, primary, query):
+    """Executa query(connection) em réplica; cai para o primário se não houver ou se falhar"""
+    replica = router.acquire() if router else None
+    if replica is not None:
+        try:
+            result = query(replica.connection)
+            DB_READS.inc(target=replica.name)
+            return result
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            router.mark_failed(replica, e)
+    DB_READS.inc(target='fallback' if router else 'primary')
+    return query(primary)
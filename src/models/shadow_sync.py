@@ -0,0 +1,213 @@
+# Sincronização sombra (dry-run): valida um motor de estatísticas contra mlm_levels
+#
+# Extrai tracked e constrói a hierarquia como a sincronização normal, mas o
+# cálculo N1-N5 é feito pelo motor escolhido no registro STATS_ENGINES e
+# nada é gravado (sem geração, sem log, sem baseline). Para cada afiliado, as
+# contagens calculadas (N1..N5, total N1-N5 e além de N5) viram um checksum
+# no mesmo formato do que o banco calcula sobre mlm_levels; só os afiliados
+# com checksum diferente (ou ausentes de um dos lados) têm as linhas lidas
+# para a amostra do relatório.
+#
+# mlm_levels reflete a última geração publicada: indicações feitas depois
+# dela aparecem como divergência. Para validar um motor, rodar logo após uma
+# sincronização completa (ou comparar o número de divergências com o de uma
+# sombra do motor atual).
+
+import functools
+import hashlib
+import time
+from datetime import datetime
+import logging
+
+import psycopg2.extras
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SHADOW_RUNS = registry.counter(
+    'mlm_shadow_sync_total',
+    'Sincronizações sombra por motor e resultado',
+    ('engine', 'result')
+)
+SHADOW_MISMATCHES = registry.gauge(
+    'mlm_shadow_sync_mismatches',
+    'Afiliados divergentes na última sincronização sombra por motor',
+    ('engine',)
+)
+
+# Motores de estatísticas N1-N5: nome -> função(service, global_hierarchy)
+# devolvendo {affiliate_id: stats} com level_counts, total_n1_to_n5 e beyond_n5
+STATS_ENGINES = {
+    'recursive': lambda service, global_hierarchy: service.calculate_individual_n1_to_n5_stats(global_hierarchy)
+}
+DEFAULT_ENGINE = 'recursive'
+
+
+def register_stats_engine(name, func):
+    """Registra um motor alternativo para validação pela sincronização sombra"""
+    STATS_ENGINES[name] = func
+
+
+def level_checksum(counts, total, beyond):
+    """md5 das linhas level 0..5 (mesmo texto que PERSISTED_CHECKSUMS monta no banco)"""
+    parts = [f"0:{total}:{beyond}"] + [f"{level}:{counts.get(level, 0)}:0" for level in range(1, 6)]
+    return hashlib.md5(','.join(parts).encode()).hexdigest()
+
+
+PERSISTED_CHECKSUMS = """
+    SELECT
+        affiliate_id,
+        md5(string_agg(
+            level || ':' || direct_count || ':' || CASE WHEN level = 0 THEN indirect_count ELSE 0 END,
+            ',' ORDER BY level
+        )) AS checksum
+    FROM mlm_levels
+    WHERE level BETWEEN 0 AND 5
+    GROUP BY affiliate_id
+"""
+
+PERSISTED_ROWS = """
+    SELECT affiliate_id, level, direct_count, indirect_count
+    FROM mlm_levels
+    WHERE affiliate_id = ANY(%s) AND level BETWEEN 0 AND 5
+    ORDER BY affiliate_id, level
+"""
+
+
+def _stats_counts(stats):
+    return {
+        'level_counts': {level: stats['level_counts'].get(level, 0) for level in range(1, 6)},
+        'total_n1_to_n5': stats['total_n1_to_n5'],
+        'beyond_n5': stats['beyond_n5']
+    }
+
+
+def _persisted_counts(rows):
+    counts = {'level_counts': {level: 0 for level in range(1, 6)}, 'total_n1_to_n5': 0, 'beyond_n5': 0}
+    for row in rows:
+        if row['level'] == 0:
+            counts['total_n1_to_n5'] = row['direct_count']
+            counts['beyond_n5'] = row['indirect_count']
+        else:
+            counts['level_counts'][row['level']] = row['direct_count']
+    return counts
+
+
+class ShadowSync:
+    """Executa o pipeline sem gravar e compara as contagens com mlm_levels"""
+
+    def __init__(self, service, engine=DEFAULT_ENGINE, sample_size=20):
+        if engine not in STATS_ENGINES:
+            raise ValueError(f"Motor desconhecido: {engine} (disponíveis: {', '.join(sorted(STATS_ENGINES))})")
+        self.service = service
+        self.engine = engine
+        self.sample_size = sample_size
+        self.timings = {}
+
+    def _timed(self, name, func):
+        start = time.perf_counter()
+        result = func()
+        self.timings[name] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run(self):
+        service = self.service
+        started_at = datetime.now()
+        report = {
+            'engine': self.engine,
+            'started_at': started_at.isoformat(),
+            'persisted_generation': service.current_generation,
+            'status': 'failed'
+        }
+        try:
+            tracked_data = self._timed('extract', service.get_tracked_data)
+            report['tracked_rows'] = len(tracked_data)
+            global_hierarchy = self._timed('build_hierarchy', functools.partial(service.build_infinite_hierarchy, tracked_data))
+            del tracked_data
+            engine = STATS_ENGINES[self.engine]
+            individual_stats = self._timed('engine', functools.partial(engine, service, global_hierarchy))
+            persisted = self._timed('read_persisted', self._persisted_checksums)
+            report.update(self._compare(individual_stats, persisted))
+            report['status'] = 'completed'
+        except Exception as e:
+            report['error'] = str(e)
+            SHADOW_RUNS.inc(engine=self.engine, result='failed')
+            logger.error(f"Erro na sincronização sombra ({self.engine}): {e}")
+            raise
+        finally:
+            # Tempo do motor em produção na última sincronização, para comparação
+            self.timings['reference_engine'] = service.stage_durations.get('calculate_stats')
+            report['timings'] = self.timings
+            report['finished_at'] = datetime.now().isoformat()
+            service.shadow_report = report
+
+        SHADOW_MISMATCHES.set(report['mismatched'], engine=self.engine)
+        SHADOW_RUNS.inc(engine=self.engine, result='match' if report['ok'] else 'mismatch')
+        logger.info(
+            f"Sincronização sombra ({self.engine}): {report['matched']} afiliados iguais, "
+            f"{report['mismatched']} divergentes em {report['affiliates_computed']} calculados"
+        )
+        return report
+
+    def _persisted_checksums(self):
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute(PERSISTED_CHECKSUMS)
+            return dict(cursor.fetchall())
+
+    def _compare(self, individual_stats, persisted):
+        mismatched = []
+        missing_in_db = []
+        matched = 0
+        for affiliate_id, stats in individual_stats.items():
+            checksum = persisted.pop(affiliate_id, None)
+            if checksum is None:
+                missing_in_db.append(affiliate_id)
+            elif checksum == level_checksum(stats['level_counts'], stats['total_n1_to_n5'], stats['beyond_n5']):
+                matched += 1
+            else:
+                mismatched.append(affiliate_id)
+        # O que sobrou em persisted não foi calculado pelo motor
+        missing_in_engine = sorted(persisted)
+
+        sample = self._sample(individual_stats, sorted(mismatched), sorted(missing_in_db), missing_in_engine)
+        total_mismatched = len(mismatched) + len(missing_in_db) + len(missing_in_engine)
+        return {
+            'affiliates_computed': len(individual_stats),
+            'affiliates_persisted': matched + len(mismatched) + len(missing_in_engine),
+            'matched': matched,
+            'mismatched': total_mismatched,
+            'different_counts': len(mismatched),
+            'missing_in_db': len(missing_in_db),
+            'missing_in_engine': len(missing_in_engine),
+            'ok': total_mismatched == 0,
+            'sample': sample
+        }
+
+    def _sample(self, individual_stats, mismatched, missing_in_db, missing_in_engine):
+        """Até sample_size afiliados divergentes com as contagens dos dois lados"""
+        chosen = (
+            [(affiliate_id, 'different_counts') for affiliate_id in mismatched]
+            + [(affiliate_id, 'missing_in_db') for affiliate_id in missing_in_db]
+            + [(affiliate_id, 'missing_in_engine') for affiliate_id in missing_in_engine]
+        )[:self.sample_size]
+        if not chosen:
+            return []
+
+        rows_by_affiliate = {}
+        with self.service.mlm_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute(PERSISTED_ROWS, ([affiliate_id for affiliate_id, _ in chosen],))
+            for row in cursor.fetchall():
+                rows_by_affiliate.setdefault(row['affiliate_id'], []).append(row)
+
+        sample = []
+        for affiliate_id, reason in chosen:
+            stats = individual_stats.get(affiliate_id)
+            rows = rows_by_affiliate.get(affiliate_id)
+            sample.append({
+                'affiliate_id': affiliate_id,
+                'reason': reason,
+                'persisted': _persisted_counts(rows) if rows else None,
+                'computed': _stats_counts(stats) if stats else None
+            })
+        return sample
@@ -0,0 +1,557 @@
+# Sincronização particionada por rede raiz entre vários nós
+#
+# Cada rede (componente conexo das indicações em tracked, identificado pela
+# menor raiz) vai para um shard pelo CRC32 do seu ID. Um nó coordenador,
+# eleito por advisory lock no banco MLM, abre a geração, exporta um snapshot do
+# banco da operação (pg_export_snapshot) e cria uma linha por shard em
+# mlm_sync_shards. O coordenador lê só as arestas de tracked no snapshot,
+# calcula uma vez o shard de cada afiliado e grava em mlm_sync_shard_affiliates.
+# Qualquer nó (inclusive o coordenador) reivindica shards por advisory lock, lê
+# no snapshot exportado apenas as indicações dos afiliados do seu shard (filtro
+# no banco), calcula as redes e grava as linhas em tabelas de staging. Quando todos os shards
+# concluem, o coordenador troca as linhas publicadas em uma única transação.
+#
+# Re-parent entre shards: todos os nós leem o mesmo snapshot, então cada rede
+# cai em exatamente um shard; uma subárvore que mudou de rede sai das linhas do
+# shard antigo e entra nas do novo, e a publicação remove e grava as duas
+# partes na mesma transação (nunca há geração publicada com a subárvore
+# duplicada ou ausente). Worker que cai libera o advisory lock junto com a
+# conexão e o shard volta a ser reivindicável.
+
+import os
+import socket
+import time
+import zlib
+from datetime import datetime
+import logging
+
+import psycopg2
+import psycopg2.extras
+
+from src.models.metrics import (
+    registry, track_stage, SYNC_RUNS, SYNC_STAGE_DURATION, SYNC_LAST_SUCCESS
+)
+from src.models.query_log import instrumented_connect
+from src.models.leaderboard import persist_from_staging
+from src.models.affiliate_stats import publish_from_staging as publish_affiliate_stats
+
+logger = logging.getLogger(__name__)
+
+# Classes de advisory lock (pg_try_advisory_lock(classe, objeto))
+COORDINATOR_LOCK = 0x4D4C4D01
+SHARD_LOCK = 0x4D4C4D02
+
+SHARDS_PROCESSED = registry.counter(
+    'mlm_sync_shards_total',
+    'Shards da sincronização particionada processados por este nó',
+    ('status',)
+)
+SYNC_COORDINATOR = registry.gauge(
+    'mlm_sync_coordinator',
+    'Este nó coordena a sincronização particionada (1 = sim)'
+)
+
+
+def shard_of(network_id, shard_count):
+    """Shard estável de uma rede (CRC32 do ID da raiz)"""
+    return zlib.crc32(str(network_id).encode()) % shard_count
+
+
+# Arestas de tracked lidas pelo coordenador (mesmos filtros de get_tracked_data)
+TRACKED_EDGES_QUERY = """
+    SELECT user_afil, user_id
+    FROM tracked
+    WHERE tracked_type_id = 1
+        AND user_afil IS NOT NULL
+        AND user_id IS NOT NULL
+"""
+
+
+def assign_networks(edges):
+    """Rede de cada usuário: componente conexo das indicações, identificado pela menor raiz
+
+    edges: pares (affiliate_id, referred_user_id).
+    """
+    parent = {}
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    referred = set()
+    for affiliate_id, referred_user_id in edges:
+        parent.setdefault(affiliate_id, affiliate_id)
+        parent.setdefault(referred_user_id, referred_user_id)
+        referred.add(referred_user_id)
+        a, b = find(affiliate_id), find(referred_user_id)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    # Rede sem raiz (ciclo) fica com o menor ID do componente
+    network_root = {}
+    for node in parent:
+        if node not in referred:
+            component = find(node)
+            network_root[component] = min(network_root.get(component, node), node)
+
+    return {node: network_root.get(find(node), find(node)) for node in parent}
+
+
+def assign_shards(edges, shard_count):
+    """Shard de cada afiliado (quem tem indicações), pelo shard da sua rede"""
+    edges = list(edges)
+    networks = assign_networks(edges)
+    shards = {}
+    affiliates = {}
+    for affiliate_id, _ in edges:
+        if affiliate_id in affiliates:
+            continue
+        network_id = networks[affiliate_id]
+        if network_id not in shards:
+            shards[network_id] = shard_of(network_id, shard_count)
+        affiliates[affiliate_id] = shards[network_id]
+    return affiliates
+
+
+class ShardedSync:
+    """Coordena e executa a sincronização particionada de um MLMSyncService"""
+
+    def __init__(self, service, shard_count, worker_id=None, shard_timeout=1800, poll_interval=2.0):
+        self.service = service
+        self.shard_count = shard_count
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.shard_timeout = shard_timeout
+        self.poll_interval = poll_interval
+
+        self.is_coordinator = False
+        self.shards_processed = 0
+        self.last_generation = None
+        self.last_shard_states = {}
+
+    # Ciclo
+
+    def run_cycle(self, force=False):
+        """Coordena uma geração quando devida (só o coordenador) e processa shards pendentes
+
+        Devolve a geração publicada ou o número de shards processados (0 = nada a fazer).
+        """
+        if self._acquire_coordinator() and (force or self._generation_due()):
+            return self.run_generation()
+        return self.process_pending()
+
+    def _generation_due(self):
+        last_sync = self.service.last_sync
+        return last_sync is None or (datetime.now() - last_sync).total_seconds() >= self.service.sync_interval
+
+    def _acquire_coordinator(self):
+        """Advisory lock de sessão: fica com este nó até a conexão cair"""
+        if not self.is_coordinator:
+            with self.service.mlm_conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s, 0)", (COORDINATOR_LOCK,))
+                self.is_coordinator = cursor.fetchone()[0]
+            if self.is_coordinator:
+                SYNC_COORDINATOR.set(1)
+                logger.info(f"Nó {self.worker_id} assumiu a coordenação da sincronização particionada")
+                self._abandon_orphans()
+        return self.is_coordinator
+
+    def _abandon_orphans(self):
+        """Gerações particionadas em andamento ficaram de um coordenador anterior"""
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE mlm_generations
+                SET status = 'failed', error_message = 'coordenador interrompido',
+                    completed_at = CURRENT_TIMESTAMP
+                WHERE status = 'running' AND shard_count IS NOT NULL
+                RETURNING generation
+            """)
+            for (generation,) in cursor.fetchall():
+                self._drop_staging(generation)
+                logger.warning(f"Geração particionada {generation} abandonada por coordenador anterior")
+
+    # Coordenação
+
+    def run_generation(self):
+        """Abre geração, aguarda todos os shards e publica (executado pelo coordenador)"""
+        service = self.service
+        start_time = datetime.now()
+        generation = None
+        export_conn = None
+        try:
+            generation = service.begin_generation('sharded_infinite_hierarchy')
+            self.last_generation = generation
+
+            # Transação mantida aberta até a publicação: shards importam o snapshot
+            export_conn = instrumented_connect(service.operation_db_url, 'sync_snapshot')
+            export_conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            with export_conn.cursor() as cursor:
+                cursor.execute("SELECT pg_export_snapshot()")
+                snapshot_id = cursor.fetchone()[0]
+
+            # Antes de criar os shards: workers só os reivindicam com a atribuição gravada
+            with track_stage('shard_assign') as stage:
+                stage.rows = self._assign_shards(generation, export_conn)
+
+            with service.mlm_conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE mlm_generations SET shard_count = %s, operation_snapshot = %s WHERE generation = %s",
+                    (self.shard_count, snapshot_id, generation)
+                )
+                psycopg2.extras.execute_values(
+                    cursor,
+                    "INSERT INTO mlm_sync_shards (generation, shard) VALUES %s",
+                    [(generation, shard) for shard in range(self.shard_count)]
+                )
+            logger.info(f"Geração {generation} aberta com {self.shard_count} shards (snapshot {snapshot_id})")
+
+            self._await_shards(generation)
+
+            with track_stage('publish_shards') as stage:
+                affiliates, persisted = self._publish(generation)
+                stage.rows = persisted
+
+            # Linhas publicadas foram trocadas fora do baseline deste nó
+            service.baseline_hierarchy = None
+            service.baseline_levels = None
+            service.engine = None
+            service.leaderboard.clear()
+
+            service.log_sync_operation(
+                sync_type='sharded_infinite_hierarchy',
+                records_processed=affiliates,
+                records_updated=persisted,
+                status='completed'
+            )
+            service.last_sync = datetime.now()
+            duration = (service.last_sync - start_time).total_seconds()
+            service.last_sync_duration = duration
+            SYNC_STAGE_DURATION.observe(duration, stage='total')
+            SYNC_RUNS.inc(status='completed')
+            SYNC_LAST_SUCCESS.set(time.time())
+            logger.info(f"Geração particionada {generation} publicada em {duration:.2f}s - {affiliates} afiliados")
+            return generation
+
+        except Exception as e:
+            logger.error(f"Erro na sincronização particionada: {e}")
+            SYNC_RUNS.inc(status='failed')
+            service.fail_generation(generation, 'failed', str(e))
+            if generation is not None:
+                self._drop_staging(generation)
+            service.log_sync_operation(
+                sync_type='sharded_infinite_hierarchy',
+                status='failed',
+                error_message=str(e)
+            )
+            raise
+        finally:
+            if export_conn is not None:
+                export_conn.close()
+
+    def _assign_shards(self, generation, export_conn):
+        """Calcula rede -> shard uma vez, no snapshot exportado, e grava por afiliado"""
+        with export_conn.cursor() as cursor:
+            cursor.execute(TRACKED_EDGES_QUERY)
+            affiliates = assign_shards(cursor.fetchall(), self.shard_count)
+        with self.service.mlm_conn.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO mlm_sync_shard_affiliates (generation, shard, affiliate_id) VALUES %s",
+                [(generation, shard, affiliate_id) for affiliate_id, shard in affiliates.items()],
+                page_size=5000
+            )
+        return len(affiliates)
+
+    def _shard_affiliates(self, generation, shard):
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT affiliate_id FROM mlm_sync_shard_affiliates WHERE generation = %s AND shard = %s",
+                (generation, shard)
+            )
+            return [affiliate_id for (affiliate_id,) in cursor.fetchall()]
+
+    def _await_shards(self, generation):
+        """Processa shards localmente enquanto aguarda os demais nós"""
+        deadline = time.monotonic() + self.shard_timeout
+        while True:
+            self.process_pending(generation)
+            states = self.shard_states(generation)
+            self.last_shard_states = states
+            if states.get('failed'):
+                raise RuntimeError(f"Shard falhou na geração {generation}: {self._shard_error(generation)}")
+            if states.get('completed', 0) == self.shard_count:
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Shards da geração {generation} não concluíram em {self.shard_timeout}s: {states}")
+            time.sleep(self.poll_interval)
+
+    def shard_states(self, generation):
+        """Quantidade de shards por status"""
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT status, COUNT(*) FROM mlm_sync_shards WHERE generation = %s GROUP BY status",
+                (generation,)
+            )
+            return dict(cursor.fetchall())
+
+    def _shard_error(self, generation):
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT shard, worker, error_message FROM mlm_sync_shards
+                WHERE generation = %s AND status = 'failed'
+                ORDER BY shard LIMIT 1
+            """, (generation,))
+            row = cursor.fetchone()
+        return f"shard {row[0]} ({row[1]}): {row[2]}" if row else None
+
+    def _publish(self, generation):
+        """Troca as linhas publicadas pelas do staging em uma transação"""
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute("""
+                    DELETE FROM mlm_hierarchy h
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM mlm_hierarchy_staging s
+                        WHERE s.generation = %s AND s.affiliate_id = h.affiliate_id
+                    )
+                """, (generation,))
+                persisted = cursor.rowcount
+                cursor.execute("""
+                    DELETE FROM mlm_levels l
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM mlm_levels_staging s
+                        WHERE s.generation = %s AND s.affiliate_id = l.affiliate_id AND s.level = l.level
+                    )
+                """, (generation,))
+                persisted += cursor.rowcount
+
+                # Linhas iguais às publicadas não são regravadas
+                cursor.execute("""
+                    INSERT INTO mlm_hierarchy (
+                        affiliate_id, parent_id, level, path,
+                        total_downline, direct_referrals, status,
+                        created_at, updated_at
+                    )
+                    SELECT affiliate_id, parent_id, level, path,
+                           total_downline, direct_referrals, 'active',
+                           CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+                    FROM mlm_hierarchy_staging
+                    WHERE generation = %s
+                    ON CONFLICT (affiliate_id) DO UPDATE SET
+                        parent_id = EXCLUDED.parent_id,
+                        level = EXCLUDED.level,
+                        path = EXCLUDED.path,
+                        total_downline = EXCLUDED.total_downline,
+                        direct_referrals = EXCLUDED.direct_referrals,
+                        status = EXCLUDED.status,
+                        updated_at = EXCLUDED.updated_at
+                    WHERE (mlm_hierarchy.parent_id, mlm_hierarchy.level, mlm_hierarchy.path,
+                           mlm_hierarchy.total_downline, mlm_hierarchy.direct_referrals, mlm_hierarchy.status)
+                        IS DISTINCT FROM
+                          (EXCLUDED.parent_id, EXCLUDED.level, EXCLUDED.path,
+                           EXCLUDED.total_downline, EXCLUDED.direct_referrals, EXCLUDED.status)
+                """, (generation,))
+                persisted += cursor.rowcount
+                cursor.execute("""
+                    INSERT INTO mlm_levels (
+                        affiliate_id, level, direct_count, indirect_count,
+                        total_volume, commission_rate, commission_earned,
+                        new_1d, new_7d, new_30d, last_calculated
+                    )
+                    SELECT affiliate_id, level, direct_count, indirect_count,
+                           total_volume, commission_rate, commission_earned,
+                           new_1d, new_7d, new_30d, last_calculated
+                    FROM mlm_levels_staging
+                    WHERE generation = %s
+                    ON CONFLICT (affiliate_id, level) DO UPDATE SET
+                        direct_count = EXCLUDED.direct_count,
+                        indirect_count = EXCLUDED.indirect_count,
+                        total_volume = EXCLUDED.total_volume,
+                        commission_rate = EXCLUDED.commission_rate,
+                        commission_earned = EXCLUDED.commission_earned,
+                        new_1d = EXCLUDED.new_1d,
+                        new_7d = EXCLUDED.new_7d,
+                        new_30d = EXCLUDED.new_30d,
+                        last_calculated = EXCLUDED.last_calculated
+                    WHERE (mlm_levels.direct_count, mlm_levels.indirect_count, mlm_levels.total_volume,
+                           mlm_levels.commission_rate, mlm_levels.commission_earned,
+                           mlm_levels.new_1d, mlm_levels.new_7d, mlm_levels.new_30d)
+                        IS DISTINCT FROM
+                          (EXCLUDED.direct_count, EXCLUDED.indirect_count, EXCLUDED.total_volume,
+                           EXCLUDED.commission_rate, EXCLUDED.commission_earned,
+                           EXCLUDED.new_1d, EXCLUDED.new_7d, EXCLUDED.new_30d)
+                """, (generation,))
+                persisted += cursor.rowcount
+
+                cursor.execute(
+                    "SELECT COUNT(*) FROM mlm_hierarchy_staging WHERE generation = %s",
+                    (generation,)
+                )
+                affiliates = cursor.fetchone()[0]
+                persisted += publish_affiliate_stats(cursor, generation)
+                persist_from_staging(cursor, generation, self.service.leaderboard.size)
+                self.service.publish_generation(generation, affiliates)
+                self._drop_staging(generation, cursor)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+        logger.info(f"Geração {generation}: {persisted} linhas alteradas na publicação")
+        return affiliates, persisted
+
+    def _drop_staging(self, generation, cursor=None):
+        if cursor is None:
+            try:
+                with self.service.mlm_conn.cursor() as cursor:
+                    self._drop_staging(generation, cursor)
+            except Exception as e:
+                logger.error(f"Erro ao limpar staging da geração {generation}: {e}")
+            return
+        cursor.execute("DELETE FROM mlm_hierarchy_staging WHERE generation = %s", (generation,))
+        cursor.execute("DELETE FROM mlm_levels_staging WHERE generation = %s", (generation,))
+        cursor.execute("DELETE FROM mlm_sync_shard_affiliates WHERE generation = %s", (generation,))
+
+    # Execução de shards (qualquer nó)
+
+    def process_pending(self, generation=None):
+        """Processa shards disponíveis: pendentes ou de workers que caíram"""
+        processed = 0
+        while True:
+            claimed = self._claim_shard(generation)
+            if claimed is None:
+                return processed
+            claimed_generation, shard, snapshot_id, anchor = claimed
+            try:
+                self._process_shard(claimed_generation, shard, snapshot_id, anchor)
+            finally:
+                self._release_shard(shard)
+            processed += 1
+
+    def _claim_shard(self, generation=None):
+        """Reivindica um shard; lock livre em shard 'running' indica worker que caiu"""
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT s.generation, s.shard, g.operation_snapshot, g.started_at
+                FROM mlm_sync_shards s
+                JOIN mlm_generations g ON g.generation = s.generation
+                WHERE g.status = 'running'
+                    AND s.status IN ('pending', 'running')
+                    AND (%s::bigint IS NULL OR s.generation = %s::bigint)
+                ORDER BY s.generation, s.status = 'running', s.shard
+            """, (generation, generation))
+            candidates = cursor.fetchall()
+
+            for candidate_generation, shard, snapshot_id, anchor in candidates:
+                cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (SHARD_LOCK, shard))
+                if not cursor.fetchone()[0]:
+                    continue
+                cursor.execute("""
+                    UPDATE mlm_sync_shards
+                    SET status = 'running', worker = %s, started_at = CURRENT_TIMESTAMP, error_message = NULL
+                    WHERE generation = %s AND shard = %s AND status IN ('pending', 'running')
+                    RETURNING shard
+                """, (self.worker_id, candidate_generation, shard))
+                if cursor.fetchone():
+                    return candidate_generation, shard, snapshot_id, anchor
+                self._release_shard(shard)
+        return None
+
+    def _release_shard(self, shard):
+        with self.service.mlm_conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s, %s)", (SHARD_LOCK, shard))
+
+    def _process_shard(self, generation, shard, snapshot_id, anchor):
+        """Calcula as redes do shard e grava as linhas no staging da geração"""
+        service = self.service
+        logger.info(f"Processando shard {shard}/{self.shard_count} da geração {generation}")
+        try:
+            with track_stage('shard_extract') as stage:
+                # Só as indicações dos afiliados do shard (atribuição do coordenador)
+                affiliate_ids = self._shard_affiliates(generation, shard)
+                records = service.get_tracked_data(snapshot_id, affiliate_ids) if affiliate_ids else []
+                stage.rows = len(records)
+
+            global_hierarchy = service.build_infinite_hierarchy(records) if records else {}
+            volumes = {}
+            if service.volume_source and global_hierarchy:
+                # Mesmo snapshot de tracked, agregando só os usuários do shard
+                volumes = service.get_user_volumes(global_hierarchy, snapshot_id, only_users=True)
+            # Janelas ancoradas no início da geração (iguais em todos os shards)
+            windows, _ = service.compute_growth_windows(records, anchor)
+
+            with track_stage('shard_calculate') as stage:
+                individual_stats = service.calculate_individual_n1_to_n5_stats(global_hierarchy, volumes, windows)
+                stage.rows = len(individual_stats)
+
+            with track_stage('shard_stage') as stage:
+                stage.rows = self._write_staging(
+                    generation, shard,
+                    service.hierarchy_rows(global_hierarchy),
+                    service.level_rows(individual_stats)
+                )
+
+            self._finish_shard(generation, shard, 'completed', affiliates=len(global_hierarchy))
+            self.shards_processed += 1
+            SHARDS_PROCESSED.inc(status='completed')
+            logger.info(f"Shard {shard} da geração {generation} concluído: {len(global_hierarchy)} afiliados")
+
+        except Exception as e:
+            logger.error(f"Erro no shard {shard} da geração {generation}: {e}")
+            SHARDS_PROCESSED.inc(status='failed')
+            self._finish_shard(generation, shard, 'failed', error_message=str(e))
+
+    def _write_staging(self, generation, shard, hierarchy_rows, level_rows):
+        with self.service.mlm_conn.cursor() as cursor:
+            # Reprocessamento de shard de worker que caiu
+            cursor.execute(
+                "DELETE FROM mlm_hierarchy_staging WHERE generation = %s AND shard = %s",
+                (generation, shard)
+            )
+            cursor.execute(
+                "DELETE FROM mlm_levels_staging WHERE generation = %s AND shard = %s",
+                (generation, shard)
+            )
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO mlm_hierarchy_staging (
+                    generation, shard, affiliate_id, parent_id, level, path,
+                    total_downline, direct_referrals
+                ) VALUES %s
+            """, [
+                (generation, shard, affiliate_id, *row)
+                for affiliate_id, row in hierarchy_rows.items()
+            ], page_size=1000)
+            level_values = self.service.level_values(level_rows)
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO mlm_levels_staging (
+                    generation, shard, affiliate_id, level, direct_count, indirect_count,
+                    total_volume, commission_rate, commission_earned,
+                    new_1d, new_7d, new_30d, last_calculated
+                ) VALUES %s
+            """, [(generation, shard, *values) for values in level_values], page_size=1000)
+        return len(hierarchy_rows) + len(level_values)
+
+    def _finish_shard(self, generation, shard, status, affiliates=None, error_message=None):
+        try:
+            with self.service.mlm_conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE mlm_sync_shards
+                    SET status = %s, affiliates = %s, error_message = %s, completed_at = CURRENT_TIMESTAMP
+                    WHERE generation = %s AND shard = %s
+                """, (status, affiliates, error_message, generation, shard))
+        except Exception as e:
+            logger.error(f"Erro ao registrar shard {shard} da geração {generation}: {e}")
+
+    def status(self):
+        return {
+            'shard_count': self.shard_count,
+            'worker_id': self.worker_id,
+            'coordinator': self.is_coordinator,
+            'shards_processed': self.shards_processed,
+            'last_generation': self.last_generation,
+            'last_shard_states': self.last_shard_states
+        }
@@ -0,0 +1,155 @@
+# Coalescência de leituras idênticas simultâneas (single-flight)
+#
+# Quando muitos usuários abrem a página do mesmo afiliado ao mesmo tempo (ou
+# logo após uma sincronização), cada requisição executaria a mesma consulta
+# no banco. Aqui a primeira requisição de uma chave (instância + método +
+# argumentos) executa a consulta e as que chegam enquanto ela está em
+# andamento aguardam e recebem o mesmo resultado: N requisições, uma consulta.
+#
+# Não é cache: ao terminar a consulta a chave sai da tabela e a próxima
+# requisição consulta de novo. O resultado é compartilhado entre threads e
+# deve ser tratado como somente leitura. Erros da consulta também são
+# repassados a quem aguardava.
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+import logging
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+FLIGHT_REQUESTS = registry.counter(
+    'mlm_single_flight_requests_total',
+    'Leituras por método e papel (leader executa, shared reaproveita, timeout desistiu de aguardar)',
+    ('method', 'role')
+)
+FLIGHT_IN_FLIGHT = registry.gauge(
+    'mlm_single_flight_in_flight',
+    'Consultas em andamento com requisições coalescidas possíveis por método',
+    ('method',)
+)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Uma consulta em andamento por chave; concorrentes idênticos aguardam o resultado"""
+
+    def __init__(self, enabled=True, wait_timeout=30.0, max_keys=200):
+        self.enabled = enabled
+        self.wait_timeout = wait_timeout  # segundos; depois disso o seguidor consulta sozinho
+        self.max_keys = max_keys  # chaves acompanhadas nas estatísticas (LRU)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._keys = OrderedDict()  # chave -> estatísticas
+
+    def configure(self, enabled=None, wait_timeout=None, max_keys=None):
+        with self._lock:
+            if enabled is not None:
+                self.enabled = enabled
+            if wait_timeout is not None:
+                self.wait_timeout = wait_timeout
+            if max_keys is not None:
+                self.max_keys = max_keys
+                while len(self._keys) > self.max_keys:
+                    self._keys.popitem(last=False)
+
+    def do(self, method, key, func):
+        """Executa func() uma vez por chave entre chamadas simultâneas"""
+        if not self.enabled:
+            return func()
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+            self._record(key, method, leader, call.waiters)
+
+        if leader:
+            FLIGHT_REQUESTS.inc(method=method, role='leader')
+            FLIGHT_IN_FLIGHT.inc(method=method)
+            try:
+                call.result = func()
+                return call.result
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.done.set()
+                FLIGHT_IN_FLIGHT.dec(method=method)
+
+        if not call.done.wait(self.wait_timeout):
+            FLIGHT_REQUESTS.inc(method=method, role='timeout')
+            with self._lock:
+                entry = self._keys.get(key)
+                if entry is not None:
+                    entry['timeouts'] += 1
+            logger.warning(f"Single-flight: {key} excedeu {self.wait_timeout}s; consultando sem coalescer")
+            return func()
+        FLIGHT_REQUESTS.inc(method=method, role='shared')
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _record(self, key, method, leader, waiters):
+        entry = self._keys.pop(key, None)
+        if entry is None:
+            entry = {'method': method, 'queries': 0, 'shared': 0, 'timeouts': 0, 'max_waiters': 0}
+        if leader:
+            entry['queries'] += 1
+        else:
+            entry['shared'] += 1
+            entry['max_waiters'] = max(entry['max_waiters'], waiters)
+        entry['last_at'] = time.time()
+        self._keys[key] = entry
+        if len(self._keys) > self.max_keys:
+            self._keys.popitem(last=False)
+
+    def stats(self, limit=50):
+        """Chaves mais coalescidas (shared - timeouts = consultas economizadas)"""
+        with self._lock:
+            keys = [{'key': key, **entry} for key, entry in self._keys.items()]
+            in_flight = len(self._calls)
+        keys.sort(key=lambda entry: (entry['shared'], entry['queries']), reverse=True)
+        return {
+            'enabled': self.enabled,
+            'wait_timeout': self.wait_timeout,
+            'max_keys': self.max_keys,
+            'in_flight': in_flight,
+            'keys': keys[:limit]
+        }
+
+    def reset(self):
+        with self._lock:
+            self._keys.clear()
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(method):
+    """Decorator: chamadas simultâneas com os mesmos argumentos compartilham a consulta"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            arguments = [repr(arg) for arg in args] + [f"{name}={value!r}" for name, value in sorted(kwargs.items())]
+            # id(self) separa instâncias (bancos distintos) que usam o mesmo single_flight;
+            # o líder mantém self vivo enquanto a chave está em andamento
+            key = f"{method}@{id(self):x}({', '.join(arguments)})"
+            return single_flight.do(method, key, lambda: func(self, *args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,378 @@
+# Snapshot binário da hierarquia calculada, compartilhado via mmap
+#
+# Formato (little-endian, seções alinhadas em 8 bytes):
+#   cabeçalho (64 bytes): magic, versão do formato, geração, data de criação,
+#                          número de nós, número de arestas, colunas de nível, CRC32
+#   ids            int64[n]        IDs ordenados (busca binária)
+#   parent         int32[n]        índice do pai em ids (-1 = raiz)
+#   child_offsets  int32[n + 1]    offsets CSR em children
+#   children       int32[arestas]  índices dos filhos diretos
+#   depth          int32[n]        nível global gravado pela sincronização (0 = não afiliado)
+#   levels         int32[n * 22]   N1..N5, total N1-N5, além de N5 e
+#                                  indicações novas N1..N5 em 1, 7 e 30 dias
+#
+# O arquivo é escrito de forma atômica e apontado por CURRENT. Cada processo web
+# abre o arquivo com mmap somente leitura: as páginas são compartilhadas pelo
+# sistema operacional, sem cópia por processo e sem consulta ao banco.
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+import logging
+
+from src.models.metrics import record_cache
+from src.models.hierarchy_engine import GROWTH_WINDOWS
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MLMSNAP\x00'
+FORMAT_VERSION = 3
+HEADER = struct.Struct('<8sIIQdQQIII4x')
+COUNT_COLUMNS = 7  # N1..N5, total N1-N5, além de N5
+LEVEL_COLUMNS = COUNT_COLUMNS + 5 * len(GROWTH_WINDOWS)  # + janelas N1..N5
+CURRENT_FILE = 'CURRENT'
+
+
+class SnapshotError(Exception):
+    """Snapshot ausente, corrompido ou de formato incompatível"""
+
+
+def _pad(size):
+    return (-size) % 8
+
+
+def _snapshot_name(generation):
+    return f"hierarchy-{generation:012d}.snap"
+
+
+def build_snapshot_arrays(global_hierarchy, individual_stats):
+    """Converte os dicts da sincronização nas seções do snapshot"""
+    parents = {}
+    for affiliate_id, data in global_hierarchy.items():
+        for child_id in data.get('children', []):
+            # Filhos não afiliados (folhas) só aparecem nas listas de children
+            parents.setdefault(child_id, affiliate_id)
+    for affiliate_id, data in global_hierarchy.items():
+        parents[affiliate_id] = data.get('parent_id')
+
+    ids = array('q', sorted(parents))
+    index = {node_id: i for i, node_id in enumerate(ids)}
+
+    parent = array('i', [-1]) * len(ids)
+    for node_id, parent_id in parents.items():
+        if parent_id is not None and parent_id in index:
+            parent[index[node_id]] = index[parent_id]
+
+    depth = array('i', [0]) * len(ids)
+    child_offsets = array('i', [0])
+    children = array('i')
+    levels = array('i', [0]) * (len(ids) * LEVEL_COLUMNS)
+    for i, node_id in enumerate(ids):
+        data = global_hierarchy.get(node_id)
+        if data:
+            children.extend(index[child] for child in data.get('children', []) if child in index)
+            depth[i] = data.get('global_level') or 0
+        child_offsets.append(len(children))
+
+        stats = individual_stats.get(node_id)
+        if stats:
+            base = i * LEVEL_COLUMNS
+            for level in range(1, 6):
+                levels[base + level - 1] = stats['level_counts'].get(level, 0)
+            levels[base + 5] = stats['total_n1_to_n5']
+            levels[base + 6] = stats['beyond_n5']
+            for window, (name, _) in enumerate(GROWTH_WINDOWS):
+                per_level = stats.get(f'level_{name}', {})
+                for level in range(1, 6):
+                    levels[base + COUNT_COLUMNS + 5 * window + level - 1] = per_level.get(level, 0)
+
+    return ids, parent, child_offsets, children, depth, levels
+
+
+def write_snapshot(directory, generation, global_hierarchy, individual_stats, keep=3):
+    """Grava snapshot da geração e atualiza CURRENT (escrita atômica)"""
+    if sys.byteorder != 'little':
+        raise SnapshotError("Snapshot suporta apenas plataformas little-endian")
+
+    os.makedirs(directory, exist_ok=True)
+    ids, parent, child_offsets, children, depth, levels = build_snapshot_arrays(global_hierarchy, individual_stats)
+
+    body = bytearray()
+    for section in (ids, parent, child_offsets, children, depth, levels):
+        data = section.tobytes()
+        body += data
+        body += b'\x00' * _pad(len(data))
+
+    checksum = zlib.crc32(body)
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, generation, time.time(),
+        len(ids), len(children), LEVEL_COLUMNS, 0, checksum
+    )
+
+    name = _snapshot_name(generation)
+    path = os.path.join(directory, name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    current_tmp = os.path.join(directory, f"{CURRENT_FILE}.tmp")
+    with open(current_tmp, 'w') as f:
+        f.write(name + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(current_tmp, os.path.join(directory, CURRENT_FILE))
+
+    _cleanup(directory, keep)
+    logger.info(f"Snapshot da geração {generation} gravado: {len(ids)} nós, {len(header) + len(body)} bytes")
+    return path
+
+
+def _cleanup(directory, keep):
+    """Remove snapshots antigos (leitores com mmap aberto não são afetados)"""
+    snapshots = sorted(f for f in os.listdir(directory) if f.startswith('hierarchy-') and f.endswith('.snap'))
+    for name in snapshots[:-keep] if keep else []:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError as e:
+            logger.warning(f"Erro ao remover snapshot antigo {name}: {e}")
+
+
+class HierarchySnapshot:
+    """Leitor zero-copy de um snapshot via mmap somente leitura"""
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self._parse(verify)
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def _parse(self, verify):
+        if len(self._mmap) < HEADER.size:
+            raise SnapshotError(f"Snapshot truncado: {self.path}")
+
+        (magic, version, _flags, generation, created_at, node_count,
+         edge_count, level_columns, _reserved, checksum) = HEADER.unpack_from(self._mmap, 0)
+
+        if magic != MAGIC:
+            raise SnapshotError(f"Arquivo não é um snapshot MLM: {self.path}")
+        if version != FORMAT_VERSION or level_columns != LEVEL_COLUMNS:
+            raise SnapshotError(f"Formato de snapshot incompatível (versão {version})")
+
+        view = memoryview(self._mmap)
+        if verify and zlib.crc32(view[HEADER.size:]) != checksum:
+            view.release()
+            raise SnapshotError(f"Checksum inválido: {self.path}")
+
+        self.generation = generation
+        self.created_at = created_at
+        self.node_count = node_count
+        self.edge_count = edge_count
+
+        offset = HEADER.size
+        sections = {}
+        for name, fmt, count in (
+            ('ids', 'q', node_count),
+            ('parent', 'i', node_count),
+            ('child_offsets', 'i', node_count + 1),
+            ('children', 'i', edge_count),
+            ('depth', 'i', node_count),
+            ('levels', 'i', node_count * LEVEL_COLUMNS)
+        ):
+            size = count * struct.calcsize(fmt)
+            sections[name] = view[offset:offset + size].cast(fmt)
+            offset += size + _pad(size)
+
+        if offset > len(self._mmap):
+            raise SnapshotError(f"Snapshot truncado: {self.path}")
+
+        self._view = view
+        self.ids = sections['ids']
+        self.parent = sections['parent']
+        self.child_offsets = sections['child_offsets']
+        self.children_index = sections['children']
+        self.depth = sections['depth']
+        self.levels = sections['levels']
+
+    def index_of(self, affiliate_id):
+        i = bisect_left(self.ids, affiliate_id)
+        if i < self.node_count and self.ids[i] == affiliate_id:
+            return i
+        return None
+
+    def __contains__(self, affiliate_id):
+        return self.index_of(affiliate_id) is not None
+
+    def level_counts(self, affiliate_id):
+        """N1..N5, total, além de N5 e janelas de crescimento de um afiliado (None se ausente)"""
+        i = self.index_of(affiliate_id)
+        if i is None:
+            return None
+        base = i * LEVEL_COLUMNS
+        row = self.levels[base:base + LEVEL_COLUMNS].tolist()
+        return {
+            'level_counts': {level: row[level - 1] for level in range(1, 6)},
+            'total_n1_to_n5': row[5],
+            'beyond_n5': row[6],
+            'growth': {
+                name: {level: row[COUNT_COLUMNS + 5 * window + level - 1] for level in range(1, 6)}
+                for window, (name, _) in enumerate(GROWTH_WINDOWS)
+            }
+        }
+
+    def parent_of(self, affiliate_id):
+        i = self.index_of(affiliate_id)
+        if i is None or self.parent[i] < 0:
+            return None
+        return self.ids[self.parent[i]]
+
+    def upline(self, affiliate_id, max_depth=None):
+        """Ancestrais do mais próximo à raiz (None se o afiliado não existe)"""
+        i = self.index_of(affiliate_id)
+        if i is None:
+            return None
+        result = []
+        current = self.parent[i]
+        # Limite de segurança contra snapshot malformado com ciclo
+        while current >= 0 and len(result) < self.node_count:
+            if max_depth is not None and len(result) >= max_depth:
+                break
+            result.append(self.ids[current])
+            current = self.parent[current]
+        return result
+
+    def children(self, affiliate_id):
+        i = self.index_of(affiliate_id)
+        if i is None:
+            return None
+        start, end = self.child_offsets[i], self.child_offsets[i + 1]
+        return [self.ids[j] for j in self.children_index[start:end]]
+
+    def affiliate_rows(self):
+        """Reconstrói as linhas persistidas (hierarquia e N1-N5) dos afiliados"""
+        ids, parent, offsets, depth, levels = self.ids, self.parent, self.child_offsets, self.depth, self.levels
+        paths = [None] * self.node_count
+        for i in range(self.node_count):
+            direct = offsets[i + 1] - offsets[i]
+            if not direct:
+                continue  # usuário referido sem indicações (não é afiliado)
+
+            if paths[i] is None:
+                # Sobe até um ancestral com path conhecido e desce preenchendo;
+                # cada nó é visitado uma vez, então o total é O(n)
+                chain = []
+                on_chain = set()
+                current = i
+                while current >= 0 and paths[current] is None and current not in on_chain:
+                    chain.append(current)
+                    on_chain.add(current)
+                    current = parent[current]
+                # Ciclo no array de pais: o path começa no nó onde a subida o fechou
+                prefix = paths[current] if current >= 0 and current not in on_chain else None
+                for node in reversed(chain):
+                    prefix = f"{prefix}.{ids[node]}" if prefix else str(ids[node])
+                    paths[node] = prefix
+
+            base = i * LEVEL_COLUMNS
+            yield (
+                ids[i],
+                ids[parent[i]] if parent[i] >= 0 else None,
+                depth[i],
+                paths[i],
+                direct,
+                tuple(levels[base:base + LEVEL_COLUMNS])
+            )
+
+    def info(self):
+        return {
+            'generation': self.generation,
+            'created_at': self.created_at,
+            'nodes': self.node_count,
+            'edges': self.edge_count,
+            'path': self.path
+        }
+
+    def close(self):
+        for name in ('ids', 'parent', 'child_offsets', 'children_index', 'depth', 'levels', '_view'):
+            section = getattr(self, name, None)
+            if section is not None:
+                section.release()
+        self._mmap.close()
+
+
+class SnapshotStore:
+    """Mantém aberto o snapshot apontado por CURRENT, recarregando quando muda"""
+
+    def __init__(self, directory, check_interval=5.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._current_name = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _read_current(self):
+        try:
+            with open(os.path.join(self.directory, CURRENT_FILE)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def current(self):
+        """Snapshot atual (ou None); verifica CURRENT no máximo a cada check_interval"""
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._checked_at < self.check_interval:
+            return self._snapshot
+
+        with self._lock:
+            if self._snapshot is not None and now - self._checked_at < self.check_interval:
+                return self._snapshot
+            self._checked_at = now
+
+            name = self._read_current()
+            if name is None or name == self._current_name:
+                return self._snapshot
+
+            try:
+                snapshot = HierarchySnapshot(os.path.join(self.directory, name))
+            except (OSError, SnapshotError) as e:
+                logger.warning(f"Erro ao abrir snapshot {name}: {e}")
+                return self._snapshot
+
+            # O snapshot anterior não é fechado aqui: requisições em andamento
+            # podem estar lendo dele; o mmap é liberado pelo coletor de lixo
+            self._snapshot = snapshot
+            self._current_name = name
+            logger.info(f"Snapshot da geração {snapshot.generation} carregado ({snapshot.node_count} nós)")
+            return snapshot
+
+    def level_counts(self, affiliate_id, snapshot=None):
+        # snapshot: handle já obtido pelo chamador (geração e dados coerentes)
+        snapshot = snapshot or self.current()
+        if snapshot is None:
+            return None
+        result = snapshot.level_counts(affiliate_id)
+        record_cache('snapshot', result is not None)
+        return result
+
+    def upline(self, affiliate_id, max_depth=None, snapshot=None):
+        snapshot = snapshot or self.current()
+        if snapshot is None:
+            return None
+        result = snapshot.upline(affiliate_id, max_depth)
+        record_cache('snapshot', result is not None)
+        return result
@@ -0,0 +1,280 @@
+# Agendador da sincronização: uma execução por vez, com fila de um job
+#
+# Todas as sincronizações (periódicas, manuais e pedidos de resync do CDC)
+# passam pela mesma thread, então nunca há duas execuções intercalando
+# DELETE/INSERT nas mesmas conexões. Pedidos que chegam enquanto já existe um
+# job na fila são agregados a ele (mesmo job_id). O próximo horário periódico
+# recebe jitter, para que várias instâncias não sincronizem em fase; quando uma
+# execução passa do intervalo configurado, o intervalo efetivo cresce
+# (limitado a max_interval) em vez de emendar uma execução na outra.
+#
+# No modo particionado a execução periódica é a procura por shards a cada
+# poll_interval: procuras sem trabalho não entram no histórico de jobs e a
+# duração de um shard não amplia o intervalo.
+
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+import logging
+
+from src.models.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+OVERRUN_FACTOR = 1.5  # intervalo efetivo após execução mais longa que o configurado
+
+SYNC_JOBS = registry.counter(
+    'mlm_sync_jobs_total',
+    'Jobs de sincronização executados por origem e resultado',
+    ('trigger', 'status')
+)
+SYNC_JOBS_COALESCED = registry.counter(
+    'mlm_sync_jobs_coalesced_total',
+    'Pedidos de sincronização agregados a um job já na fila',
+    ('trigger',)
+)
+SYNC_EFFECTIVE_INTERVAL = registry.gauge(
+    'mlm_sync_effective_interval_seconds',
+    'Intervalo efetivo até a próxima sincronização periódica (sem jitter)'
+)
+
+
+class SyncJob:
+    """Execução de sincronização enfileirada (consultável pelo job_id)"""
+
+    def __init__(self, trigger):
+        self.job_id = uuid.uuid4().hex
+        self.trigger = trigger
+        self.status = 'queued'
+        self.requested_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.coalesced = 0
+        self.generation = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def duration_seconds(self):
+        if self.started_at and self.finished_at:
+            return (self.finished_at - self.started_at).total_seconds()
+        return None
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'trigger': self.trigger,
+            'status': self.status,
+            'requested_at': self.requested_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_seconds': self.duration_seconds,
+            'coalesced': self.coalesced,
+            'generation': self.generation,
+            'error': self.error
+        }
+
+
+class SyncScheduler:
+    """Serializa as sincronizações de um MLMSyncService"""
+
+    def __init__(self, service, jitter=0.1, max_interval=None, history=100):
+        self.service = service
+        self.jitter = jitter  # fração do intervalo (+/-)
+        self.max_interval = max_interval  # None = 10x o intervalo base
+        self.history = history
+
+        self.periodic = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pending = None
+        self._running = None
+        self._jobs = OrderedDict()
+        self._last_finished_at = None  # time.time() da última execução
+        self._last_duration = None
+        self._jitter_factor = 1.0
+        self.overruns = 0
+
+    # Controle
+
+    def start(self):
+        """Ativa as execuções periódicas (a primeira sai imediatamente)"""
+        with self._cond:
+            self.periodic = True
+            self._cond.notify_all()
+        self._ensure_thread()
+
+    def stop(self):
+        """Desativa as execuções periódicas; jobs manuais continuam sendo atendidos"""
+        with self._cond:
+            self.periodic = False
+            self._cond.notify_all()
+
+    def wake(self):
+        """Recalcula o próximo horário (ex.: intervalo alterado em /config)"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def submit(self, trigger='manual'):
+        """Enfileira uma sincronização; agrega ao job já na fila, se houver"""
+        with self._cond:
+            if self._pending is not None:
+                self._pending.coalesced += 1
+                SYNC_JOBS_COALESCED.inc(trigger=trigger)
+                if self._pending.job_id not in self._jobs:
+                    # Procura por shards fora do histórico: quem agregou consulta o job_id
+                    self._record(self._pending)
+                return self._pending
+            job = self._enqueue(trigger)
+            self._cond.notify_all()
+        self._ensure_thread()
+        return job
+
+    def _enqueue(self, trigger, record=True):
+        job = SyncJob(trigger)
+        self._pending = job
+        if record:
+            self._record(job)
+        return job
+
+    def _record(self, job):
+        """Guarda o job no histórico; ao passar do limite saem primeiro os periódicos"""
+        self._jobs[job.job_id] = job
+        while len(self._jobs) > self.history:
+            oldest = next(
+                (job_id for job_id, recorded in self._jobs.items()
+                 if recorded.trigger == 'scheduled' and recorded.done.is_set()),
+                None
+            )
+            if oldest is None:
+                self._jobs.popitem(last=False)
+            else:
+                del self._jobs[oldest]
+
+    def _ensure_thread(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='sync-scheduler', daemon=True)
+                self._thread.start()
+
+    # Intervalo
+
+    def base_interval(self):
+        """Intervalo configurado para o modo atual da sincronização"""
+        service = self.service
+        if service.sharding:
+            # Workers precisam notar shards novos logo; o coordenador checa sync_interval
+            return service.sharding.poll_interval
+        if service.cdc_listener and service.cdc_listener.is_listening:
+            # CDC ativo: mudanças chegam por micro-lotes; completa só como segurança
+            return service.cdc_resync_interval
+        return service.sync_interval
+
+    def effective_interval(self):
+        """Intervalo base, ampliado quando a última execução passou dele"""
+        base = self.base_interval()
+        if self.service.sharding:
+            # Procura por shards: um shard longo não é atraso da sincronização
+            # (o coordenador abre gerações pelo sync_interval)
+            return base
+        interval = base
+        if self._last_duration is not None and self._last_duration > base:
+            interval = self._last_duration * OVERRUN_FACTOR
+        limit = self.max_interval or base * 10
+        return min(max(interval, base), max(limit, base))
+
+    def next_run_at(self):
+        """time.time() da próxima execução periódica (None se desativada)"""
+        if not self.periodic:
+            return None
+        if self._last_finished_at is None:
+            return time.time()
+        return self._last_finished_at + self.effective_interval() * self._jitter_factor
+
+    # Execução
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    next_run = self.next_run_at()
+                    if next_run is None:
+                        self._cond.wait()
+                        continue
+                    delay = next_run - time.time()
+                    if delay <= 0:
+                        # Procura por shards só vai ao histórico se tiver trabalho
+                        self._enqueue('scheduled', record=not self.service.sharding)
+                        break
+                    self._cond.wait(delay)
+                job = self._pending
+                self._pending = None
+                self._running = job
+            result = None
+            try:
+                result = self._execute(job)
+            finally:
+                with self._cond:
+                    if job.job_id not in self._jobs and (result or job.status != 'completed'):
+                        self._record(job)
+                    self._running = None
+                    self._last_finished_at = time.time()
+                    self._last_duration = job.duration_seconds
+                    self._jitter_factor = 1.0 + random.uniform(-self.jitter, self.jitter)
+                    self._record_interval()
+
+    def _execute(self, job):
+        job.status = 'running'
+        job.started_at = datetime.now()
+        logger.info(f"Executando job de sincronização {job.job_id} ({job.trigger})")
+        result = None
+        try:
+            result = self.service.run_sync_job(job.trigger)
+            job.status = 'completed'
+            job.generation = self.service.current_generation
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            logger.error(f"Job de sincronização {job.job_id} falhou: {e}")
+        finally:
+            job.finished_at = datetime.now()
+            job.done.set()
+            SYNC_JOBS.inc(trigger=job.trigger, status=job.status)
+        return result
+
+    def _record_interval(self):
+        base = self.base_interval()
+        interval = self.effective_interval()
+        if interval > base:
+            self.overruns += 1
+            logger.warning(
+                f"Sincronização levou {self._last_duration:.1f}s (intervalo {base}s); "
+                f"próximo intervalo efetivo: {interval:.1f}s"
+            )
+        SYNC_EFFECTIVE_INTERVAL.set(interval)
+
+    # Consulta
+
+    def job(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def status(self, limit=20):
+        with self._cond:
+            next_run = self.next_run_at()
+            recent = list(self._jobs.values())[-limit:] if limit else []
+            recent.reverse()
+            return {
+                'periodic': self.periodic,
+                'running': self._running.to_dict() if self._running else None,
+                'queued': self._pending.to_dict() if self._pending else None,
+                'next_run_at': datetime.fromtimestamp(next_run).isoformat() if next_run else None,
+                'base_interval_seconds': self.base_interval(),
+                'effective_interval_seconds': self.effective_interval(),
+                'jitter': self.jitter,
+                'overruns': self.overruns,
+                'recent_jobs': [job.to_dict() for job in recent]
+            }
@@ -1,27 +1,112 @@
 # Sistema MLM Corrigido - Hierarquia Infinita com Total N1-N5
 # sync_service_final.py
 
+import os
 import psycopg2
 import psycopg2.extras
 import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from decimal import Decimal
 import logging
 from collections import defaultdict
+from psycopg2 import sql
+
+from src.models.metrics import track_stage, SYNC_RUNS, SYNC_STAGE_DURATION, SYNC_LAST_SUCCESS
+from src.models.query_log import instrumented_connect
+from src.models.mlm_database import ensure_commission_partitions
+from src.models.snapshot import write_snapshot, HierarchySnapshot, SnapshotError
+from src.models.cdc import TrackedChangeListener, install_tracked_trigger, DEFAULT_CHANNEL
+from src.models.hierarchy_engine import HierarchyEngine, EdgeConflict, GROWTH_WINDOWS, LEVEL_METRICS
+from src.models.sharded_sync import ShardedSync
+from src.models.sync_scheduler import SyncScheduler
+from src.models.parallel_extract import ParallelExtractor
+from src.models.memory_profile import MemoryProfiler, write_report
+from src.models.shadow_sync import ShadowSync, DEFAULT_ENGINE
+from src.models.leaderboard import Leaderboard, LEADERBOARD_REBUILDS
+from src.models.affiliate_stats import upsert_affiliate_stats
 
 logger = logging.getLogger(__name__)
 
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+# Linha de níveis: N1..N5, total, além de N5 e, para cada métrica de
+# LEVEL_METRICS (volume, novos 1d/7d/30d), os valores N1..N5
+LEVEL_ROW_COUNTS = 7
+METRIC_OFFSETS = {name: LEVEL_ROW_COUNTS + 5 * index for index, name in enumerate(LEVEL_METRICS)}
+LEVEL_ROW_SIZE = LEVEL_ROW_COUNTS + 5 * len(LEVEL_METRICS)
+
+
+def _naive(value):
+    """Datas com fuso são convertidas para horário local sem fuso (como created_at)"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
+
 class MLMSyncService:
     """Serviço MLM com hierarquia infinita e total limitado a N1-N5 por afiliado"""
     
-    def __init__(self, operation_db_url, mlm_db_url, redis_url=None):
+    def __init__(self, operation_db_url, mlm_db_url, redis_url=None, autoconnect=True):
         self.operation_db_url = operation_db_url
         self.mlm_db_url = mlm_db_url
         self.redis_url = redis_url
         
         self.is_running = False
         self.last_sync = None
+        self.last_sync_duration = None  # segundos da última sincronização concluída
         self.sync_interval = 60  # segundos
+        self.snapshot_dir = None  # diretório do snapshot binário (None = desativado)
+        self.current_generation = None  # última geração publicada
+        self.warm_start_source = None  # 'snapshot', 'database' ou None (partida a frio)
+        
+        # Linhas persistidas na última geração publicada; com baseline as
+        # persistências gravam apenas o que mudou
+        self.baseline_hierarchy = None  # affiliate_id -> linha de mlm_hierarchy
+        self.baseline_levels = None  # affiliate_id -> (N1..N5, total, além de N5)
+        self._pending_hierarchy = None
+        self._pending_levels = None
+        
+        # CDC (LISTEN/NOTIFY em tracked); polling continua como fallback
+        self.cdc_enabled = False
+        self.cdc_listener = None
+        self.cdc_resync_interval = 3600  # sincronização completa de segurança com CDC ativo
+        self.tracked_records = None  # tracked id -> (affiliate_id, referred_user_id, created_at)
+        
+        # Agregação de volume no banco da operação (None = total_volume fica zerado)
+        # chaves: table, user_column, amount_column, filter, batch_size
+        self.volume_source = None
+        self.user_volumes = {}  # user_id -> volume da última agregação
+        self._sync_lock = threading.RLock()
+        
+        # Motor incremental (arestas isoladas sem recalcular a floresta)
+        self.incremental_enabled = True
+        self.engine = None
+        # Todas as execuções passam pelo agendador (uma por vez, pedidos agregados)
+        self.scheduler = SyncScheduler(self)
+        
+        # Sincronização particionada entre nós (None = este nó sincroniza tudo)
+        self.sharding = None
+        
+        # Extração de tracked por faixas de id em várias conexões (None = consulta única)
+        self.extractor = None
+        
+        # Perfil de memória por etapa (opcional: tracemalloc deixa o pipeline mais lento)
+        self.memory_profile = False
+        self.memory_profile_dir = None  # None = relatório só em memória
+        self.memory_profile_top = 10
+        self.memory_report = None  # relatório da última execução perfilada
+        self._profiler = None
+        self.stage_durations = {}  # etapa -> segundos na última sincronização
+        
+        # Sincronização sombra: valida motores de estatísticas sem gravar
+        self.shadow_report = None
+        self._shadow_thread = None
+        self._shadow_lock = threading.Lock()
+        
+        # Ranking dos maiores afiliados (mantido a cada geração em mlm_leaderboard)
+        self.leaderboard = Leaderboard()
         
         # Conexões de banco
         self.operation_conn = None
@@ -30,18 +115,20 @@ class MLMSyncService:
         # Cache para otimização
         self.hierarchy_cache = {}
         
-        self.connect_databases()
+        # autoconnect=False permite usar as etapas em memória sem banco (benchmarks)
+        if autoconnect:
+            self.connect_databases()
 
     def connect_databases(self):
         """Conecta aos bancos de dados"""
         try:
             # Conexão com banco da operação
-            self.operation_conn = psycopg2.connect(self.operation_db_url)
+            self.operation_conn = instrumented_connect(self.operation_db_url, 'sync_operation')
             self.operation_conn.autocommit = True
             logger.info("Conectado ao banco da operação")
             
             # Conexão com banco MLM
-            self.mlm_conn = psycopg2.connect(self.mlm_db_url)
+            self.mlm_conn = instrumented_connect(self.mlm_db_url, 'sync_mlm')
             self.mlm_conn.autocommit = True
             logger.info("Conectado ao banco MLM")
             
@@ -50,57 +137,328 @@ class MLMSyncService:
             raise
 
     def start_sync_worker(self):
-        """Inicia worker de sincronização em background"""
+        """Inicia as sincronizações periódicas (thread do agendador)"""
         if not self.is_running:
             self.is_running = True
-            worker_thread = threading.Thread(target=self._sync_worker)
-            worker_thread.daemon = True
-            worker_thread.start()
+            self.scheduler.start()
             logger.info("Worker de sincronização iniciado")
 
     def stop_sync_worker(self):
         """Para worker de sincronização"""
         self.is_running = False
+        self.scheduler.stop()
+        if self.cdc_listener:
+            self.cdc_listener.stop()
         logger.info("Worker de sincronização parado")
 
-    def _sync_worker(self):
-        """Worker principal de sincronização"""
-        while self.is_running:
+    def run_sync_job(self, trigger='scheduled'):
+        """Execução do agendador: manutenção de partições e sincronização"""
+        self.maintain_commission_partitions()
+        if self.sharding:
+            with self._sync_lock:
+                # Periódico só abre geração quando devida; manual/resync força no coordenador
+                return self.sharding.run_cycle(force=trigger != 'scheduled')
+        return self.sync_data()
+
+    def request_resync(self, reason):
+        """Antecipa a próxima sincronização completa (CDC perdeu eventos)"""
+        if not self.is_running:
+            logger.info(f"Sincronização completa solicitada ({reason}) com worker parado - ignorada")
+            return
+        logger.info(f"Sincronização completa solicitada: {reason}")
+        self.scheduler.submit('resync')
+
+    def enable_cdc(self, channel=DEFAULT_CHANNEL, batch_size=500, batch_window=0.25,
+                   resync_interval=3600, install_trigger=False):
+        """Ativa CDC via LISTEN/NOTIFY; o polling segue como fallback se o canal cair"""
+        if install_trigger:
+            install_tracked_trigger(self.operation_conn, channel)
+        
+        self.cdc_enabled = True
+        self.cdc_resync_interval = resync_interval
+        self.cdc_listener = TrackedChangeListener(
+            self.operation_db_url,
+            on_batch=self.apply_tracked_changes,
+            on_resync=self.request_resync,
+            channel=channel,
+            batch_size=batch_size,
+            batch_window=batch_window
+        )
+        self.cdc_listener.start()
+
+    def enable_sharding(self, shard_count, worker_id=None, shard_timeout=1800, poll_interval=2.0):
+        """Ativa sincronização particionada por rede raiz (shards distribuídos entre nós)"""
+        # Cada nó só vê as redes dos shards que processou: sem motor incremental
+        # nem snapshot da floresta inteira
+        self.incremental_enabled = False
+        self.engine = None
+        if self.snapshot_dir:
+            logger.info("Snapshot binário desativado na sincronização particionada")
+            self.snapshot_dir = None
+        self.sharding = ShardedSync(
+            self,
+            shard_count,
+            worker_id=worker_id,
+            shard_timeout=shard_timeout,
+            poll_interval=poll_interval
+        )
+        logger.info(f"Sincronização particionada ativada: {shard_count} shards, worker {self.sharding.worker_id}")
+
+    def enable_parallel_extract(self, workers=4, range_size=100000, batch_size=10000, max_rows_per_second=None):
+        """Lê tracked por faixas de id em paralelo (mesmo snapshot, ordem refeita em memória)"""
+        self.extractor = ParallelExtractor(
+            self.operation_db_url,
+            workers=workers,
+            range_size=range_size,
+            batch_size=batch_size,
+            max_rows_per_second=max_rows_per_second
+        )
+        limit = f"{max_rows_per_second} linhas/s" if max_rows_per_second else "sem limite de vazão"
+        logger.info(f"Extração paralela ativada: {workers} conexões, faixas de {range_size} ids, {limit}")
+
+    def shadow_sync(self, engine=DEFAULT_ENGINE, sample_size=20):
+        """Pipeline sem gravação comparando as contagens do motor com mlm_levels"""
+        if self.sharding:
+            raise RuntimeError("Sincronização sombra precisa da floresta inteira (indisponível no modo particionado)")
+        shadow = ShadowSync(self, engine=engine, sample_size=sample_size)
+        with self._sync_lock:
+            return shadow.run()
+
+    def start_shadow_sync(self, engine=DEFAULT_ENGINE, sample_size=20):
+        """Executa shadow_sync em segundo plano; False se já houver uma em andamento"""
+        if self.sharding:
+            raise RuntimeError("Sincronização sombra precisa da floresta inteira (indisponível no modo particionado)")
+        shadow = ShadowSync(self, engine=engine, sample_size=sample_size)
+
+        def run():
             try:
-                self.sync_data()
-                time.sleep(self.sync_interval)
-            except Exception as e:
-                logger.error(f"Erro na sincronização automática: {e}")
-                time.sleep(30)
+                with self._sync_lock:
+                    shadow.run()
+            except Exception:
+                pass  # erro já registrado no relatório e no log
+
+        with self._shadow_lock:
+            if self.shadow_running:
+                return False
+            self._shadow_thread = threading.Thread(target=run, name='shadow-sync', daemon=True)
+            self._shadow_thread.start()
+        return True
+
+    @property
+    def shadow_running(self):
+        return bool(self._shadow_thread and self._shadow_thread.is_alive())
 
     def sync_data(self):
         """Sincroniza dados do banco da operação para o banco MLM"""
+        with self._sync_lock:
+            if self.sharding:
+                # Só o coordenador abre geração; nos demais nós processa shards pendentes
+                return self.sharding.run_cycle(force=True)
+            return self._run_pipeline('infinite_hierarchy_n1_to_n5', 'extract', self._extract_tracked)
+
+    def apply_tracked_changes(self, events):
+        """Aplica micro-lote de CDC sobre os registros tracked mantidos em memória"""
+        with self._sync_lock:
+            if self.tracked_records is None:
+                # Ainda não houve extração completa: não há base para aplicar
+                self.request_resync('cdc_without_baseline')
+                return
+            logger.info(f"Aplicando micro-lote de CDC com {len(events)} eventos")
+            operations = self._apply_tracked_events(events)
+            
+            if self.engine is not None:
+                try:
+                    return self.apply_edges(operations, sync_type='cdc_incremental')
+                except EdgeConflict as e:
+                    logger.info(f"Micro-lote de CDC não aplicável incrementalmente ({e}); recalculando")
+            
+            # Volumes seguem os da última agregação completa
+            return self._run_pipeline('cdc_micro_batch', 'cdc_apply', self._tracked_records_list,
+                                      refresh_volumes=False)
+
+    def _extract_tracked(self):
+        tracked_data = self.get_tracked_data()
+        if self.cdc_enabled:
+            self.tracked_records = {
+                record['id']: (record['affiliate_id'], record['referred_user_id'], record['created_at'])
+                for record in tracked_data
+            }
+        return tracked_data
+
+    def _apply_tracked_events(self, events):
+        """Aplica INSERT/UPDATE/DELETE aos registros em memória e devolve as operações de aresta"""
+        records = self.tracked_records
+        operations = []
+        for event in events:
+            old = records.pop(event['id'], None)
+            if old is not None:
+                operations.append({'op': 'remove', 'parent_id': old[0], 'child_id': old[1]})
+            if (event['op'] != 'DELETE' and event.get('tracked_type_id') == 1
+                    and event.get('affiliate_id') is not None
+                    and event.get('referred_user_id') is not None):
+                created_at = event.get('created_at')
+                records[event['id']] = (
+                    event['affiliate_id'],
+                    event['referred_user_id'],
+                    datetime.fromisoformat(created_at) if created_at else None
+                )
+                # tracked admite mais de um referidor por usuário (como no cálculo completo)
+                operations.append({
+                    'op': 'insert',
+                    'parent_id': event['affiliate_id'],
+                    'child_id': event['referred_user_id'],
+                    'allow_multiple': True,
+                    'created_at': _naive(records[event['id']][2]) or datetime.now()
+                })
+        return operations
+
+    def _tracked_records_list(self):
+        """Registros em memória na ordem de get_tracked_data"""
+        ordered = sorted(self.tracked_records.items(), key=lambda item: (item[1][0], item[1][1]))
+        return [
+            {
+                'id': record_id,
+                'affiliate_id': affiliate_id,
+                'referred_user_id': referred_user_id,
+                'tracked_type_id': 1,
+                'created_at': created_at
+            }
+            for record_id, (affiliate_id, referred_user_id, created_at) in ordered
+        ]
+
+    def apply_edges(self, operations, sync_type='incremental_edges'):
+        """Aplica inserção/remoção/re-parent de arestas e persiste só as linhas afetadas"""
+        with self._sync_lock:
+            if self.engine is None:
+                raise RuntimeError("Motor incremental indisponível (aguardando sincronização completa)")
+            
+            start_time = datetime.now()
+            generation = self.begin_generation(sync_type)
+            try:
+                with track_stage('incremental_apply') as stage:
+                    changes = self.engine.apply(operations)
+                    stage.rows = len(operations)
+            except EdgeConflict as e:
+                self.fail_generation(generation, 'rejected', str(e))
+                raise
+            
+            try:
+                with track_stage('persist_incremental') as stage:
+                    persisted = self.persist_changes(changes)
+                    stage.rows = persisted
+                if self.baseline_levels is not None and (changes.level_upserts or changes.level_deletes):
+                    with track_stage('leaderboard') as stage:
+                        stage.rows = self.update_leaderboard(
+                            generation, changes.level_upserts, changes.level_deletes
+                        )
+                self.publish_generation(generation, len(self.engine))
+            except Exception as e:
+                # Motor já alterado e banco parcial: volta ao recálculo completo
+                logger.error(f"Erro ao persistir alterações incrementais: {e}")
+                self.engine = None
+                self.baseline_hierarchy = None
+                self.baseline_levels = None
+                self.fail_generation(generation, 'failed', str(e))
+                self.request_resync('incremental_persist_failed')
+                raise
+            
+            duration = (datetime.now() - start_time).total_seconds()
+            SYNC_STAGE_DURATION.observe(duration, stage='incremental_total')
+            SYNC_RUNS.inc(status='incremental')
+            logger.info(
+                f"{len(operations)} operações de aresta aplicadas em {duration:.3f}s - "
+                f"{len(changes.level_upserts)} afiliados com N1-N5 alterados"
+            )
+            return {
+                'generation': generation,
+                'operations': len(operations),
+                'hierarchy_rows': len(changes.hierarchy_upserts) + len(changes.hierarchy_deletes),
+                'level_affiliates': len(changes.level_upserts) + len(changes.level_deletes),
+                'rows_persisted': persisted,
+                'duration_seconds': duration
+            }
+
+    def _run_pipeline(self, sync_type, extract_stage, load_tracked, refresh_volumes=True):
+        """Executa construção, cálculo, persistência e publicação de uma geração"""
         start_time = datetime.now()
-        logger.info("Iniciando sincronização MLM com hierarquia infinita")
+        logger.info(f"Iniciando sincronização MLM com hierarquia infinita ({sync_type})")
+        generation = None
+        if self.memory_profile:
+            self._profiler = MemoryProfiler(sync_type, top=self.memory_profile_top).start()
+        status = 'failed'
         
         try:
+            generation = self.begin_generation(sync_type)
+            
             # 1. Obter TODOS os dados tracked (614.944 registros)
-            tracked_data = self.get_tracked_data()
+            with self._stage(extract_stage) as stage:
+                tracked_data = load_tracked()
+                stage.rows = len(tracked_data)
+            self._measure_memory(tracked_data=tracked_data)
             
             if not tracked_data:
                 logger.info("Nenhum dado encontrado para sincronização")
+                self.fail_generation(generation, 'empty', None)
+                SYNC_RUNS.inc(status='empty')
+                status = 'empty'
                 return
             
             logger.info(f"Processando {len(tracked_data)} registros de afiliação")
             
             # 2. Construir hierarquia INFINITA (todos os registros presentes)
-            global_hierarchy = self.build_infinite_hierarchy(tracked_data)
+            with self._stage('build_hierarchy') as stage:
+                global_hierarchy = self.build_infinite_hierarchy(tracked_data)
+                stage.rows = len(global_hierarchy)
+            self._measure_memory(global_hierarchy=global_hierarchy)
+            
+            # Volume por usuário agregado no banco da operação (streaming)
+            if self.volume_source and refresh_volumes:
+                with self._stage('extract_volumes') as stage:
+                    self.user_volumes = self.get_user_volumes(global_hierarchy)
+                    stage.rows = len(self.user_volumes)
+            
+            # Indicações novas por janela (created_at de tracked), ancoradas agora
+            window_members, window_cutoffs = self.compute_growth_windows(tracked_data)
             
             # 3. Calcular perspectivas individuais N1-N5 para cada afiliado
-            individual_stats = self.calculate_individual_n1_to_n5_stats(global_hierarchy)
+            with self._stage('calculate_stats') as stage:
+                individual_stats = self.calculate_individual_n1_to_n5_stats(
+                    global_hierarchy, self.user_volumes, window_members
+                )
+                stage.rows = len(individual_stats)
+            self._measure_memory(individual_stats=individual_stats)
             
             # 4. Persistir dados
-            records_updated = self.persist_hierarchy(global_hierarchy)
-            stats_updated = self.persist_level_stats(individual_stats)
+            with self._stage('persist_hierarchy') as stage:
+                records_updated = self.persist_hierarchy(global_hierarchy)
+                stage.rows = records_updated
+            with self._stage('persist_level_stats') as stage:
+                stats_updated = self.persist_level_stats(individual_stats)
+                stage.rows = stats_updated
+            with self._stage('leaderboard') as stage:
+                stage.rows = self.refresh_leaderboard(generation, self._pending_levels)
+            
+            # 5. Snapshot binário para leitura via mmap pelos processos web
+            snapshot_file = None
+            if self.snapshot_dir:
+                with self._stage('snapshot') as stage:
+                    snapshot_file = self.write_hierarchy_snapshot(generation, global_hierarchy, individual_stats)
+                    stage.rows = len(global_hierarchy) if snapshot_file else 0
+            
+            self.publish_generation(generation, len(global_hierarchy), snapshot_file)
+            self.baseline_hierarchy = self._pending_hierarchy
+            self.baseline_levels = self._pending_levels
+            if self.incremental_enabled:
+                self.engine = HierarchyEngine(
+                    global_hierarchy, individual_stats,
+                    node_values={'volume': self.user_volumes},
+                    window_cutoffs=window_cutoffs,
+                    edge_values=window_members
+                )
             
-            # 5. Log
+            # 6. Log
             self.log_sync_operation(
-                sync_type='infinite_hierarchy_n1_to_n5',
+                sync_type=sync_type,
                 records_processed=len(tracked_data),
                 records_updated=records_updated,
                 records_inserted=stats_updated,
@@ -109,42 +467,370 @@ class MLMSyncService:
             
             self.last_sync = datetime.now()
             duration = (self.last_sync - start_time).total_seconds()
+            self.last_sync_duration = duration
+            SYNC_STAGE_DURATION.observe(duration, stage='total')
+            SYNC_RUNS.inc(status='completed')
+            SYNC_LAST_SUCCESS.set(time.time())
+            status = 'completed'
             
             logger.info(f"Sincronização concluída em {duration:.2f}s - {len(global_hierarchy)} afiliados processados")
             
         except Exception as e:
             logger.error(f"Erro na sincronização: {e}")
+            SYNC_RUNS.inc(status='failed')
+            self.fail_generation(generation, 'failed', str(e))
+            # Persistência parcial: baseline não reflete mais o banco
+            self.baseline_hierarchy = None
+            self.baseline_levels = None
+            self.engine = None
             self.log_sync_operation(
-                sync_type='infinite_hierarchy_n1_to_n5',
+                sync_type=sync_type,
                 status='failed',
                 error_message=str(e)
             )
             raise
+        finally:
+            if self._profiler:
+                self._finish_memory_profile(status, generation)
+
+    @contextmanager
+    def _stage(self, name):
+        """track_stage com perfil de memória quando ativo"""
+        with track_stage(name) as stage:
+            if self._profiler is None:
+                yield stage
+            else:
+                with self._profiler.stage(name):
+                    yield stage
+        self.stage_durations[name] = stage.duration
+
+    def _measure_memory(self, **structures):
+        """Tamanho profundo das estruturas (só com perfil de memória ativo)"""
+        if self._profiler is not None:
+            self._profiler.measure(**structures)
+
+    def _finish_memory_profile(self, status, generation):
+        profiler, self._profiler = self._profiler, None
+        report = profiler.finish(status, generation)
+        if self.memory_profile_dir:
+            try:
+                report['file'] = write_report(report, self.memory_profile_dir)
+            except OSError as e:
+                logger.warning(f"Erro ao gravar perfil de memória: {e}")
+        self.memory_report = report
+        structures = ', '.join(
+            f"{name}={data['bytes'] / 1048576:.1f}MB" for name, data in report['structures'].items()
+        )
+        logger.info(
+            f"Perfil de memória: pico Python {report['python_peak_bytes'] / 1048576:.1f}MB "
+            f"em {report['peak_stage']}, RSS máximo {report['rss_peak_kb']}KB ({structures})"
+        )
 
-    def get_tracked_data(self):
-        """Obtém TODOS os dados da tabela tracked"""
+    def warm_start(self, snapshot_dir=None):
+        """Carrega a última geração publicada como baseline (snapshot ou banco)"""
+        with self.mlm_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT generation, snapshot_file, completed_at
+                FROM mlm_generations
+                WHERE status = 'published'
+                ORDER BY generation DESC
+                LIMIT 1
+            """)
+            published = cursor.fetchone()
+            # Execução não particionada posterior à publicada (em andamento ou caída no
+            # meio da gravação): as tabelas podem não corresponder mais à geração publicada
+            cursor.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM mlm_generations
+                    WHERE status IN ('running', 'failed') AND shard_count IS NULL
+                        AND generation > COALESCE(
+                            (SELECT MAX(generation) FROM mlm_generations WHERE status = 'published'), 0
+                        )
+                ) AS dirty
+            """)
+            dirty = cursor.fetchone()['dirty']
+        
+        if not published:
+            logger.info("Nenhuma geração publicada - primeira sincronização será completa")
+            return None
+        
+        generation = published['generation']
+        source = None
+        snapshot_file = published['snapshot_file']
+        if snapshot_file and snapshot_dir and os.path.dirname(snapshot_file) != snapshot_dir:
+            # Caminho gravado por outra instância: procura o mesmo arquivo no diretório local
+            snapshot_file = os.path.join(snapshot_dir, os.path.basename(snapshot_file))
+        
+        if dirty:
+            # Baseline lido das tabelas como estão: a próxima sincronização regrava
+            # as linhas apagadas ou desatualizadas pela execução interrompida
+            logger.warning(
+                f"Gravação posterior à geração {generation} ficou incompleta; baseline lido do banco"
+            )
+        # Snapshot não guarda volumes: com agregação ativa o baseline vem do banco
+        elif snapshot_file and not self.volume_source and os.path.exists(snapshot_file):
+            try:
+                self._load_baseline_from_snapshot(snapshot_file, generation)
+                source = 'snapshot'
+            except (OSError, SnapshotError) as e:
+                logger.warning(f"Snapshot da geração {generation} inutilizável: {e}")
+        
+        if source is None:
+            self._load_baseline_from_db()
+            source = 'database'
+        
+        self.current_generation = generation
+        self.last_sync = published['completed_at']
+        self.warm_start_source = source
+        logger.info(
+            f"Partida a quente da geração {generation} ({source}): "
+            f"{len(self.baseline_hierarchy)} afiliados no baseline"
+        )
+        return source
+
+    def _load_baseline_from_snapshot(self, path, generation):
+        snapshot = HierarchySnapshot(path)
         try:
-            with self.operation_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            if snapshot.generation != generation:
+                raise SnapshotError(f"snapshot é da geração {snapshot.generation}")
+            hierarchy = {}
+            levels = {}
+            for affiliate_id, parent_id, global_level, path, direct, counts in snapshot.affiliate_rows():
+                hierarchy[affiliate_id] = (parent_id, global_level, path, direct, direct)
+                # Snapshot: contagens + janelas; volume não é guardado (zero)
+                levels[affiliate_id] = counts[:LEVEL_ROW_COUNTS] + (ZERO,) * 5 + counts[LEVEL_ROW_COUNTS:]
+        finally:
+            snapshot.close()
+        self.baseline_hierarchy = hierarchy
+        self.baseline_levels = levels
+
+    def _load_baseline_from_db(self):
+        hierarchy = {}
+        levels = defaultdict(lambda: [0] * LEVEL_ROW_SIZE)
+        with self.mlm_conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT affiliate_id, parent_id, level, path, total_downline, direct_referrals
+                FROM mlm_hierarchy
+            """)
+            for affiliate_id, *row in cursor:
+                hierarchy[affiliate_id] = tuple(row)
+            
+            cursor.execute("""
+                SELECT affiliate_id, level, direct_count, indirect_count,
+                       total_volume, new_1d, new_7d, new_30d
+                FROM mlm_levels
+            """)
+            for affiliate_id, level, direct_count, indirect_count, *metrics in cursor:
+                counts = levels[affiliate_id]
+                if level == 0:
+                    counts[5] = direct_count
+                    counts[6] = indirect_count
+                else:
+                    counts[level - 1] = direct_count
+                    for name, value in zip(LEVEL_METRICS, metrics):
+                        counts[METRIC_OFFSETS[name] + level - 1] = value or 0
+        self.baseline_hierarchy = hierarchy
+        self.baseline_levels = {affiliate_id: tuple(counts) for affiliate_id, counts in levels.items()}
+
+    def begin_generation(self, sync_type):
+        """Registra nova geração em andamento e retorna seu número"""
+        with self.mlm_conn.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO mlm_generations (sync_type) VALUES (%s) RETURNING generation",
+                (sync_type,)
+            )
+            return cursor.fetchone()[0]
+
+    def publish_generation(self, generation, affiliates, snapshot_file=None):
+        """Marca a geração como publicada (dados persistidos e snapshot gravado)"""
+        with self.mlm_conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE mlm_generations
+                SET status = 'published', affiliates = %s, snapshot_file = %s,
+                    completed_at = CURRENT_TIMESTAMP
+                WHERE generation = %s
+            """, (affiliates, snapshot_file, generation))
+        self.current_generation = generation
+
+    def fail_generation(self, generation, status, error_message):
+        """Encerra geração não publicada (falha ou sincronização vazia)"""
+        if generation is None:
+            return
+        try:
+            with self.mlm_conn.cursor() as cursor:
                 cursor.execute("""
-                    SELECT
-                        id,
-                        user_afil as affiliate_id,
-                        user_id as referred_user_id,
-                        tracked_type_id,
-                        created_at
-                    FROM tracked
-                    WHERE tracked_type_id = 1
-                        AND user_afil IS NOT NULL
-                        AND user_id IS NOT NULL
-                    ORDER BY user_afil, user_id;
-                """)
-                
-                return cursor.fetchall()
+                    UPDATE mlm_generations
+                    SET status = %s, error_message = %s, completed_at = CURRENT_TIMESTAMP
+                    WHERE generation = %s
+                """, (status, error_message, generation))
+        except Exception as e:
+            logger.error(f"Erro ao encerrar geração {generation}: {e}")
+
+    def refresh_leaderboard(self, generation, rows, levels=None, source='full'):
+        """Recalcula quadros do ranking (top-K por heap) e grava; falha não interrompe a sincronização"""
+        try:
+            if levels is None:
+                levels = self.leaderboard.rebuild(rows)
+            else:
+                self.leaderboard.rebuild(rows, levels)
+            with self.mlm_conn.cursor() as cursor:
+                written = self.leaderboard.persist(cursor, generation, levels)
+            LEADERBOARD_REBUILDS.inc(len(levels), source=source)
+            return written
+        except Exception as e:
+            # Ranking em memória não confere mais com o banco: recalcula tudo na próxima vez
+            self.leaderboard.clear()
+            logger.error(f"Erro ao atualizar ranking da geração {generation}: {e}")
+            return 0
+
+    def update_leaderboard(self, generation, upserts, deletes):
+        """Atualiza o ranking com as linhas alteradas (sem varrer todos os afiliados) e grava"""
+        try:
+            changed, reselected = self.leaderboard.update(self.baseline_levels, upserts, deletes)
+            if not changed:
+                return 0
+            with self.mlm_conn.cursor() as cursor:
+                written = self.leaderboard.persist(cursor, generation, changed)
+            if reselected:
+                LEADERBOARD_REBUILDS.inc(len(reselected), source='incremental')
+            if len(changed) > len(reselected):
+                LEADERBOARD_REBUILDS.inc(len(changed) - len(reselected), source='in_place')
+            return written
+        except Exception as e:
+            self.leaderboard.clear()
+            logger.error(f"Erro ao atualizar ranking da geração {generation}: {e}")
+            return 0
+
+    def write_hierarchy_snapshot(self, generation, global_hierarchy, individual_stats):
+        """Grava snapshot binário; falha não interrompe a sincronização"""
+        try:
+            return write_snapshot(self.snapshot_dir, generation, global_hierarchy, individual_stats)
+        except Exception as e:
+            logger.error(f"Erro ao gravar snapshot da geração {generation}: {e}")
+            return None
+
+    def maintain_commission_partitions(self):
+        """Cria partições futuras de mlm_commissions (no-op quando já existem)"""
+        try:
+            ensure_commission_partitions(self.mlm_conn)
+        except Exception as e:
+            logger.warning(f"Erro ao manter partições de comissões: {e}")
+
+    def get_tracked_data(self, snapshot_id=None, affiliate_ids=None):
+        """Obtém TODOS os dados da tabela tracked (snapshot_id: leitura no snapshot exportado)
+
+        affiliate_ids restringe a leitura às indicações desses afiliados (shard
+        da sincronização particionada), com o filtro aplicado no banco.
+        """
+        if self.extractor and affiliate_ids is None:
+            return self.extractor.extract(snapshot_id)
+        try:
+            with self.operation_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                if snapshot_id:
+                    # Todos os shards leem o mesmo estado de tracked (pg_export_snapshot)
+                    cursor.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+                    try:
+                        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                        return self._fetch_tracked(cursor, affiliate_ids)
+                    finally:
+                        cursor.execute("COMMIT")
+                return self._fetch_tracked(cursor, affiliate_ids)
                 
         except Exception as e:
             logger.error(f"Erro ao buscar dados tracked: {e}")
             raise
 
+    def _fetch_tracked(self, cursor, affiliate_ids=None):
+        cursor.execute(f"""
+            SELECT
+                id,
+                user_afil as affiliate_id,
+                user_id as referred_user_id,
+                tracked_type_id,
+                created_at
+            FROM tracked
+            WHERE tracked_type_id = 1
+                AND user_afil IS NOT NULL
+                AND user_id IS NOT NULL
+                {'AND user_afil = ANY(%s)' if affiliate_ids is not None else ''}
+            ORDER BY user_afil, user_id;
+        """, (list(affiliate_ids),) if affiliate_ids is not None else None)
+        return cursor.fetchall()
+
+    def get_user_volumes(self, global_hierarchy, snapshot_id=None, only_users=False):
+        """Volume por usuário via GROUP BY no banco da operação, lido em lotes (cursor no servidor)
+
+        snapshot_id: agrega no snapshot exportado (mesmo estado lido de tracked).
+        only_users: agrega só os usuários da hierarquia (shard), filtrando no banco.
+        """
+        source = self.volume_source
+        users = set(global_hierarchy)
+        for data in global_hierarchy.values():
+            users.update(data.get('children', []))
+        
+        conditions = []
+        params = None
+        if source.get('filter'):
+            # Filtro vem da configuração do serviço (não de entrada de usuário)
+            conditions.append(sql.SQL(f"({source['filter']})"))
+        if only_users:
+            conditions.append(sql.SQL("{user} = ANY(%s)").format(user=sql.Identifier(source['user_column'])))
+            params = (list(users),)
+        query = sql.SQL("SELECT {user}, SUM({amount}) FROM {table}{where} GROUP BY {user}").format(
+            user=sql.Identifier(source['user_column']),
+            amount=sql.Identifier(source['amount_column']),
+            table=sql.Identifier(*source['table'].split('.')),
+            where=sql.SQL(' WHERE ') + sql.SQL(' AND ').join(conditions) if conditions else sql.SQL('')
+        )
+        
+        volumes = {}
+        scanned = 0
+        try:
+            with self.operation_conn.cursor() as control:
+                if snapshot_id:
+                    control.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+                    control.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+                try:
+                    # withhold: cursor nomeado funciona com a conexão em autocommit
+                    with self.operation_conn.cursor(name='mlm_user_volumes', withhold=True) as cursor:
+                        cursor.itersize = source.get('batch_size', 10000)
+                        cursor.execute(query, params)
+                        for user_id, volume in cursor:
+                            scanned += 1
+                            if volume and user_id in users:
+                                volumes[user_id] = Decimal(volume).quantize(CENT)
+                finally:
+                    if snapshot_id:
+                        control.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"Erro ao agregar volumes: {e}")
+            raise
+        
+        logger.info(f"Volumes agregados: {scanned} usuários lidos, {len(volumes)} na hierarquia")
+        return volumes
+
+    def compute_growth_windows(self, tracked_data, now=None):
+        """Indicações (referidor, indicado) dentro de cada janela (data da indicação em tracked)"""
+        now = now or datetime.now()
+        cutoffs = {name: now - timedelta(days=days) for name, days in GROWTH_WINDOWS}
+        oldest = min(cutoffs.values())
+        
+        # Por aresta: um usuário com vários referidores só é novo sob aquele cuja
+        # indicação caiu na janela (registro repetido da mesma aresta: o último prevalece)
+        joined = {}
+        for record in tracked_data:
+            joined[(record['affiliate_id'], record['referred_user_id'])] = record.get('created_at')
+        
+        members = {name: {} for name in cutoffs}
+        for edge, created_at in joined.items():
+            created_at = _naive(created_at)
+            if created_at is None or created_at < oldest:
+                continue
+            for name, cutoff in cutoffs.items():
+                if created_at >= cutoff:
+                    members[name][edge] = 1
+        return members, cutoffs
+
     def build_infinite_hierarchy(self, tracked_data):
         """Constrói hierarquia INFINITA - TODOS os 614.944 registros devem estar presentes"""
         logger.info("Construindo hierarquia infinita com todos os registros")
@@ -173,16 +859,18 @@ class MLMSyncService:
         logger.info(f"Afiliados únicos: {len(all_affiliates)}")
         logger.info(f"Usuários referidos únicos: {len(all_users)}")
         logger.info(f"Afiliados raiz: {len(root_affiliates)}")
+        # Estruturas intermediárias só existem durante a construção
+        self._measure_memory(relationships=relationships, user_to_affiliate=user_to_affiliate)
         
         # Construir hierarquia global INFINITA
         global_hierarchy = {}
         
         # Processar afiliados raiz
+        cycle_edges = 0
         for root_affiliate in root_affiliates:
-            self._build_infinite_recursive(
+            cycle_edges += self._build_infinite_iterative(
                 affiliate_id=root_affiliate,
                 relationships=relationships,
-                user_to_affiliate=user_to_affiliate,
                 hierarchy=global_hierarchy,
                 global_level=1,
                 path=str(root_affiliate),
@@ -197,10 +885,9 @@ class MLMSyncService:
                 parent_level = parent_data.get('global_level', 0)
                 parent_path = parent_data.get('path', str(affiliate_id))
                 
-                self._build_infinite_recursive(
+                cycle_edges += self._build_infinite_iterative(
                     affiliate_id=user_id,
                     relationships=relationships,
-                    user_to_affiliate=user_to_affiliate,
                     hierarchy=global_hierarchy,
                     global_level=parent_level + 1,
                     path=f"{parent_path}.{user_id}",
@@ -208,6 +895,8 @@ class MLMSyncService:
                 )
         
         logger.info(f"Hierarquia infinita construída: {len(global_hierarchy)} afiliados mapeados")
+        if cycle_edges:
+            logger.warning(f"Indicações que fecham ciclo ignoradas na hierarquia: {cycle_edges}")
         
         # Verificar se todos os registros estão presentes
         total_relationships = sum(len(refs) for refs in relationships.values())
@@ -218,186 +907,359 @@ class MLMSyncService:
         
         return global_hierarchy
 
-    def _build_infinite_recursive(self, affiliate_id, relationships, user_to_affiliate, hierarchy, global_level, path, parent_id):
-        """Constrói hierarquia recursivamente SEM limitação de nível"""
-        
-        # Adicionar afiliado à hierarquia
-        hierarchy[affiliate_id] = {
-            'affiliate_id': affiliate_id,
-            'parent_id': parent_id,
-            'global_level': global_level,
-            'path': path,
-            'direct_referrals': len(relationships.get(affiliate_id, [])),
-            'children': relationships.get(affiliate_id, []).copy(),
-            'affiliate_children': []  # Apenas filhos que também são afiliados
-        }
+    def _build_infinite_iterative(self, affiliate_id, relationships, hierarchy, global_level, path, parent_id):
+        """Constrói a rede de um afiliado em profundidade SEM limitação de nível (pilha explícita)
+
+        Mesma ordem de visita da versão recursiva, sem o limite de recursão do Python
+        em cadeias longas. Um referido que já está no caminho atual (ciclo ou
+        auto-indicação) não é visitado de novo; devolve quantas indicações assim
+        foram ignoradas.
+        """
+        def visit(node_id, level, node_path, node_parent):
+            referred = relationships.get(node_id, [])
+            entry = hierarchy[node_id] = {
+                'affiliate_id': node_id,
+                'parent_id': node_parent,
+                'global_level': level,
+                'path': node_path,
+                'direct_referrals': len(referred),
+                'children': referred.copy(),
+                'affiliate_children': []  # Apenas filhos que também são afiliados
+            }
+            return entry, iter(referred)
         
-        # Processar referidos diretos
-        for referred_user in relationships.get(affiliate_id, []):
-            # Se o usuário referido também é um afiliado, processar recursivamente
-            if referred_user in relationships:
-                hierarchy[affiliate_id]['affiliate_children'].append(referred_user)
-                
-                # Continuar recursivamente SEM limitação de nível
-                self._build_infinite_recursive(
-                    affiliate_id=referred_user,
-                    relationships=relationships,
-                    user_to_affiliate=user_to_affiliate,
-                    hierarchy=hierarchy,
-                    global_level=global_level + 1,
-                    path=f"{path}.{referred_user}",
-                    parent_id=affiliate_id
-                )
+        cycle_edges = 0
+        on_chain = {affiliate_id}
+        stack = [(affiliate_id, *visit(affiliate_id, global_level, path, parent_id))]
+        while stack:
+            node_id, entry, pending = stack[-1]
+            # Próximo referido que também é afiliado
+            referred_user = next((user for user in pending if user in relationships), None)
+            if referred_user is None:
+                stack.pop()
+                on_chain.discard(node_id)
+                continue
+            if referred_user in on_chain:
+                cycle_edges += 1
+                continue
+            entry['affiliate_children'].append(referred_user)
+            on_chain.add(referred_user)
+            stack.append((referred_user, *visit(
+                referred_user, entry['global_level'] + 1, f"{entry['path']}.{referred_user}", node_id
+            )))
+        return cycle_edges
 
-    def calculate_individual_n1_to_n5_stats(self, global_hierarchy):
+    def calculate_individual_n1_to_n5_stats(self, global_hierarchy, volumes=None, windows=None):
         """Calcula estatísticas N1-N5 para cada afiliado (TOTAL = N1+N2+N3+N4+N5)"""
         logger.info("Calculando estatísticas individuais N1-N5")
         
         individual_stats = {}
+        downline = {}  # além de N5: indicações abaixo de cada afiliado, calculadas uma vez
         
         for affiliate_id in global_hierarchy.keys():
-            stats = self._calculate_affiliate_n1_to_n5(affiliate_id, global_hierarchy)
+            stats = self._calculate_affiliate_n1_to_n5(affiliate_id, global_hierarchy, volumes, windows, downline)
             individual_stats[affiliate_id] = stats
         
         logger.info(f"Estatísticas calculadas para {len(individual_stats)} afiliados")
         return individual_stats
 
-    def _calculate_affiliate_n1_to_n5(self, affiliate_id, global_hierarchy):
-        """Calcula N1-N5 de um afiliado específico"""
+    def _downline_edges(self, affiliate_id, global_hierarchy, memo):
+        """Indicações em toda a rede abaixo do afiliado (uma por caminho); None se a rede tem ciclo
+
+        memo guarda o resultado de cada afiliado visitado: em redes profundas o
+        N6+ de cada ancestral reaproveita a contagem em vez de percorrer a cadeia.
+        """
+        if affiliate_id in memo:
+            return memo[affiliate_id]
+        
+        def children_of(current_id):
+            return iter(global_hierarchy.get(current_id, {}).get('children', []))
+        
+        on_path = {affiliate_id}
+        totals = {affiliate_id: 0}
+        stack = [(affiliate_id, children_of(affiliate_id))]
+        while stack:
+            current_id, pending = stack[-1]
+            child_id = next(pending, None)
+            if child_id is None:
+                stack.pop()
+                on_path.discard(current_id)
+                memo[current_id] = total = totals.pop(current_id)
+                if stack:
+                    parent_id = stack[-1][0]
+                    if totals[parent_id] is not None:
+                        totals[parent_id] = None if total is None else totals[parent_id] + total
+                continue
+            
+            if totals[current_id] is not None:
+                totals[current_id] += 1
+            if child_id not in global_hierarchy:
+                continue
+            if child_id in on_path:
+                totals[current_id] = None  # ciclo: contagem depende do caminho
+            elif child_id in memo:
+                if memo[child_id] is None:
+                    totals[current_id] = None
+                elif totals[current_id] is not None:
+                    totals[current_id] += memo[child_id]
+            else:
+                on_path.add(child_id)
+                totals[child_id] = 0
+                stack.append((child_id, children_of(child_id)))
+        return memo[affiliate_id]
+
+    def _calculate_affiliate_n1_to_n5(self, affiliate_id, global_hierarchy, volumes=None, windows=None,
+                                      downline=None):
+        """Calcula N1-N5 de um afiliado específico (volume e janelas por nível no mesmo passe)"""
         
         stats = {
             'affiliate_id': affiliate_id,
             'levels': {1: [], 2: [], 3: [], 4: [], 5: []},
             'level_counts': {1: 0, 2: 0, 3: 0, 4: 0, 5: 0},
+            'level_volumes': {1: ZERO, 2: ZERO, 3: ZERO, 4: ZERO, 5: ZERO},
+            **{f'level_{name}': {1: 0, 2: 0, 3: 0, 4: 0, 5: 0} for name, _ in GROWTH_WINDOWS},
             'total_n1_to_n5': 0,  # APENAS N1+N2+N3+N4+N5
             'beyond_n5': 0  # N6+ (não conta no total, mas existe)
         }
         
-        def map_levels_recursive(current_id, relative_level, visited=None):
-            if visited is None:
-                visited = set()
-            
-            if current_id in visited:
-                return  # Evitar loops
-            visited.add(current_id)
+        def children_of(current_id):
+            return iter(global_hierarchy.get(current_id, {}).get('children', []))
+        
+        # Profundidade com pilha explícita (redes com milhares de níveis); on_path
+        # guarda o caminho atual para não repetir afiliados de um ciclo
+        on_path = {affiliate_id}
+        stack = [(affiliate_id, 1, children_of(affiliate_id))]
+        while stack:
+            current_id, relative_level, pending = stack[-1]
+            child_id = next(pending, None)
+            if child_id is None:
+                stack.pop()
+                on_path.discard(current_id)
+                continue
             
-            current_data = global_hierarchy.get(current_id, {})
-            affiliate_children = current_data.get('affiliate_children', [])
-            all_children = current_data.get('children', [])
+            if relative_level <= 5:
+                # Contar no nível apropriado (N1-N5)
+                if child_id in global_hierarchy:
+                    # Filho que também é afiliado
+                    stats['levels'][relative_level].append(child_id)
+                
+                stats['level_counts'][relative_level] += 1
+                stats['total_n1_to_n5'] += 1
+                if volumes:
+                    stats['level_volumes'][relative_level] += volumes.get(child_id, ZERO)
+                if windows:
+                    for name, members in windows.items():
+                        if (current_id, child_id) in members:
+                            stats[f'level_{name}'][relative_level] += 1
+            else:
+                # N6+ - não conta no total do afiliado pai
+                stats['beyond_n5'] += 1
             
-            for child_id in all_children:
-                if relative_level <= 5:
-                    # Contar no nível apropriado (N1-N5)
-                    if child_id in global_hierarchy:
-                        # Filho que também é afiliado
-                        stats['levels'][relative_level].append(child_id)
-                    
-                    stats['level_counts'][relative_level] += 1
-                    stats['total_n1_to_n5'] += 1
-                    
-                    # Continuar para próximo nível se o filho é afiliado
-                    if child_id in global_hierarchy:
-                        map_levels_recursive(child_id, relative_level + 1, visited.copy())
-                else:
-                    # N6+ - não conta no total do afiliado pai
-                    stats['beyond_n5'] += 1
-                    
-                    # Mas continuar mapeando para outros afiliados
-                    if child_id in global_hierarchy:
-                        map_levels_recursive(child_id, relative_level + 1, visited.copy())
-        
-        # Executar mapeamento
-        map_levels_recursive(affiliate_id, 1)
+            # Continuar para o próximo nível se o filho é afiliado (N6+ também é mapeado)
+            if child_id in global_hierarchy and child_id not in on_path:
+                if relative_level >= 5 and downline is not None:
+                    # Rede abaixo sem ciclo: N6+ é a contagem já calculada
+                    edges = self._downline_edges(child_id, global_hierarchy, downline)
+                    if edges is not None:
+                        stats['beyond_n5'] += edges
+                        continue
+                on_path.add(child_id)
+                stack.append((child_id, relative_level + 1, children_of(child_id)))
         
         return stats
 
+    def hierarchy_rows(self, global_hierarchy):
+        """Linhas de mlm_hierarchy por afiliado (parent, nível, path, downline, diretos)"""
+        return {
+            affiliate_id: (
+                data.get('parent_id'),
+                data.get('global_level'),
+                data.get('path'),
+                len(data.get('children', [])),  # Total de filhos diretos
+                data.get('direct_referrals', 0)
+            )
+            for affiliate_id, data in global_hierarchy.items()
+        }
+
+    def level_rows(self, individual_stats):
+        """Linha de níveis por afiliado (contagens e métricas de LEVEL_METRICS)"""
+        return {
+            affiliate_id: (
+                *(stats['level_counts'].get(level, 0) for level in range(1, 6)),
+                stats['total_n1_to_n5'],
+                stats['beyond_n5'],  # N6+ vai para indirect_count da linha total
+                *(stats[key].get(level, 0) for key in LEVEL_METRICS.values() for level in range(1, 6))
+            )
+            for affiliate_id, stats in individual_stats.items()
+        }
+
     def persist_hierarchy(self, global_hierarchy):
-        """Persiste hierarquia infinita no banco"""
+        """Persiste hierarquia infinita no banco (apenas diferenças quando há baseline)"""
+        rows = self.hierarchy_rows(global_hierarchy)
+        self._pending_hierarchy = rows
+        
         try:
             with self.mlm_conn.cursor() as cursor:
-                # Limpar dados existentes
-                cursor.execute("DELETE FROM mlm_hierarchy")
+                baseline = self.baseline_hierarchy
+                if baseline is None:
+                    # Sem baseline: regrava a tabela inteira
+                    cursor.execute("DELETE FROM mlm_hierarchy")
+                    changed = list(rows)
+                else:
+                    removed = [affiliate_id for affiliate_id in baseline if affiliate_id not in rows]
+                    if removed:
+                        cursor.execute("DELETE FROM mlm_hierarchy WHERE affiliate_id = ANY(%s)", (removed,))
+                    changed = [affiliate_id for affiliate_id, row in rows.items() if baseline.get(affiliate_id) != row]
+                    logger.info(f"Hierarquia: {len(changed)} alterados, {len(removed)} removidos em relação ao baseline")
                 
-                # Inserir hierarquia completa
-                for affiliate_id, data in global_hierarchy.items():
-                    cursor.execute("""
-                        INSERT INTO mlm_hierarchy (
-                            affiliate_id, parent_id, level, path, 
-                            total_downline, direct_referrals, status, 
-                            created_at, updated_at
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        affiliate_id,
-                        data.get('parent_id'),
-                        data.get('global_level'),
-                        data.get('path'),
-                        len(data.get('children', [])),  # Total de filhos diretos
-                        data.get('direct_referrals', 0),
-                        'active',
-                        datetime.now(),
-                        datetime.now()
-                    ))
+                self._upsert_hierarchy_rows(cursor, {affiliate_id: rows[affiliate_id] for affiliate_id in changed})
                 
-                logger.info(f"Persistidos {len(global_hierarchy)} registros na hierarquia")
-                return len(global_hierarchy)
+                logger.info(f"Persistidos {len(changed)} registros na hierarquia")
+                return len(changed)
                 
         except Exception as e:
             logger.error(f"Erro ao persistir hierarquia: {e}")
             raise
 
     def persist_level_stats(self, individual_stats):
-        """Persiste estatísticas N1-N5 por afiliado"""
+        """Persiste estatísticas N1-N5 por afiliado (apenas diferenças quando há baseline)"""
+        rows = self.level_rows(individual_stats)
+        self._pending_levels = rows
+        
         try:
             with self.mlm_conn.cursor() as cursor:
-                # Limpar dados existentes
-                cursor.execute("DELETE FROM mlm_levels")
+                baseline = self.baseline_levels
+                if baseline is None:
+                    # Sem baseline: regrava a tabela inteira
+                    cursor.execute("DELETE FROM mlm_levels")
+                    cursor.execute("DELETE FROM mlm_affiliate_stats")
+                    changed = list(rows)
+                else:
+                    removed = [affiliate_id for affiliate_id in baseline if affiliate_id not in rows]
+                    if removed:
+                        cursor.execute("DELETE FROM mlm_levels WHERE affiliate_id = ANY(%s)", (removed,))
+                        cursor.execute("DELETE FROM mlm_affiliate_stats WHERE affiliate_id = ANY(%s)", (removed,))
+                    changed = [affiliate_id for affiliate_id, row in rows.items() if baseline.get(affiliate_id) != row]
+                    logger.info(f"Níveis: {len(changed)} afiliados alterados, {len(removed)} removidos em relação ao baseline")
                 
-                # Inserir estatísticas por nível
-                count = 0
-                for affiliate_id, stats in individual_stats.items():
-                    # Inserir estatísticas para cada nível (N1-N5)
-                    for level in range(1, 6):
-                        level_count = stats['level_counts'].get(level, 0)
-                        cursor.execute("""
-                            INSERT INTO mlm_levels (
-                                affiliate_id, level, direct_count, indirect_count,
-                                total_volume, commission_rate, last_calculated
-                            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        """, (
-                            affiliate_id,
-                            level,
-                            level_count,
-                            0,  # indirect_count pode ser calculado separadamente
-                            0.0,  # total_volume baseado em transações
-                            self._get_commission_rate(level),
-                            datetime.now()
-                        ))
-                        count += 1
-                    
-                    # Inserir total geral (N1+N2+N3+N4+N5)
-                    cursor.execute("""
-                        INSERT INTO mlm_levels (
-                            affiliate_id, level, direct_count, indirect_count,
-                            total_volume, commission_rate, last_calculated
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        affiliate_id,
-                        0,  # level 0 = total
-                        stats['total_n1_to_n5'],
-                        stats['beyond_n5'],  # N6+ vai para indirect_count
-                        0.0,
-                        0.0,
-                        datetime.now()
-                    ))
-                    count += 1
+                persisted = self._upsert_level_rows(cursor, {affiliate_id: rows[affiliate_id] for affiliate_id in changed})
                 
-                logger.info(f"Persistidas {count} estatísticas de níveis")
-                return count
+                logger.info(f"Persistidas {persisted} estatísticas de níveis")
+                return persisted
                 
         except Exception as e:
             logger.error(f"Erro ao persistir estatísticas: {e}")
             raise
 
+    def persist_changes(self, changes):
+        """Persiste o ChangeSet do motor incremental e mantém o baseline coerente"""
+        with self.mlm_conn.cursor() as cursor:
+            if changes.hierarchy_deletes:
+                cursor.execute("DELETE FROM mlm_hierarchy WHERE affiliate_id = ANY(%s)", (changes.hierarchy_deletes,))
+            if changes.level_deletes:
+                cursor.execute("DELETE FROM mlm_levels WHERE affiliate_id = ANY(%s)", (changes.level_deletes,))
+                cursor.execute("DELETE FROM mlm_affiliate_stats WHERE affiliate_id = ANY(%s)", (changes.level_deletes,))
+            self._upsert_hierarchy_rows(cursor, changes.hierarchy_upserts)
+            persisted = self._upsert_level_rows(cursor, changes.level_upserts)
+        
+        if self.baseline_hierarchy is not None:
+            for affiliate_id in changes.hierarchy_deletes:
+                self.baseline_hierarchy.pop(affiliate_id, None)
+            self.baseline_hierarchy.update(changes.hierarchy_upserts)
+        if self.baseline_levels is not None:
+            for affiliate_id in changes.level_deletes:
+                self.baseline_levels.pop(affiliate_id, None)
+            self.baseline_levels.update(changes.level_upserts)
+        
+        return len(changes.hierarchy_upserts) + len(changes.hierarchy_deletes) + persisted + len(changes.level_deletes)
+
+    def _upsert_hierarchy_rows(self, cursor, rows):
+        """INSERT ... ON CONFLICT em lote das linhas (parent, nível, path, downline, diretos)"""
+        now = datetime.now()
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO mlm_hierarchy (
+                affiliate_id, parent_id, level, path,
+                total_downline, direct_referrals, status,
+                created_at, updated_at
+            ) VALUES %s
+            ON CONFLICT (affiliate_id) DO UPDATE SET
+                parent_id = EXCLUDED.parent_id,
+                level = EXCLUDED.level,
+                path = EXCLUDED.path,
+                total_downline = EXCLUDED.total_downline,
+                direct_referrals = EXCLUDED.direct_referrals,
+                status = EXCLUDED.status,
+                updated_at = EXCLUDED.updated_at
+        """, [
+            (affiliate_id, *row, 'active', now, now)
+            for affiliate_id, row in rows.items()
+        ], page_size=1000)
+        return len(rows)
+
+    def _upsert_level_rows(self, cursor, rows):
+        """Grava as 6 linhas de mlm_levels (N1-N5 e total) com volume e comissão de cada afiliado"""
+        values = self.level_values(rows)
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO mlm_levels (
+                affiliate_id, level, direct_count, indirect_count,
+                total_volume, commission_rate, commission_earned,
+                new_1d, new_7d, new_30d, last_calculated
+            ) VALUES %s
+            ON CONFLICT (affiliate_id, level) DO UPDATE SET
+                direct_count = EXCLUDED.direct_count,
+                indirect_count = EXCLUDED.indirect_count,
+                total_volume = EXCLUDED.total_volume,
+                commission_rate = EXCLUDED.commission_rate,
+                commission_earned = EXCLUDED.commission_earned,
+                new_1d = EXCLUDED.new_1d,
+                new_7d = EXCLUDED.new_7d,
+                new_30d = EXCLUDED.new_30d,
+                last_calculated = EXCLUDED.last_calculated
+        """, values, page_size=1000)
+        # Mesmas contagens em linha única por afiliado (busca por faixas)
+        upsert_affiliate_stats(cursor, self.affiliate_stats_values(rows))
+        return len(values)
+
+    def affiliate_stats_values(self, rows):
+        """Linha de mlm_affiliate_stats por afiliado (N1..N5, total, além de N5, volume)"""
+        now = datetime.now()
+        volume_offset = METRIC_OFFSETS['volume']
+        return [
+            (
+                affiliate_id, *counts[:LEVEL_ROW_COUNTS],
+                sum(counts[volume_offset:volume_offset + 5], ZERO), now
+            )
+            for affiliate_id, counts in rows.items()
+        ]
+
+    def level_values(self, rows):
+        """Expande cada linha de níveis nas 6 tuplas de mlm_levels (N1-N5 e total)"""
+        now = datetime.now()
+        values = []
+        volume_offset = METRIC_OFFSETS['volume']
+        window_offsets = [METRIC_OFFSETS[name] for name, _ in GROWTH_WINDOWS]
+        for affiliate_id, counts in rows.items():
+            total_volume = ZERO
+            total_commission = ZERO
+            total_new = [0] * len(window_offsets)
+            # Estatísticas para cada nível (N1-N5)
+            for level in range(1, 6):
+                rate = self._get_commission_rate(level)
+                volume = counts[volume_offset + level - 1]
+                commission = (volume * Decimal(str(rate))).quantize(CENT)
+                new = [counts[offset + level - 1] for offset in window_offsets]
+                total_volume += volume
+                total_commission += commission
+                total_new = [a + b for a, b in zip(total_new, new)]
+                values.append((
+                    affiliate_id, level, counts[level - 1],
+                    0,  # indirect_count pode ser calculado separadamente
+                    volume, rate, commission, *new, now
+                ))
+            # Total geral (N1+N2+N3+N4+N5), level 0 = total; N6+ vai para indirect_count
+            values.append((affiliate_id, 0, counts[5], counts[6], total_volume, 0.0, total_commission, *total_new, now))
+        return values
+
     def _get_commission_rate(self, level):
         """Taxa de comissão por nível"""
         rates = {1: 0.05, 2: 0.03, 3: 0.02, 4: 0.01, 5: 0.005}
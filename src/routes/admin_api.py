@@ -0,0 +1,190 @@
+from flask import Blueprint, jsonify, request, current_app
+from datetime import datetime
+from functools import wraps
+import hmac
+import logging
+
+from src.models.query_log import query_log
+from src.models.single_flight import single_flight
+
+logger = logging.getLogger(__name__)
+
+admin_bp = Blueprint('admin', __name__)
+
+
+def admin_token_error():
+    """Resposta de erro quando X-Admin-Token não confere com ADMIN_TOKEN (None se autorizado)
+
+    Sem ADMIN_TOKEN configurado as rotas protegidas ficam desativadas.
+    """
+    token = current_app.config.get('ADMIN_TOKEN')
+    if not token:
+        return jsonify({
+            'status': 'error',
+            'message': 'Rota administrativa desativada: defina ADMIN_TOKEN'
+        }), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        return jsonify({
+            'status': 'error',
+            'message': 'Token administrativo inválido'
+        }), 401
+    return None
+
+
+def require_admin_token(func):
+    """Decorator para rotas de outros blueprints que alteram estado"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        error = admin_token_error()
+        if error:
+            return error
+        return func(*args, **kwargs)
+    return wrapper
+
+
+@admin_bp.before_request
+def check_admin_token():
+    """Exige X-Admin-Token em todas as rotas administrativas"""
+    return admin_token_error()
+
+
+@admin_bp.route('/slow-queries', methods=['GET', 'DELETE'])
+def slow_queries():
+    """Lista (ou limpa) o ring buffer de consultas lentas"""
+    try:
+        if request.method == 'DELETE':
+            query_log.clear()
+            return jsonify({
+                'status': 'success',
+                'message': 'Log de consultas lentas limpo'
+            })
+
+        limit = request.args.get('limit', 50, type=int)
+        entries = query_log.entries(limit=limit)
+
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'settings': query_log.settings(),
+                'entries': entries,
+                'total_records': len(entries)
+            },
+            'timestamp': datetime.now().isoformat()
+        })
+
+    except Exception as e:
+        logger.error(f"Erro ao buscar consultas lentas: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+
+
+@admin_bp.route('/query-stats')
+def query_stats():
+    """Tempos agregados por instrução (ordenados por tempo total)"""
+    try:
+        limit = request.args.get('limit', 50, type=int)
+
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'settings': query_log.settings(),
+                'statements': query_log.stats(limit=limit)
+            },
+            'timestamp': datetime.now().isoformat()
+        })
+
+    except Exception as e:
+        logger.error(f"Erro ao buscar estatísticas de consultas: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+
+
+@admin_bp.route('/slow-queries/config', methods=['POST'])
+def slow_query_config():
+    """Atualiza limite, amostragem e capacidade do log de consultas lentas"""
+    try:
+        data = request.get_json()
+
+        if not data:
+            return jsonify({
+                'status': 'error',
+                'message': 'Dados JSON não fornecidos'
+            }), 400
+
+        threshold_ms = data.get('threshold_ms')
+        sample_rate = data.get('sample_rate')
+        capacity = data.get('capacity')
+
+        if threshold_ms is not None and (not isinstance(threshold_ms, (int, float)) or threshold_ms < 0):
+            return jsonify({
+                'status': 'error',
+                'message': 'threshold_ms deve ser um número >= 0'
+            }), 400
+
+        if sample_rate is not None and (not isinstance(sample_rate, (int, float)) or not 0 <= sample_rate <= 1):
+            return jsonify({
+                'status': 'error',
+                'message': 'sample_rate deve estar entre 0 e 1'
+            }), 400
+
+        if capacity is not None and (not isinstance(capacity, int) or capacity < 1):
+            return jsonify({
+                'status': 'error',
+                'message': 'capacity deve ser um inteiro >= 1'
+            }), 400
+
+        query_log.configure(
+            threshold_ms=threshold_ms,
+            sample_rate=sample_rate,
+            capacity=capacity,
+            explain=data.get('explain')
+        )
+        logger.info(f"Log de consultas lentas reconfigurado: {query_log.settings()}")
+
+        return jsonify({
+            'status': 'success',
+            'message': 'Configurações atualizadas',
+            'data': query_log.settings()
+        })
+
+    except Exception as e:
+        logger.error(f"Erro ao configurar log de consultas lentas: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+
+
+@admin_bp.route('/single-flight', methods=['GET', 'DELETE'])
+def single_flight_stats():
+    """Chaves de leitura mais coalescidas (ou limpa as estatísticas)"""
+    try:
+        if request.method == 'DELETE':
+            single_flight.reset()
+            return jsonify({
+                'status': 'success',
+                'message': 'Estatísticas de single-flight limpas'
+            })
+
+        limit = request.args.get('limit', 50, type=int)
+
+        return jsonify({
+            'status': 'success',
+            'data': single_flight.stats(limit=limit),
+            'timestamp': datetime.now().isoformat()
+        })
+
+    except Exception as e:
+        logger.error(f"Erro ao buscar estatísticas de single-flight: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
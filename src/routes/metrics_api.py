@@ -0,0 +1,90 @@
+from flask import Blueprint, Response, g, request
+import time
+import logging
+
+from src.models.metrics import (
+    registry,
+    HTTP_REQUEST_DURATION,
+    HTTP_REQUESTS,
+    HTTP_REQUEST_ERRORS,
+    DB_CONNECTIONS
+)
+
+logger = logging.getLogger(__name__)
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# Será inicializado no main.py
+mlm_db = None
+sync_service = None
+
+
+def _connection_state(conn):
+    if conn is None:
+        return 'missing'
+    return 'closed' if conn.closed else 'open'
+
+
+def _collect_connections():
+    """Atualiza gauges de conexões no momento do scrape"""
+    connections = {
+        'mlm_api': mlm_db.connection if mlm_db else None,
+        'sync_operation': sync_service.operation_conn if sync_service else None,
+        'sync_mlm': sync_service.mlm_conn if sync_service else None
+    }
+    if mlm_db and mlm_db.replicas:
+        for replica in mlm_db.replicas.replicas:
+            connections[f'mlm_{replica.name}'] = replica.connection
+    for component, conn in connections.items():
+        state = _connection_state(conn)
+        for candidate in ('open', 'closed', 'missing'):
+            DB_CONNECTIONS.set(1 if candidate == state else 0, component=component, state=candidate)
+
+
+def init_metrics_routes(mlm_database, sync_svc):
+    """Inicializa as dependências usadas pelos coletores de métricas"""
+    global mlm_db, sync_service
+    mlm_db = mlm_database
+    sync_service = sync_svc
+    registry.unregister_collector(_collect_connections)
+    registry.register_collector(_collect_connections)
+    logger.info("Rotas de métricas inicializadas")
+
+
+def _route_labels():
+    # Usa o padrão da rota (não o path) para limitar a cardinalidade
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    return {
+        'blueprint': request.blueprint or 'app',
+        'route': route,
+        'method': request.method
+    }
+
+
+@metrics_bp.before_app_request
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+@metrics_bp.after_app_request
+def _record_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+
+    try:
+        labels = _route_labels()
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, **labels)
+        HTTP_REQUESTS.inc(status=str(response.status_code), **labels)
+        if response.status_code >= 500:
+            HTTP_REQUEST_ERRORS.inc(**labels)
+    except Exception as e:
+        logger.warning(f"Erro ao registrar métricas da requisição: {e}")
+
+    return response
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    """Exposição das métricas no formato do Prometheus"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -1,7 +1,14 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from datetime import datetime
+from decimal import Decimal
+import threading
 import logging
 
+from src.models.hierarchy_engine import EdgeConflict, GROWTH_WINDOWS
+from src.models.export import Export, ExportConflict, DATASETS, FORMATS
+from src.models.affiliate_stats import SEARCH_FIELDS, STATS_COLUMNS, DEFAULT_SORT, encode_cursor, parse_value
+from src.routes.admin_api import require_admin_token
+
 # Configurar logger
 logger = logging.getLogger(__name__)
 
@@ -11,14 +18,25 @@ mlm_bp = Blueprint('mlm', __name__, url_prefix='/api/v1/mlm')
 # Variáveis globais para serviços
 mlm_db = None
 sync_service = None
+snapshot_store = None
 
-def init_mlm_routes(mlm_database, sync_svc):
+def init_mlm_routes(mlm_database, sync_svc, snapshots=None):
     """Inicializa as rotas MLM com as dependências"""
-    global mlm_db, sync_service
+    global mlm_db, sync_service, snapshot_store
     mlm_db = mlm_database
     sync_service = sync_svc
+    snapshot_store = snapshots
     logger.info("Rotas MLM inicializadas")
 
+# Exportações simultâneas (cada uma mantém uma conexão e um snapshot abertos)
+MAX_CONCURRENT_EXPORTS = 2
+EXPORT_RETRY_AFTER = 30  # segundos
+_export_slots = threading.BoundedSemaphore(MAX_CONCURRENT_EXPORTS)
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
+
 @mlm_bp.route('/health')
 def health_check():
     """Health check do serviço MLM"""
@@ -78,9 +96,9 @@ def get_hierarchy(affiliate_id):
         for record in hierarchy:
             level_data = {
                 'level': record['level'],
-                'affiliate_id': record['downline_affiliate_id'],
-                'user_id': record['user_id'],
-                'parent_affiliate_id': record['parent_affiliate_id'],
+                'affiliate_id': record['affiliate_id'],
+                'user_id': record['affiliate_id'],
+                'parent_affiliate_id': record['parent_id'],
                 'depth': record['depth'],
                 'created_at': record['created_at'].isoformat() if record['created_at'] else None,
                 'updated_at': record['updated_at'].isoformat() if record['updated_at'] else None
@@ -111,6 +129,9 @@ def get_hierarchy(affiliate_id):
 def get_affiliate_stats(affiliate_id):
     """Retorna estatísticas de um afiliado"""
     try:
+        if request.args.get('source') == 'snapshot':
+            return _snapshot_stats(affiliate_id)
+        
         if not mlm_db:
             return jsonify({
                 'status': 'error',
@@ -130,7 +151,8 @@ def get_affiliate_stats(affiliate_id):
                         'total_downline': 0,
                         'total_volume': 0,
                         'total_commissions': 0,
-                        'active_levels': 0
+                        'active_levels': 0,
+                        'growth': {name: 0 for name, _ in GROWTH_WINDOWS}
                     }
                 },
                 'message': 'Nenhuma estatística encontrada para este afiliado'
@@ -141,6 +163,7 @@ def get_affiliate_stats(affiliate_id):
         total_downline = 0
         total_volume = 0
         total_commissions = 0
+        growth = {name: 0 for name, _ in GROWTH_WINDOWS}
         
         for record in stats:
             level_data = {
@@ -151,10 +174,15 @@ def get_affiliate_stats(affiliate_id):
                 'total_volume': float(record['total_volume'] or 0),
                 'commission_rate': float(record['commission_rate'] or 0),
                 'commission_earned': float(record['commission_earned'] or 0),
+                **{name: record.get(name) or 0 for name, _ in GROWTH_WINDOWS},
                 'last_calculated': record['last_calculated'].isoformat() if record['last_calculated'] else None
             }
             
             levels_data.append(level_data)
+            if record['level'] == 0:
+                # Linha de total (N1-N5) já agrega os níveis abaixo
+                growth = {name: level_data[name] for name, _ in GROWTH_WINDOWS}
+                continue
             total_downline += level_data['total_count']
             total_volume += level_data['total_volume']
             total_commissions += level_data['commission_earned']
@@ -168,7 +196,8 @@ def get_affiliate_stats(affiliate_id):
                     'total_downline': total_downline,
                     'total_volume': total_volume,
                     'total_commissions': total_commissions,
-                    'active_levels': len(levels_data)
+                    'active_levels': len([level for level in levels_data if level['level'] > 0]),
+                    'growth': growth
                 }
             },
             'timestamp': datetime.now().isoformat()
@@ -182,6 +211,196 @@ def get_affiliate_stats(affiliate_id):
             'error': str(e)
         }), 500
 
+def _snapshot_stats(affiliate_id):
+    """Contagens N1-N5 servidas do snapshot mapeado em memória (sem banco)"""
+    snapshot = snapshot_store.current() if snapshot_store else None
+    if snapshot is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Snapshot da hierarquia indisponível'
+        }), 503
+    
+    stats = snapshot_store.level_counts(affiliate_id, snapshot=snapshot)
+    if stats is None:
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'affiliate_id': affiliate_id,
+                'levels': [],
+                'total_n1_to_n5': 0,
+                'beyond_n5': 0,
+                'growth': {name: 0 for name, _ in GROWTH_WINDOWS}
+            },
+            'source': 'snapshot',
+            'generation': snapshot.generation,
+            'message': 'Afiliado não encontrado no snapshot'
+        })
+    
+    return jsonify({
+        'status': 'success',
+        'data': {
+            'affiliate_id': affiliate_id,
+            'levels': [
+                {
+                    'level': level,
+                    'direct_count': count,
+                    **{name: stats['growth'][name][level] for name, _ in GROWTH_WINDOWS}
+                }
+                for level, count in stats['level_counts'].items()
+            ],
+            'total_n1_to_n5': stats['total_n1_to_n5'],
+            'beyond_n5': stats['beyond_n5'],
+            'growth': {name: sum(stats['growth'][name].values()) for name, _ in GROWTH_WINDOWS}
+        },
+        'source': 'snapshot',
+        'generation': snapshot.generation,
+        'timestamp': datetime.now().isoformat()
+    })
+
+def _published_snapshot():
+    """Snapshot atual somente se for da última geração publicada (senão None)"""
+    snapshot = snapshot_store.current() if snapshot_store else None
+    if snapshot is None or sync_service is None:
+        return None
+    # apply_edges e CDC publicam gerações sem gravar novo snapshot: um arquivo
+    # de geração anterior traria pais desatualizados
+    if snapshot.generation != sync_service.current_generation:
+        return None
+    return snapshot
+
+@mlm_bp.route('/upline/<int:affiliate_id>')
+def get_upline(affiliate_id):
+    """Retorna ancestrais de um afiliado (snapshot quando disponível, senão banco)"""
+    try:
+        max_depth = request.args.get('max_depth', type=int)
+        
+        snapshot = _published_snapshot()
+        if snapshot is not None:
+            upline = snapshot_store.upline(affiliate_id, max_depth, snapshot=snapshot)
+            source = 'snapshot'
+        elif mlm_db:
+            upline = mlm_db.get_affiliate_upline(affiliate_id, max_depth)
+            source = 'database'
+        else:
+            return jsonify({
+                'status': 'error',
+                'message': 'Serviço MLM não inicializado'
+            }), 500
+        
+        if upline is None:
+            return jsonify({
+                'status': 'error',
+                'message': 'Afiliado não encontrado'
+            }), 404
+        
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'affiliate_id': affiliate_id,
+                'upline': upline,
+                'depth': len(upline)
+            },
+            'source': source,
+            'generation': snapshot.generation if snapshot is not None else None,
+            'timestamp': datetime.now().isoformat()
+        })
+        
+    except Exception as e:
+        logger.error(f"Erro ao buscar upline para {affiliate_id}: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+
+EDGE_OPERATIONS = ('insert', 'remove', 'reparent')
+MAX_EDGE_OPERATIONS = 10000
+
+def _parse_edge_operations(payload):
+    """Valida corpo de /edges; retorna (operações, erro)"""
+    if isinstance(payload, dict) and 'edges' in payload:
+        payload = payload['edges']
+    elif isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list) or not payload:
+        return None, 'Informe uma operação ou a lista "edges"'
+    if len(payload) > MAX_EDGE_OPERATIONS:
+        return None, f'Máximo de {MAX_EDGE_OPERATIONS} operações por requisição'
+    
+    operations = []
+    for index, item in enumerate(payload):
+        if not isinstance(item, dict) or item.get('op') not in EDGE_OPERATIONS:
+            return None, f'Operação {index}: "op" deve ser insert, remove ou reparent'
+        parent_id, child_id = item.get('parent_id'), item.get('child_id')
+        if not isinstance(parent_id, int) or not isinstance(child_id, int) \
+                or isinstance(parent_id, bool) or isinstance(child_id, bool):
+            return None, f'Operação {index}: parent_id e child_id devem ser inteiros'
+        operation = {'op': item['op'], 'parent_id': parent_id, 'child_id': child_id}
+        if item['op'] == 'insert':
+            # Data da indicação (janelas de crescimento); padrão: agora
+            try:
+                created_at = datetime.fromisoformat(item['created_at']) if item.get('created_at') else datetime.now()
+            except (TypeError, ValueError):
+                return None, f'Operação {index}: created_at deve estar em formato ISO 8601'
+            if created_at.tzinfo is not None:
+                created_at = created_at.astimezone().replace(tzinfo=None)
+            operation['created_at'] = created_at
+        operations.append(operation)
+    return operations, None
+
+@mlm_bp.route('/edges', methods=['POST'])
+@require_admin_token
+def ingest_edges():
+    """Aplica inserção/remoção/re-parent de indicações de forma incremental
+
+    As arestas são ajustes temporários: tracked continua sendo a fonte da
+    verdade e a próxima sincronização completa (ou ressincronização do CDC)
+    desfaz o que não estiver lá.
+    """
+    try:
+        operations, error = _parse_edge_operations(request.get_json(silent=True))
+        if error:
+            return jsonify({
+                'status': 'error',
+                'message': error
+            }), 400
+        
+        if not sync_service or sync_service.engine is None:
+            return jsonify({
+                'status': 'error',
+                'message': 'Motor incremental indisponível (aguardando sincronização completa)'
+            }), 503
+        
+        try:
+            result = sync_service.apply_edges(operations)
+        except EdgeConflict as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e),
+                'operation_index': getattr(e, 'index', None),
+                'applied': 0
+            }), 409
+        
+        return jsonify({
+            'status': 'success',
+            'data': result,
+            'timestamp': datetime.now().isoformat()
+        })
+        
+    except Exception as e:
+        logger.error(f"Erro ao aplicar arestas: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+
+def _parse_date(value):
+    """Converte YYYY-MM-DD em date (None se ausente); ValueError se inválida"""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
 @mlm_bp.route('/commissions/<int:affiliate_id>')
 def get_commissions(affiliate_id):
     """Retorna comissões de um afiliado"""
@@ -191,29 +410,76 @@ def get_commissions(affiliate_id):
         end_date = request.args.get('end_date')
         level = request.args.get('level', type=int)
         status = request.args.get('status', 'all')
+        limit = min(request.args.get('limit', 100, type=int), 1000)
         
-        # TODO: Implementar consulta de comissões
-        # Por enquanto, retornar dados mock
+        try:
+            start = _parse_date(start_date)
+            end = _parse_date(end_date)
+        except ValueError:
+            return jsonify({
+                'status': 'error',
+                'message': 'Datas devem estar no formato YYYY-MM-DD'
+            }), 400
+        
+        if not mlm_db:
+            return jsonify({
+                'status': 'error',
+                'message': 'Serviço MLM não inicializado'
+            }), 500
+        
+        status_filter = None if status == 'all' else status
+        
+        # Resumo do período vem do rollup diário (sem varrer comissões brutas)
+        summary_rows = mlm_db.get_commission_summary(affiliate_id, start, end, level, status_filter)
+        commissions = mlm_db.get_commissions(affiliate_id, start, end, level, status_filter, limit)
+        
+        summary = {
+            'total_amount': 0,
+            'pending_amount': 0,
+            'paid_amount': 0,
+            'total_transactions': 0,
+            'by_level': {}
+        }
+        for row in summary_rows:
+            amount = float(row['total_amount'] or 0)
+            summary['total_amount'] += amount
+            summary['total_transactions'] += int(row['total_transactions'] or 0)
+            if row['payment_status'] == 'pending':
+                summary['pending_amount'] += amount
+            elif row['payment_status'] == 'paid':
+                summary['paid_amount'] += amount
+            level_key = str(row['level'])
+            summary['by_level'][level_key] = summary['by_level'].get(level_key, 0) + amount
+        
+        commissions_data = [
+            {
+                'id': record['id'],
+                'transaction_id': record['transaction_id'],
+                'level': record['level'],
+                'commission_amount': float(record['commission_amount'] or 0),
+                'commission_rate': float(record['commission_rate'] or 0),
+                'base_amount': float(record['base_amount'] or 0),
+                'calculation_date': record['calculation_date'].isoformat() if record['calculation_date'] else None,
+                'payment_status': record['payment_status'],
+                'payment_date': record['payment_date'].isoformat() if record['payment_date'] else None
+            }
+            for record in commissions
+        ]
         
         return jsonify({
             'status': 'success',
             'data': {
                 'affiliate_id': affiliate_id,
-                'commissions': [],
-                'summary': {
-                    'total_amount': 0,
-                    'pending_amount': 0,
-                    'paid_amount': 0,
-                    'total_transactions': 0
-                },
+                'commissions': commissions_data,
+                'summary': summary,
                 'filters': {
                     'start_date': start_date,
                     'end_date': end_date,
                     'level': level,
-                    'status': status
+                    'status': status,
+                    'limit': limit
                 }
             },
-            'message': 'Funcionalidade de comissões em desenvolvimento',
             'timestamp': datetime.now().isoformat()
         })
         
@@ -225,6 +491,216 @@ def get_commissions(affiliate_id):
             'error': str(e)
         }), 500
 
+def _wants_gzip():
+    value = request.args.get('gzip')
+    if value is not None:
+        return value.lower() in ('1', 'true')
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+def _finish_export(export):
+    """Fecha a exportação e devolve a vaga quando o servidor fecha a resposta
+
+    Vale também para respostas cujo corpo nunca é iterado (HEAD, cliente que
+    cai antes do primeiro byte), em que o finally do gerador não roda.
+    """
+    def finish():
+        try:
+            export.close()
+        except Exception as e:
+            logger.warning(f"Erro ao fechar exportação de {export.dataset}: {e}")
+        finally:
+            _export_slots.release()
+    return finish
+
+@mlm_bp.route('/export/<dataset>')
+def export_dataset(dataset):
+    """Exporta mlm_hierarchy ou mlm_levels inteiros em CSV/NDJSON (streaming)"""
+    if not mlm_db:
+        return jsonify({
+            'status': 'error',
+            'message': 'Serviço MLM não inicializado'
+        }), 500
+    
+    fmt = request.args.get('format', 'csv').lower()
+    if dataset not in DATASETS or fmt not in FORMATS:
+        return jsonify({
+            'status': 'error',
+            'message': f"Use /export/<{'|'.join(sorted(DATASETS))}>?format=<{'|'.join(FORMATS)}>"
+        }), 400 if dataset in DATASETS else 404
+    
+    generation = request.args.get('generation', type=int)
+    compress = _wants_gzip()
+    
+    if not _export_slots.acquire(blocking=False):
+        response = jsonify({
+            'status': 'error',
+            'message': f'Limite de {MAX_CONCURRENT_EXPORTS} exportações simultâneas atingido'
+        })
+        response.headers['Retry-After'] = str(EXPORT_RETRY_AFTER)
+        return response, 503
+    
+    try:
+        export = Export(mlm_db.db_url, dataset, fmt=fmt, generation=generation, compress=compress)
+    except ExportConflict as e:
+        _export_slots.release()
+        response = jsonify({
+            'status': 'error',
+            'message': str(e),
+            'generation': e.generation
+        })
+        if e.retry:
+            response.headers['Retry-After'] = str(EXPORT_RETRY_AFTER)
+            return response, 503
+        return response, 409
+    except Exception as e:
+        _export_slots.release()
+        logger.error(f"Erro ao iniciar exportação de {dataset}: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+    
+    extension = f"{fmt}.gz" if compress else fmt
+    response = Response(export.stream(), mimetype=None, content_type=EXPORT_CONTENT_TYPES[fmt])
+    response.call_on_close(_finish_export(export))
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename="mlm_{dataset}_g{export.generation or 0}.{extension}"'
+    )
+    response.headers['X-MLM-Generation'] = str(export.generation or '')
+    response.headers['X-MLM-Generation-Consistent'] = 'false' if export.dirty else 'true'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@mlm_bp.route('/leaderboard')
+def get_leaderboard():
+    """Ranking dos maiores afiliados por rede (level 0 = total N1-N5), paginado"""
+    try:
+        level = request.args.get('level', 0, type=int)
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 50, type=int)
+        
+        if level < 0 or level > 5:
+            return jsonify({
+                'status': 'error',
+                'message': 'Nível deve estar entre 0 (total N1-N5) e 5'
+            }), 400
+        if page < 1 or per_page < 1 or per_page > 500:
+            return jsonify({
+                'status': 'error',
+                'message': 'page deve ser >= 1 e per_page entre 1 e 500'
+            }), 400
+        
+        if not mlm_db:
+            return jsonify({
+                'status': 'error',
+                'message': 'Serviço MLM não inicializado'
+            }), 500
+        
+        # Uma linha a mais indica se há próxima página
+        rows = mlm_db.get_leaderboard(level, (page - 1) * per_page, per_page + 1)
+        entries = [
+            {
+                'rank': row['rank'],
+                'affiliate_id': row['affiliate_id'],
+                'value': row['value']
+            }
+            for row in rows[:per_page]
+        ]
+        
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'level': level,
+                'metric': 'total_n1_to_n5' if level == 0 else f'n{level}',
+                'page': page,
+                'per_page': per_page,
+                'has_more': len(rows) > per_page,
+                'generation': rows[0]['generation'] if rows else None,
+                'entries': entries
+            },
+            'timestamp': datetime.now().isoformat()
+        })
+        
+    except Exception as e:
+        logger.error(f"Erro ao buscar ranking: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+
+def _json_number(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+@mlm_bp.route('/affiliates/search')
+def search_affiliates():
+    """Afiliados por faixas de N1..N5, total, além de N5 e volume (paginação por cursor)"""
+    try:
+        if not mlm_db:
+            return jsonify({
+                'status': 'error',
+                'message': 'Serviço MLM não inicializado'
+            }), 500
+        
+        sort = request.args.get('sort', DEFAULT_SORT)
+        order = request.args.get('order', 'desc').lower()
+        after = request.args.get('cursor')
+        
+        try:
+            # Filtros <campo>_min / <campo>_max (ex.: n1_min=10&total_min=100&total_max=1000);
+            # valor inválido é erro, não filtro ignorado
+            filters = {}
+            for field in SEARCH_FIELDS:
+                bounds = tuple(
+                    parse_value(field, request.args[name]) if name in request.args else None
+                    for name in (f'{field}_min', f'{field}_max')
+                )
+                if bounds != (None, None):
+                    filters[field] = bounds
+            limit = parse_value('limit', request.args.get('limit', '50'))
+            rows = mlm_db.search_affiliates(filters, sort, order, after, limit)
+        except ValueError as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 400
+        
+        page = rows[:limit]
+        affiliates = [
+            {
+                'affiliate_id': row['affiliate_id'],
+                **{column: row[column] for column in STATS_COLUMNS if column != 'total_volume'},
+                'total_volume': float(row['total_volume'] or 0)
+            }
+            for row in page
+        ]
+        
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'affiliates': affiliates,
+                'next_cursor': encode_cursor(sort, page[-1]) if len(rows) > limit else None,
+                'filters': {
+                    field: {'min': _json_number(minimum), 'max': _json_number(maximum)}
+                    for field, (minimum, maximum) in filters.items()
+                },
+                'sort': sort,
+                'order': order,
+                'limit': limit
+            },
+            'timestamp': datetime.now().isoformat()
+        })
+        
+    except Exception as e:
+        logger.error(f"Erro na busca de afiliados: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Erro interno do servidor',
+            'error': str(e)
+        }), 500
+
 @mlm_bp.route('/summary')
 def get_summary():
     """Retorna resumo geral do sistema MLM"""
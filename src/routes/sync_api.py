@@ -2,6 +2,11 @@ from flask import Blueprint, jsonify, request
 from datetime import datetime
 import logging
 
+from src.models.health import sync_lag_info
+from src.models.shadow_sync import STATS_ENGINES, DEFAULT_ENGINE
+from src.models.admission import admission
+from src.routes.admin_api import admin_token_error
+
 logger = logging.getLogger(__name__)
 
 sync_bp = Blueprint('sync', __name__)
@@ -9,16 +14,21 @@ sync_bp = Blueprint('sync', __name__)
 # Será inicializado no main.py
 sync_service = None
 mlm_db = None
+health_sampler = None
 
-def init_sync_services(sync_instance, db_instance):
+def init_sync_services(sync_instance, db_instance, sampler=None):
     """Inicializa instâncias dos serviços de sincronização"""
-    global sync_service, mlm_db
+    global sync_service, mlm_db, health_sampler
     sync_service = sync_instance
     mlm_db = db_instance
+    health_sampler = sampler
+
+MAX_MANUAL_WAIT = 300  # segundos
+MAX_SHADOW_SAMPLE = 500  # afiliados divergentes detalhados no relatório sombra
 
 @sync_bp.route('/manual', methods=['POST'])
 def manual_sync():
-    """Executa sincronização manual"""
+    """Enfileira sincronização manual (agregada a um job já na fila, se houver)"""
     try:
         if not sync_service:
             return jsonify({
@@ -26,25 +36,27 @@ def manual_sync():
                 'message': 'Serviço de sincronização não inicializado'
             }), 500
         
-        logger.info("Iniciando sincronização manual")
-        start_time = datetime.now()
+        wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_MANUAL_WAIT)
+        job = sync_service.scheduler.submit('manual')
+        logger.info(f"Sincronização manual enfileirada: job {job.job_id} ({job.coalesced} pedidos agregados)")
         
-        # Executar sincronização
-        sync_service.sync_data()
-        
-        end_time = datetime.now()
-        duration = (end_time - start_time).total_seconds()
+        # ?wait=N: aguarda até N segundos pelo término (compatível com chamadas síncronas)
+        if wait and job.done.wait(wait):
+            return jsonify({
+                'status': 'success' if job.status == 'completed' else 'error',
+                'message': 'Sincronização manual concluída' if job.status == 'completed' else 'Erro na sincronização manual',
+                'data': job.to_dict()
+            }), 200 if job.status == 'completed' else 500
         
         return jsonify({
-            'status': 'success',
-            'message': 'Sincronização manual concluída',
-            'data': {
-                'start_time': start_time.isoformat(),
-                'end_time': end_time.isoformat(),
-                'duration_seconds': duration,
-                'last_sync': sync_service.last_sync.isoformat() if sync_service.last_sync else None
+            'status': 'accepted',
+            'message': 'Sincronização agregada a job já na fila' if job.coalesced else 'Sincronização enfileirada',
+            'data': job.to_dict(),
+            'links': {
+                'job': f'/api/v1/sync/jobs/{job.job_id}',
+                'queue': '/api/v1/sync/queue'
             }
-        })
+        }), 202
         
     except Exception as e:
         logger.error(f"Erro na sincronização manual: {e}")
@@ -54,6 +66,121 @@ def manual_sync():
             'error': str(e)
         }), 500
 
+@sync_bp.route('/jobs/<job_id>')
+def sync_job(job_id):
+    """Estado de um job de sincronização"""
+    if not sync_service:
+        return jsonify({
+            'status': 'error',
+            'message': 'Serviço de sincronização não inicializado'
+        }), 500
+    
+    job = sync_service.scheduler.job(job_id)
+    if job is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Job não encontrado (ou fora do histórico recente)'
+        }), 404
+    
+    return jsonify({
+        'status': 'success',
+        'data': job.to_dict(),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@sync_bp.route('/queue')
+def sync_queue():
+    """Fila do agendador: job em execução, job enfileirado, próxima execução e histórico"""
+    if not sync_service:
+        return jsonify({
+            'status': 'error',
+            'message': 'Serviço de sincronização não inicializado'
+        }), 500
+    
+    return jsonify({
+        'status': 'success',
+        'data': sync_service.scheduler.status(limit=request.args.get('limit', 20, type=int)),
+        'timestamp': datetime.now().isoformat()
+    })
+
+@sync_bp.route('/shadow', methods=['GET', 'POST'])
+def sync_shadow():
+    """Sincronização sombra: calcula sem gravar e compara com mlm_levels"""
+    if not sync_service:
+        return jsonify({
+            'status': 'error',
+            'message': 'Serviço de sincronização não inicializado'
+        }), 500
+    
+    if request.method == 'GET':
+        return jsonify({
+            'status': 'success',
+            'data': {
+                'running': sync_service.shadow_running,
+                'engines': sorted(STATS_ENGINES),
+                'report': sync_service.shadow_report
+            },
+            'timestamp': datetime.now().isoformat()
+        })
+    
+    # POST roda o pipeline inteiro em segundo plano, sob o lock da sincronização
+    error = admin_token_error()
+    if error:
+        return error
+    
+    data = request.get_json(silent=True) or {}
+    engine = data.get('engine', DEFAULT_ENGINE)
+    sample_size = data.get('sample_size', 20)
+    if not isinstance(sample_size, int) or not 0 <= sample_size <= MAX_SHADOW_SAMPLE:
+        return jsonify({
+            'status': 'error',
+            'message': f'sample_size deve ser um inteiro entre 0 e {MAX_SHADOW_SAMPLE}'
+        }), 400
+    
+    try:
+        started = sync_service.start_shadow_sync(engine=engine, sample_size=sample_size)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 409
+    
+    if not started:
+        return jsonify({
+            'status': 'error',
+            'message': 'Sincronização sombra já em andamento'
+        }), 409
+    
+    return jsonify({
+        'status': 'accepted',
+        'message': f'Sincronização sombra iniciada com o motor {engine}',
+        'links': {'report': '/api/v1/sync/shadow'},
+        'timestamp': datetime.now().isoformat()
+    }), 202
+
+@sync_bp.route('/memory-profile')
+def sync_memory_profile():
+    """Relatório de memória da última sincronização perfilada (MEMORY_PROFILE)"""
+    if not sync_service:
+        return jsonify({
+            'status': 'error',
+            'message': 'Serviço de sincronização não inicializado'
+        }), 500
+    
+    report = sync_service.memory_report
+    if report is None:
+        return jsonify({
+            'status': 'error',
+            'message': 'Nenhuma sincronização perfilada ainda' + (
+                '' if sync_service.memory_profile else ' (perfil de memória desativado)'
+            )
+        }), 404
+    
+    return jsonify({
+        'status': 'success',
+        'data': report,
+        'timestamp': datetime.now().isoformat()
+    })
+
 @sync_bp.route('/status')
 def sync_status():
     """Retorna status das sincronizações"""
@@ -68,10 +195,31 @@ def sync_status():
         sync_history = mlm_db.get_sync_status()
         
         # Informações do serviço
+        report = sync_service.memory_report
         service_info = {
             'is_running': sync_service.is_running,
             'sync_interval': sync_service.sync_interval,
-            'last_sync': sync_service.last_sync.isoformat() if sync_service.last_sync else None
+            'last_sync': sync_service.last_sync.isoformat() if sync_service.last_sync else None,
+            'generation': sync_service.current_generation,
+            'warm_start_source': sync_service.warm_start_source,
+            'cdc': {
+                'enabled': sync_service.cdc_enabled,
+                'listening': bool(sync_service.cdc_listener and sync_service.cdc_listener.is_listening),
+                'mode': 'cdc' if sync_service.cdc_listener and sync_service.cdc_listener.is_listening else 'polling'
+            },
+            'sharding': sync_service.sharding.status() if sync_service.sharding else None,
+            'extract': sync_service.extractor.status() if sync_service.extractor else None,
+            'memory_profile': {
+                'enabled': sync_service.memory_profile,
+                'last_report_at': report['finished_at'] if report else None,
+                'python_peak_bytes': report['python_peak_bytes'] if report else None,
+                'rss_peak_kb': report['rss_peak_kb'] if report else None,
+                'peak_stage': report['peak_stage'] if report else None
+            },
+            'leaderboard': sync_service.leaderboard.status(),
+            'admission': admission.status(),
+            'scheduler': sync_service.scheduler.status(limit=0),
+            'replicas': mlm_db.replicas.status() if mlm_db.replicas else None
         }
         
         # Processar histórico
@@ -199,7 +347,8 @@ def sync_config():
                 'data': {
                     'sync_interval': sync_service.sync_interval,
                     'is_running': sync_service.is_running,
-                    'last_sync': sync_service.last_sync.isoformat() if sync_service.last_sync else None
+                    'last_sync': sync_service.last_sync.isoformat() if sync_service.last_sync else None,
+                    'memory_profile': sync_service.memory_profile
                 }
             })
         
@@ -224,14 +373,27 @@ def sync_config():
                     }), 400
                 
                 sync_service.sync_interval = new_interval
+                sync_service.scheduler.wake()
                 logger.info(f"Intervalo de sincronização atualizado para {new_interval} segundos")
             
+            # Perfil de memória vale a partir da próxima sincronização
+            if 'memory_profile' in data:
+                if not isinstance(data['memory_profile'], bool):
+                    return jsonify({
+                        'status': 'error',
+                        'message': 'memory_profile deve ser booleano'
+                    }), 400
+                
+                sync_service.memory_profile = data['memory_profile']
+                logger.info(f"Perfil de memória da sincronização {'ativado' if data['memory_profile'] else 'desativado'}")
+            
             return jsonify({
                 'status': 'success',
                 'message': 'Configurações atualizadas',
                 'data': {
                     'sync_interval': sync_service.sync_interval,
-                    'is_running': sync_service.is_running
+                    'is_running': sync_service.is_running,
+                    'memory_profile': sync_service.memory_profile
                 }
             })
         
@@ -253,25 +415,10 @@ def sync_health():
                 'message': 'Serviço de sincronização não inicializado'
             }), 500
         
-        # Verificar conexões de banco
-        operation_db_ok = False
-        mlm_db_ok = False
-        
-        try:
-            # Testar conexão com banco da operação
-            with sync_service.operation_conn.cursor() as cursor:
-                cursor.execute("SELECT 1")
-                operation_db_ok = True
-        except:
-            pass
-        
-        try:
-            # Testar conexão com banco MLM
-            with sync_service.mlm_conn.cursor() as cursor:
-                cursor.execute("SELECT 1")
-                mlm_db_ok = True
-        except:
-            pass
+        # Resultado em cache do amostrador (não toca nas conexões da sincronização)
+        checks = health_sampler.snapshot() if health_sampler else {'checks': {}}
+        operation_db_ok = health_sampler.is_ok('operation_db') if health_sampler else False
+        mlm_db_ok = health_sampler.is_ok('mlm_db') if health_sampler else False
         
         # Determinar status geral
         if operation_db_ok and mlm_db_ok and sync_service.is_running:
@@ -281,15 +428,18 @@ def sync_health():
         else:
             overall_status = 'unhealthy'
         
+        data = {
+            'operation_db_connected': operation_db_ok,
+            'mlm_db_connected': mlm_db_ok,
+            'checks': checks['checks'],
+            'sampled_at': checks.get('sampled_at'),
+            'sample_age_seconds': checks.get('sample_age_seconds')
+        }
+        data.update(sync_lag_info(sync_service))
+        
         return jsonify({
             'status': overall_status,
-            'data': {
-                'sync_service_running': sync_service.is_running,
-                'operation_db_connected': operation_db_ok,
-                'mlm_db_connected': mlm_db_ok,
-                'last_sync': sync_service.last_sync.isoformat() if sync_service.last_sync else None,
-                'sync_interval': sync_service.sync_interval
-            },
+            'data': data,
             'timestamp': datetime.now().isoformat()
         })
         
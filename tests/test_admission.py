@@ -0,0 +1,187 @@
+# Controle de admissão: token bucket, vagas por classe e chave do cliente
+#
+# O MemoryBackend é exercitado com um relógio controlado (sem sleeps). A
+# chave do cliente e as respostas 429/503 passam por um app Flask mínimo com
+# o controlador instalado no blueprint.
+#
+# Executar: python -m pytest tests
+
+from types import SimpleNamespace
+
+import pytest
+from flask import Blueprint, Flask
+
+from src.models import admission as admission_module
+from src.models.admission import (
+    AdmissionController, MemoryBackend, CHEAP, STANDARD, HEAVY, COSTS, client_key
+)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(admission_module, 'time', SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def test_bucket_allows_burst_then_waits_for_refill(clock):
+    backend = MemoryBackend()
+    for _ in range(4):
+        assert backend.take('ip:a', 10.0, 4.0, 1, 0.0) == (True, 0.0)
+    allowed, wait = backend.take('ip:a', 10.0, 4.0, 1, 0.0)
+    assert not allowed
+    assert wait == pytest.approx(0.1)
+
+    clock.now += 0.1
+    assert backend.take('ip:a', 10.0, 4.0, 1, 0.0)[0]
+    assert not backend.take('ip:a', 10.0, 4.0, 1, 0.0)[0]
+
+
+def test_bucket_refill_is_capped_at_burst(clock):
+    backend = MemoryBackend()
+    backend.take('ip:a', 10.0, 4.0, 4, 0.0)
+    clock.now += 60
+    for _ in range(4):
+        assert backend.take('ip:a', 10.0, 4.0, 1, 0.0)[0]
+    assert not backend.take('ip:a', 10.0, 4.0, 1, 0.0)[0]
+
+
+def test_buckets_are_per_client(clock):
+    backend = MemoryBackend()
+    assert backend.take('ip:a', 1.0, 5.0, 5, 0.0)[0]
+    assert not backend.take('ip:a', 1.0, 5.0, 1, 0.0)[0]
+    assert backend.take('ip:b', 1.0, 5.0, 5, 0.0)[0]
+
+
+def test_reserve_is_left_for_cheap_routes(clock):
+    backend = MemoryBackend()
+    # Rajada 10, reserva 5: a pesada (5) só passa uma vez, as baratas gastam o resto
+    assert backend.take('ip:a', 1.0, 10.0, COSTS[HEAVY], 5.0)[0]
+    allowed, wait = backend.take('ip:a', 1.0, 10.0, COSTS[HEAVY], 5.0)
+    assert not allowed
+    assert wait == pytest.approx(5.0)
+    for _ in range(5):
+        assert backend.take('ip:a', 1.0, 10.0, COSTS[CHEAP], 0.0)[0]
+    assert not backend.take('ip:a', 1.0, 10.0, COSTS[CHEAP], 0.0)[0]
+
+
+def test_rejected_take_does_not_spend_tokens(clock):
+    backend = MemoryBackend()
+    backend.take('ip:a', 1.0, 5.0, 3, 0.0)
+    assert not backend.take('ip:a', 1.0, 5.0, 3, 0.0)[0]
+    assert backend.take('ip:a', 1.0, 5.0, 2, 0.0)[0]
+
+
+def test_idle_buckets_are_swept(clock):
+    backend = MemoryBackend()
+    backend.take('ip:a', 10.0, 4.0, 1, 0.0)
+    clock.now += 1.0
+    backend.take('ip:b', 10.0, 4.0, 1, 0.0)
+    assert set(backend._buckets) == {'ip:b'}
+
+
+def test_slots_limit_and_release():
+    backend = MemoryBackend()
+    first = backend.acquire(HEAVY, 2)
+    second = backend.acquire(HEAVY, 2)
+    assert first and second and first != second
+    assert backend.acquire(HEAVY, 2) is None
+    assert backend.acquire(STANDARD, 2) is not None
+    assert backend.in_flight() == {CHEAP: 0, STANDARD: 1, HEAVY: 2}
+
+    backend.release(HEAVY, first)
+    assert backend.acquire(HEAVY, 2) is not None
+
+
+def test_overloaded_request_keeps_client_tokens(clock):
+    controller = AdmissionController()
+    controller.configure(rate=1.0, burst=10.0, reserve=0.0, heavy_limit=1)
+    app = Flask(__name__)
+    with app.app_context():
+        rejection, lease = controller.admit('ip:a', HEAVY)
+        assert rejection is None and lease is not None
+        rejection, _ = controller.admit('ip:a', HEAVY)
+        assert rejection.status_code == 503
+        assert rejection.headers['Retry-After'] == str(controller.retry_after)
+
+        # A rejeição por sobrecarga não gastou tokens: sobram 5 para outra pesada
+        controller.backend.release(HEAVY, lease)
+        rejection, lease = controller.admit('ip:a', HEAVY)
+        assert rejection is None
+        controller.backend.release(HEAVY, lease)
+        rejection, _ = controller.admit('ip:a', HEAVY)
+        assert rejection.status_code == 429
+        assert controller.backend.in_flight()[HEAVY] == 0
+
+
+def test_reserve_never_exceeds_burst():
+    controller = AdmissionController()
+    controller.configure(burst=8.0, reserve=100.0)
+    assert controller.reserve == 8.0 - COSTS[HEAVY]
+
+
+def _app(controller):
+    app = Flask(__name__)
+    blueprint = Blueprint('mlm', __name__)
+
+    @blueprint.route('/upline')
+    def get_upline():
+        return {'client': client_key(controller.client_tokens)}
+
+    @blueprint.route('/hierarchy')
+    def get_hierarchy():
+        return {'status': 'success'}
+
+    controller.install(blueprint)
+    app.register_blueprint(blueprint)
+    return app
+
+
+def test_client_key_requires_valid_token():
+    controller = AdmissionController()
+    controller.client_tokens = {'partner': 's3cret'}
+    client = _app(controller).test_client()
+    environ = {'REMOTE_ADDR': '10.0.0.7'}
+
+    assert client.get('/upline', environ_base=environ).json['client'] == 'ip:10.0.0.7'
+    response = client.get('/upline', environ_base=environ, headers={'X-Client-Id': 'partner'})
+    assert response.json['client'] == 'ip:10.0.0.7'
+    response = client.get('/upline', environ_base=environ,
+                          headers={'X-Client-Id': 'partner', 'X-Client-Token': 'wrong'})
+    assert response.json['client'] == 'ip:10.0.0.7'
+    response = client.get('/upline', environ_base=environ,
+                          headers={'X-Client-Id': 'partner', 'X-Client-Token': 's3cret'})
+    assert response.json['client'] == 'id:partner'
+    # Sem tokens configurados, X-Client-Id é ignorado
+    controller.client_tokens = {}
+    response = client.get('/upline', environ_base=environ, headers={'X-Client-Id': 'partner'})
+    assert response.json['client'] == 'ip:10.0.0.7'
+
+
+def _get(client, path, **kwargs):
+    # Fechar a resposta dispara call_on_close, que libera a vaga da classe
+    response = client.get(path, **kwargs)
+    response.close()
+    return response
+
+
+def test_forwarded_for_does_not_choose_bucket(clock):
+    controller = AdmissionController()
+    controller.configure(enabled=True, rate=0.001, burst=10.0, reserve=0.0)
+    client = _app(controller).test_client()
+    environ = {'REMOTE_ADDR': '10.0.0.7'}
+
+    assert _get(client, '/hierarchy', environ_base=environ).status_code == 200
+    assert _get(client, '/hierarchy', environ_base=environ).status_code == 200
+    response = _get(client, '/hierarchy', environ_base=environ, headers={'X-Forwarded-For': '203.0.113.9'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    assert controller.backend.in_flight()[HEAVY] == 0
@@ -0,0 +1,127 @@
+# Busca em mlm_affiliate_stats: SQL gerado, cursor keyset e validação
+#
+# build_search só monta a consulta: os testes conferem condições, ordenação
+# e parâmetros sem banco. Cursores e valores vindos do cliente que não
+# tenham o tipo da coluna devem ser rejeitados com ValueError (400 na API).
+#
+# Executar: python -m pytest tests
+
+import base64
+import json
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from src.models.affiliate_stats import (
+    MAX_LIMIT, build_search, decode_cursor, encode_cursor, parse_value
+)
+
+
+def _sql(query):
+    return ' '.join(query.split())
+
+
+def _raw_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+
+def test_default_search_has_no_filters():
+    query, params = build_search()
+    sql = _sql(query)
+    assert 'WHERE' not in sql
+    assert sql.endswith('ORDER BY total_n1_to_n5 DESC, affiliate_id DESC LIMIT %s')
+    assert params == [51]
+
+
+def test_filters_become_ranges_with_open_bounds():
+    query, params = build_search({'n1': (10, None), 'total': (100, 1000), 'volume': (None, Decimal('5.5'))},
+                                 sort='n1', order='asc', limit=20)
+    sql = _sql(query)
+    assert 'WHERE n1 >= %s AND total_n1_to_n5 >= %s AND total_n1_to_n5 <= %s AND total_volume <= %s' in sql
+    assert 'ORDER BY n1 ASC, affiliate_id ASC' in sql
+    assert params == [10, 100, 1000, Decimal('5.5'), 21]
+
+
+@pytest.mark.parametrize('sort, order, expected, cursor_params', [
+    ('total', 'desc', '(total_n1_to_n5, affiliate_id) < (%s, %s)', [7, 42]),
+    ('volume', 'asc', '(total_volume, affiliate_id) > (%s, %s)', [Decimal('12.50'), 42]),
+    ('affiliate_id', 'desc', 'affiliate_id < %s', [42])
+])
+def test_cursor_continues_after_last_row(sort, order, expected, cursor_params):
+    row = {'affiliate_id': 42, 'total_n1_to_n5': 7, 'total_volume': Decimal('12.50')}
+    cursor = encode_cursor(sort, row)
+    query, params = build_search({'n1': (1, None)}, sort=sort, order=order, after=cursor, limit=10)
+    assert f"WHERE n1 >= %s AND {expected}" in _sql(query)
+    assert params == [1, *cursor_params, 11]
+
+
+def test_cursor_round_trip_keeps_column_types():
+    row = {'affiliate_id': 9, 'total_volume': Decimal('0.10'), 'n1': 3}
+    assert decode_cursor('volume', encode_cursor('volume', row)) == (Decimal('0.10'), 9)
+    value, affiliate_id = decode_cursor('n1', encode_cursor('n1', row))
+    assert (value, affiliate_id) == (3, 9) and type(value) is int
+
+
+@pytest.mark.parametrize('cursor', [
+    'não-é-base64!',
+    base64.urlsafe_b64encode(b'not json').decode(),
+    _raw_cursor(['total', '5']),
+    _raw_cursor(['total', 5, 42]),
+    _raw_cursor(['total', '5', '42']),
+    _raw_cursor(['total', '5', 4.2]),
+    _raw_cursor(['total', '5', True]),
+    _raw_cursor(['total', '1 OR 1=1', 42]),
+    _raw_cursor(['total', '5.5', 42])
+])
+def test_malformed_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match='Cursor inválido'):
+        decode_cursor('total', cursor)
+
+
+def test_cursor_from_other_sort_is_rejected():
+    cursor = encode_cursor('n1', {'affiliate_id': 1, 'n1': 2})
+    with pytest.raises(ValueError, match='outra ordenação'):
+        build_search(sort='total', after=cursor)
+
+
+def test_volume_cursor_rejects_non_finite_values():
+    for value in ('NaN', 'Infinity', '-inf'):
+        with pytest.raises(ValueError):
+            decode_cursor('volume', _raw_cursor(['volume', value, 1]))
+
+
+@pytest.mark.parametrize('field, raw, expected', [
+    ('n1', '10', 10),
+    ('total', '-3', -3),
+    ('volume', '1.25', Decimal('1.25')),
+    ('volume', '7', Decimal('7'))
+])
+def test_parse_value(field, raw, expected):
+    assert parse_value(field, raw) == expected
+
+
+@pytest.mark.parametrize('field, raw', [
+    ('n1', '1.5'),
+    ('n1', 'abc'),
+    ('n1', None),
+    ('volume', 'abc'),
+    ('volume', 'NaN'),
+    ('volume', 'Infinity')
+])
+def test_parse_value_rejects_invalid(field, raw):
+    with pytest.raises(ValueError, match=f'Valor inválido para {field}'):
+        parse_value(field, raw)
+
+
+@pytest.mark.parametrize('kwargs, message', [
+    ({'sort': 'n2'}, 'Ordenação inválida'),
+    ({'order': 'sideways'}, 'order deve ser'),
+    ({'limit': 0}, 'limit deve estar'),
+    ({'limit': MAX_LIMIT + 1}, 'limit deve estar'),
+    ({'filters': {'n1; DROP TABLE x': (1, None)}}, 'Filtro desconhecido')
+])
+def test_invalid_search_arguments(kwargs, message):
+    with pytest.raises(ValueError, match=message):
+        build_search(**kwargs)
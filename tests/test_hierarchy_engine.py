@@ -0,0 +1,213 @@
+# Equivalência do motor incremental com o cálculo completo
+#
+# Para florestas aleatórias, aplica lotes de inserção/remoção/re-parent no
+# HierarchyEngine e compara, após cada lote, as linhas de mlm_hierarchy e
+# mlm_levels mantidas pelo motor com as de uma sincronização completa
+# (build_infinite_hierarchy + calculate_individual_n1_to_n5_stats) sobre o
+# mesmo conjunto de indicações. Lotes rejeitados (EdgeConflict) não podem
+# alterar nada.
+#
+# Executar: python -m pytest tests
+
+import random
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from src.models.hierarchy_engine import HierarchyEngine, EdgeConflict
+from src.models.sync_service import MLMSyncService, LEVEL_ROW_COUNTS
+
+TRIALS = 300
+BATCHES_PER_TRIAL = 12
+NOW = datetime(2026, 1, 31, 12, 0, 0)
+
+
+@pytest.fixture(scope='module')
+def service():
+    return MLMSyncService(None, None, autoconnect=False)
+
+
+def _volumes(max_user):
+    return {user_id: Decimal(user_id * 37 % 101) / 4 for user_id in range(1, max_user + 1)}
+
+
+def _records(edges):
+    """Linhas de tracked para o conjunto atual: {child_id: (parent_id, created_at)}"""
+    return [
+        {'id': index, 'affiliate_id': parent_id, 'referred_user_id': child_id, 'created_at': created_at}
+        for index, (child_id, (parent_id, created_at)) in enumerate(sorted(edges.items()), start=1)
+    ]
+
+
+def _full_sync(service, edges, volumes):
+    """Linhas (hierarquia, níveis) de uma sincronização completa, mais o necessário para o motor"""
+    records = _records(edges)
+    window_members, window_cutoffs = service.compute_growth_windows(records, now=NOW)
+    hierarchy = service.build_infinite_hierarchy(records)
+    stats = service.calculate_individual_n1_to_n5_stats(hierarchy, volumes, window_members)
+    rows = (service.hierarchy_rows(hierarchy), service.level_rows(stats))
+    return rows, hierarchy, stats, window_members, window_cutoffs
+
+
+def _engine_rows(engine):
+    hierarchy = {affiliate_id: engine.hierarchy_row(affiliate_id) for affiliate_id in engine.info}
+    levels = {affiliate_id: engine.level_row(affiliate_id) for affiliate_id in engine.counts}
+    return hierarchy, levels
+
+
+def _created_at(rng):
+    # Espalha as indicações dentro e fora das janelas de 1, 7 e 30 dias
+    return NOW - timedelta(days=rng.choice((0.5, 3, 15, 60)))
+
+
+def _random_forest(rng):
+    size = rng.randint(5, 60)
+    edges = {}
+    for child_id in range(2, size):
+        if rng.random() < 0.85:
+            edges[child_id] = (rng.randint(1, child_id - 1), _created_at(rng))
+    return size, edges
+
+
+def _random_operation(rng, size, edges):
+    """Operação aleatória; pode ser inválida (ciclo, aresta inexistente, auto-indicação)"""
+    roll = rng.random()
+    if roll < 0.4 or not edges:
+        return {
+            'op': 'insert',
+            'parent_id': rng.randint(1, size + 5),
+            'child_id': rng.randint(2, size + 5),
+            'created_at': _created_at(rng)
+        }
+    child_id = rng.choice(sorted(edges))
+    if roll < 0.7:
+        parent_id = edges[child_id][0] if rng.random() < 0.9 else rng.randint(1, size + 5)
+        return {'op': 'remove', 'parent_id': parent_id, 'child_id': child_id}
+    return {'op': 'reparent', 'parent_id': rng.randint(1, size + 5), 'child_id': child_id}
+
+
+def _apply_to_edges(edges, operation):
+    child_id = operation['child_id']
+    if operation['op'] == 'insert':
+        edges[child_id] = (operation['parent_id'], operation['created_at'])
+    elif operation['op'] == 'remove':
+        del edges[child_id]
+    else:
+        edges[child_id] = (operation['parent_id'], edges[child_id][1])
+
+
+def _apply_changes(rows, changes):
+    hierarchy, levels = rows
+    hierarchy.update(changes.hierarchy_upserts)
+    for affiliate_id in changes.hierarchy_deletes:
+        hierarchy.pop(affiliate_id, None)
+    levels.update(changes.level_upserts)
+    for affiliate_id in changes.level_deletes:
+        levels.pop(affiliate_id, None)
+
+
+@pytest.mark.parametrize('seed', range(TRIALS))
+def test_engine_matches_full_sync(service, seed):
+    rng = random.Random(seed)
+    size, edges = _random_forest(rng)
+    volumes = _volumes(size + 5)
+
+    expected, hierarchy, stats, window_members, window_cutoffs = _full_sync(service, edges, volumes)
+    engine = HierarchyEngine(
+        hierarchy, stats,
+        node_values={'volume': volumes},
+        window_cutoffs=window_cutoffs,
+        edge_values=window_members
+    )
+    # Linhas persistidas: começam iguais à sincronização completa e recebem só as alterações
+    persisted = ({**expected[0]}, {**expected[1]})
+    assert _engine_rows(engine) == expected
+
+    for batch in range(BATCHES_PER_TRIAL):
+        operations = [_random_operation(rng, size, edges) for _ in range(rng.randint(1, 3))]
+        before = _engine_rows(engine)
+        try:
+            changes = engine.apply(operations)
+        except EdgeConflict:
+            assert _engine_rows(engine) == before, f"lote rejeitado alterou o motor: {operations}"
+            continue
+
+        for operation in operations:
+            _apply_to_edges(edges, operation)
+        _apply_changes(persisted, changes)
+
+        expected = _full_sync(service, edges, volumes)[0]
+        assert _engine_rows(engine) == expected, f"lote {batch}: {operations}"
+        assert persisted == expected, f"alterações incompletas no lote {batch}: {operations}"
+
+
+def _multi_records(edges):
+    """Linhas de tracked com mais de um referidor por usuário: [(parent_id, child_id, created_at)]"""
+    return [
+        {'id': index, 'affiliate_id': parent_id, 'referred_user_id': child_id, 'created_at': created_at}
+        for index, (parent_id, child_id, created_at) in enumerate(sorted(edges), start=1)
+    ]
+
+
+def _full_levels(service, edges, volumes):
+    records = _multi_records(edges)
+    window_members, window_cutoffs = service.compute_growth_windows(records, now=NOW)
+    hierarchy = service.build_infinite_hierarchy(records)
+    stats = service.calculate_individual_n1_to_n5_stats(hierarchy, volumes, window_members)
+    return service.level_rows(stats), hierarchy, stats, window_members, window_cutoffs
+
+
+def test_windows_follow_each_referral(service):
+    # 3 indicado por 1 há 60 dias e por 2 há 12 horas: novo só sob 2
+    edges = [(1, 3, NOW - timedelta(days=60)), (2, 3, NOW - timedelta(hours=12)), (3, 4, NOW - timedelta(days=60))]
+    levels = _full_levels(service, edges, {})[0]
+    new_1d_n1 = LEVEL_ROW_COUNTS + 5  # primeiro valor de new_1d (N1) na linha de níveis
+    assert levels[1][new_1d_n1] == 0
+    assert levels[2][new_1d_n1] == 1
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_engine_windows_with_multiple_referrers(service, seed):
+    rng = random.Random(seed)
+    size = rng.randint(5, 40)
+    edges = set()
+    for child_id in range(2, size):
+        for parent_id in rng.sample(range(1, child_id), min(child_id - 1, rng.choice((1, 1, 2)))):
+            edges.add((parent_id, child_id, _created_at(rng)))
+    volumes = _volumes(size + 5)
+
+    expected, hierarchy, stats, window_members, window_cutoffs = _full_levels(service, edges, volumes)
+    engine = HierarchyEngine(
+        hierarchy, stats,
+        node_values={'volume': volumes},
+        window_cutoffs=window_cutoffs,
+        edge_values=window_members
+    )
+
+    for batch in range(BATCHES_PER_TRIAL):
+        pairs = {(parent_id, child_id): created_at for parent_id, child_id, created_at in edges}
+        if rng.random() < 0.6 or not pairs:
+            parent_id, child_id = rng.randint(1, size + 3), rng.randint(2, size + 3)
+            if parent_id == child_id or (parent_id, child_id) in pairs:
+                continue
+            operation = {'op': 'insert', 'parent_id': parent_id, 'child_id': child_id,
+                         'allow_multiple': True, 'created_at': _created_at(rng)}
+        else:
+            parent_id, child_id = rng.choice(sorted(pairs))
+            operation = {'op': 'remove', 'parent_id': parent_id, 'child_id': child_id}
+        try:
+            engine.apply([operation])
+        except EdgeConflict:
+            continue
+
+        if operation['op'] == 'insert':
+            edges.add((parent_id, child_id, operation['created_at']))
+        else:
+            edges.discard((parent_id, child_id, pairs[(parent_id, child_id)]))
+
+        expected = _full_levels(service, edges, volumes)[0]
+        levels = {affiliate_id: engine.level_row(affiliate_id) for affiliate_id in engine.counts}
+        assert levels == expected, f"lote {batch}: {operation}"
@@ -0,0 +1,196 @@
+# Executor de migrações com uma conexão falsa que registra as instruções
+#
+# A conexão simula apenas o que o MigrationRunner consulta: existência e
+# conteúdo de mlm_schema_version, índices inválidos e transações (inserções
+# de versão só valem após commit). Verifica a ordem de aplicação, o caminho
+# sem DDL, o advisory lock, o rollback de migração com falha e a limpeza de
+# índices CONCURRENTLY interrompidos.
+#
+# Executar: python -m pytest tests
+
+import pytest
+
+from src.models.migrations import (
+    MIGRATIONS, LATEST_VERSION, MIGRATION_LOCK_KEY, Migration, MigrationRunner, _index
+)
+
+
+class _Database:
+    def __init__(self, versions=(), invalid_indexes=(), fail_on=None):
+        self.versions = set(versions)
+        self.has_table = bool(versions)
+        self.invalid_indexes = set(invalid_indexes)
+        self.fail_on = fail_on
+        self.executed = []  # (instrução, parâmetros, autocommit)
+        self.on_lock = None
+
+
+class _Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self._result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params=None):
+        connection = self.connection
+        database = connection.database
+        statement = ' '.join(statement.split())
+        database.executed.append((statement, params, connection.autocommit))
+        self._result = None
+        if database.fail_on and database.fail_on in statement:
+            raise RuntimeError(f"falha simulada: {database.fail_on}")
+
+        if 'to_regclass' in statement:
+            self._result = (database.has_table,)
+        elif 'MAX(version)' in statement:
+            self._result = (max(database.versions, default=0),)
+        elif 'pg_advisory_lock' in statement and database.on_lock:
+            database.on_lock(database)
+        elif 'FROM pg_index' in statement:
+            self._result = (1,) if params[0] in database.invalid_indexes else None
+        elif statement.startswith('DROP INDEX'):
+            database.invalid_indexes.discard(statement.split()[-1])
+        elif 'CREATE TABLE IF NOT EXISTS mlm_schema_version' in statement:
+            database.has_table = True
+        elif statement.startswith('INSERT INTO mlm_schema_version'):
+            connection.record(params[0])
+
+    def fetchone(self):
+        return self._result
+
+
+class _Connection:
+    def __init__(self, database):
+        self.database = database
+        self.autocommit = True
+        self._uncommitted = []
+
+    def cursor(self):
+        return _Cursor(self)
+
+    def record(self, version):
+        if self.autocommit:
+            self.database.versions.add(version)
+        else:
+            self._uncommitted.append(version)
+
+    def commit(self):
+        self.database.versions.update(self._uncommitted)
+        self._uncommitted = []
+
+    def rollback(self):
+        self._uncommitted = []
+
+
+def _migrations():
+    return [
+        Migration(1, 'tabelas', ["CREATE TABLE a (id INTEGER)", "CREATE TABLE b (id INTEGER)"]),
+        Migration(2, 'índices', [_index('idx_a_id', 'ON a (id)')], concurrent=True),
+        Migration(3, 'coluna', ["ALTER TABLE b ADD COLUMN c INTEGER"])
+    ]
+
+
+def _statements(database, prefix):
+    return [(statement, autocommit) for statement, _, autocommit in database.executed
+            if statement.startswith(prefix)]
+
+
+def test_migration_list_is_ordered_and_contiguous():
+    versions = [migration.version for migration in MIGRATIONS]
+    assert versions == list(range(1, len(MIGRATIONS) + 1))
+    assert LATEST_VERSION == versions[-1]
+    for migration in MIGRATIONS:
+        if migration.concurrent:
+            for name, statement in migration.statements:
+                assert 'CONCURRENTLY' in statement and name in statement
+        else:
+            assert all(isinstance(statement, str) for statement in migration.statements)
+
+
+def test_applies_pending_migrations_in_order():
+    database = _Database()
+    runner = MigrationRunner(_Connection(database), migrations=list(reversed(_migrations())))
+
+    assert runner.apply() == 3
+    assert database.versions == {1, 2, 3}
+
+    executed = [statement for statement, _, _ in database.executed]
+    lock = executed.index('SELECT pg_advisory_lock(%s)')
+    assert database.executed[lock][1] == (MIGRATION_LOCK_KEY,)
+    assert executed[-1] == 'SELECT pg_advisory_unlock(%s)'
+    assert [statement for statement in executed if statement.startswith(('CREATE TABLE a', 'CREATE TABLE b',
+                                                                       'CREATE INDEX', 'ALTER'))] == [
+        'CREATE TABLE a (id INTEGER)',
+        'CREATE TABLE b (id INTEGER)',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a_id ON a (id)',
+        'ALTER TABLE b ADD COLUMN c INTEGER'
+    ]
+    # Migrações comuns em transação; CONCURRENTLY fora dela
+    assert _statements(database, 'CREATE TABLE a') == [('CREATE TABLE a (id INTEGER)', False)]
+    assert _statements(database, 'CREATE INDEX')[0][1] is True
+    assert runner.connection.autocommit is True
+
+
+def test_up_to_date_schema_runs_no_ddl():
+    database = _Database(versions={1, 2, 3})
+    assert MigrationRunner(_Connection(database), migrations=_migrations()).apply() == 3
+    assert [statement for statement, _, _ in database.executed] == [
+        "SELECT to_regclass('mlm_schema_version') IS NOT NULL",
+        'SELECT COALESCE(MAX(version), 0) FROM mlm_schema_version'
+    ]
+
+
+def test_applies_only_newer_versions():
+    database = _Database(versions={1})
+    assert MigrationRunner(_Connection(database), migrations=_migrations()).apply() == 3
+    assert not _statements(database, 'CREATE TABLE a')
+    assert _statements(database, 'ALTER TABLE b')
+
+
+def test_rechecks_version_after_waiting_for_lock():
+    database = _Database(versions={1})
+
+    def migrated_by_other_process(database):
+        database.versions.update({2, 3})
+
+    database.on_lock = migrated_by_other_process
+    assert MigrationRunner(_Connection(database), migrations=_migrations()).apply() == 3
+    assert not _statements(database, 'CREATE INDEX')
+    assert not _statements(database, 'INSERT INTO mlm_schema_version')
+    assert database.executed[-1][0] == 'SELECT pg_advisory_unlock(%s)'
+
+
+def test_failed_migration_rolls_back_and_releases_lock():
+    database = _Database(versions={1, 2}, fail_on='ALTER TABLE b')
+    connection = _Connection(database)
+
+    with pytest.raises(RuntimeError):
+        MigrationRunner(connection, migrations=_migrations()).apply()
+    assert database.versions == {1, 2}
+    assert connection.autocommit is True
+    assert database.executed[-1][0] == 'SELECT pg_advisory_unlock(%s)'
+
+
+def test_failed_migration_stops_later_versions():
+    database = _Database(fail_on='CREATE TABLE b')
+
+    with pytest.raises(RuntimeError):
+        MigrationRunner(_Connection(database), migrations=_migrations()).apply()
+    # A migração 1 falhou inteira (CREATE TABLE a desfeito junto)
+    assert database.versions == set()
+    assert not _statements(database, 'CREATE INDEX')
+
+
+def test_drops_invalid_index_before_recreating():
+    database = _Database(versions={1}, invalid_indexes={'idx_a_id'})
+    MigrationRunner(_Connection(database), migrations=_migrations()).apply()
+
+    executed = [statement for statement, _, _ in database.executed]
+    drop = executed.index('DROP INDEX CONCURRENTLY IF EXISTS idx_a_id')
+    assert drop < executed.index('CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_a_id ON a (id)')
+    assert database.invalid_indexes == set()
@@ -0,0 +1,169 @@
+# Single-flight: coalescência por chave, separação por instância e erros
+#
+# As consultas são funções que bloqueiam num Event até o teste liberar,
+# assim as chamadas concorrentes ficam garantidamente sobrepostas.
+#
+# Executar: python -m pytest tests
+
+import threading
+import time
+
+import pytest
+
+from src.models import single_flight as single_flight_module
+from src.models.single_flight import SingleFlight, coalesce
+
+
+@pytest.fixture
+def flight(monkeypatch):
+    flight = SingleFlight(wait_timeout=5.0)
+    monkeypatch.setattr(single_flight_module, 'single_flight', flight)
+    return flight
+
+
+def _wait_for_waiters(flight, key, count):
+    for _ in range(500):
+        with flight._lock:
+            call = flight._calls.get(key)
+            if call is not None and call.waiters >= count:
+                return
+        time.sleep(0.01)
+    raise AssertionError(f"{key}: menos de {count} chamadas aguardando")
+
+
+def _run_concurrently(target, count):
+    results = [None] * count
+    errors = [None] * count
+
+    def run(index):
+        try:
+            results[index] = target()
+        except Exception as e:
+            errors[index] = e
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_concurrent_calls_share_one_query(flight):
+    release = threading.Event()
+    calls = []
+
+    def query():
+        calls.append(1)
+        release.wait(5)
+        return {'rows': [1, 2, 3]}
+
+    threads, results, errors = _run_concurrently(lambda: flight.do('hierarchy', 'k', query), 5)
+    _wait_for_waiters(flight, 'k', 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert errors == [None] * 5
+    assert all(result is results[0] for result in results)
+    entry = flight.stats()['keys'][0]
+    assert (entry['queries'], entry['shared'], entry['max_waiters']) == (1, 4, 4)
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_finished_key_queries_again(flight):
+    calls = []
+    flight.do('stats', 'k', lambda: calls.append(1))
+    flight.do('stats', 'k', lambda: calls.append(1))
+    assert len(calls) == 2
+
+
+def test_error_is_raised_to_every_waiter(flight):
+    release = threading.Event()
+
+    def query():
+        release.wait(5)
+        raise RuntimeError('banco indisponível')
+
+    threads, results, errors = _run_concurrently(lambda: flight.do('stats', 'k', query), 3)
+    _wait_for_waiters(flight, 'k', 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(error, RuntimeError) for error in errors)
+    # A chave saiu da tabela: a próxima chamada consulta de novo
+    assert flight.do('stats', 'k', lambda: 'ok') == 'ok'
+
+
+def test_waiter_queries_alone_after_timeout(flight):
+    flight.configure(wait_timeout=0.05)
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: flight.do('stats', 'k', lambda: release.wait(5)))
+    leader.start()
+    try:
+        for _ in range(500):
+            if 'k' in flight._calls:
+                break
+            time.sleep(0.01)
+        assert flight.do('stats', 'k', lambda: 'sozinho') == 'sozinho'
+        assert flight.stats()['keys'][0]['timeouts'] == 1
+    finally:
+        release.set()
+        leader.join()
+
+
+def test_disabled_does_not_coalesce(flight):
+    flight.configure(enabled=False)
+    assert flight.do('stats', 'k', lambda: 'direto') == 'direto'
+    assert flight.stats()['keys'] == []
+
+
+def test_stats_keep_most_recent_keys(flight):
+    flight.configure(max_keys=2)
+    for key in ('a', 'b', 'c'):
+        flight.do('stats', key, lambda: None)
+    assert sorted(entry['key'] for entry in flight.stats()['keys']) == ['b', 'c']
+
+
+class _Database:
+    def __init__(self, name, release):
+        self.name = name
+        self.release = release
+        self.calls = []
+
+    @coalesce('get_upline')
+    def get_upline(self, affiliate_id, max_depth=None):
+        self.calls.append((affiliate_id, max_depth))
+        self.release.wait(5)
+        return (self.name, affiliate_id, max_depth)
+
+
+def _key(database, arguments):
+    return f"get_upline@{id(database):x}({arguments})"
+
+
+def test_coalesce_keys_by_instance_and_arguments(flight):
+    release = threading.Event()
+    primary = _Database('primary', release)
+    other = _Database('other', release)
+
+    same, same_results, _ = _run_concurrently(lambda: primary.get_upline(7, max_depth=3), 3)
+    _wait_for_waiters(flight, _key(primary, '7, max_depth=3'), 2)
+    # Mesmos argumentos em outra instância (outro banco) e outros argumentos na mesma
+    distinct, distinct_results, _ = _run_concurrently(lambda: other.get_upline(7, max_depth=3), 1)
+    positional, positional_results, _ = _run_concurrently(lambda: primary.get_upline(7, 3), 1)
+    for _ in range(500):
+        if len(flight._calls) == 3:
+            break
+        time.sleep(0.01)
+    assert len(flight._calls) == 3
+
+    release.set()
+    for thread in same + distinct + positional:
+        thread.join()
+
+    assert same_results == [('primary', 7, 3)] * 3
+    assert distinct_results == [('other', 7, 3)]
+    assert positional_results == [('primary', 7, 3)]
+    assert primary.calls == [(7, 3), (7, 3)]
+    assert other.calls == [(7, 3)]
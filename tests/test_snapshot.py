@@ -0,0 +1,154 @@
+# Snapshot binário: gravação, leitura via mmap, CRC e troca de CURRENT
+#
+# Uma floresta pequena escrita com write_snapshot deve ser lida de volta
+# igual (pais, filhos, upline, contagens e janelas). Arquivos corrompidos,
+# truncados ou de outro formato são rejeitados com SnapshotError.
+#
+# Executar: python -m pytest tests
+
+import os
+import struct
+
+import pytest
+
+from src.models.snapshot import (
+    HEADER, CURRENT_FILE, FORMAT_VERSION, HierarchySnapshot, SnapshotError, SnapshotStore,
+    write_snapshot
+)
+
+
+def _stats(counts, beyond=0, new_7d=None):
+    level_counts = {level: count for level, count in enumerate(counts, start=1)}
+    return {
+        'level_counts': level_counts,
+        'total_n1_to_n5': sum(counts),
+        'beyond_n5': beyond,
+        'level_new_1d': {},
+        'level_new_7d': new_7d or {},
+        'level_new_30d': {}
+    }
+
+
+# 1 -> 2 -> 3 -> 4 e 1 -> 5; 4 e 5 são folhas (não afiliados)
+HIERARCHY = {
+    1: {'parent_id': None, 'children': [2, 5], 'global_level': 1},
+    2: {'parent_id': 1, 'children': [3], 'global_level': 2},
+    3: {'parent_id': 2, 'children': [4], 'global_level': 3}
+}
+STATS = {
+    1: _stats([2, 1, 1], new_7d={1: 2, 3: 1}),
+    2: _stats([1, 1]),
+    3: _stats([1])
+}
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    return write_snapshot(str(tmp_path), 7, HIERARCHY, STATS)
+
+
+def test_round_trip(snapshot_path):
+    snapshot = HierarchySnapshot(snapshot_path)
+    try:
+        assert snapshot.generation == 7
+        assert (snapshot.node_count, snapshot.edge_count) == (5, 4)
+        assert list(snapshot.ids) == [1, 2, 3, 4, 5]
+        assert snapshot.parent_of(4) == 3
+        assert snapshot.parent_of(1) is None
+        assert snapshot.children(1) == [2, 5]
+        assert snapshot.children(4) == []
+        assert snapshot.upline(4) == [3, 2, 1]
+        assert snapshot.upline(4, max_depth=2) == [3, 2]
+        assert snapshot.upline(99) is None
+        assert 5 in snapshot and 99 not in snapshot
+
+        counts = snapshot.level_counts(1)
+        assert counts['level_counts'] == {1: 2, 2: 1, 3: 1, 4: 0, 5: 0}
+        assert (counts['total_n1_to_n5'], counts['beyond_n5']) == (4, 0)
+        assert counts['growth']['new_7d'] == {1: 2, 2: 0, 3: 1, 4: 0, 5: 0}
+        assert snapshot.level_counts(4)['total_n1_to_n5'] == 0
+    finally:
+        snapshot.close()
+
+
+def test_affiliate_rows_rebuild_paths(snapshot_path):
+    snapshot = HierarchySnapshot(snapshot_path)
+    try:
+        rows = {row[0]: row[:5] for row in snapshot.affiliate_rows()}
+    finally:
+        snapshot.close()
+    assert rows == {
+        1: (1, None, 1, '1', 2),
+        2: (2, 1, 2, '1.2', 1),
+        3: (3, 2, 3, '1.2.3', 1)
+    }
+
+
+def _corrupt(path, offset, data):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def test_crc_detects_corrupted_body(snapshot_path):
+    with open(snapshot_path, 'rb') as f:
+        original = f.read(HEADER.size + 1)[-1]
+    _corrupt(snapshot_path, HEADER.size, bytes([original ^ 0xFF]))
+
+    with pytest.raises(SnapshotError, match='Checksum'):
+        HierarchySnapshot(snapshot_path)
+    # O erro vem do CRC, não da estrutura: sem verificação o arquivo abre
+    HierarchySnapshot(snapshot_path, verify=False).close()
+
+
+def test_rejects_truncated_file(snapshot_path):
+    with open(snapshot_path, 'r+b') as f:
+        f.truncate(HEADER.size - 1)
+    with pytest.raises(SnapshotError, match='truncado'):
+        HierarchySnapshot(snapshot_path)
+
+
+def test_rejects_other_format(snapshot_path):
+    _corrupt(snapshot_path, 0, b'NOTSNAP\x00')
+    with pytest.raises(SnapshotError, match='não é um snapshot'):
+        HierarchySnapshot(snapshot_path)
+
+    _corrupt(snapshot_path, 0, b'MLMSNAP\x00' + struct.pack('<I', FORMAT_VERSION - 1))
+    with pytest.raises(SnapshotError, match='incompatível'):
+        HierarchySnapshot(snapshot_path)
+
+
+def test_write_points_current_and_keeps_latest(tmp_path):
+    directory = str(tmp_path)
+    for generation in range(1, 6):
+        write_snapshot(directory, generation, HIERARCHY, STATS, keep=3)
+
+    with open(os.path.join(directory, CURRENT_FILE)) as f:
+        assert f.read().strip() == 'hierarchy-000000000005.snap'
+    assert sorted(name for name in os.listdir(directory) if name.endswith('.snap')) == [
+        'hierarchy-000000000003.snap', 'hierarchy-000000000004.snap', 'hierarchy-000000000005.snap'
+    ]
+    assert not [name for name in os.listdir(directory) if name.endswith('.tmp')]
+
+
+def test_store_follows_current_and_keeps_last_good(tmp_path):
+    directory = str(tmp_path)
+    store = SnapshotStore(directory, check_interval=0)
+    assert store.current() is None
+
+    write_snapshot(directory, 1, HIERARCHY, STATS)
+    assert store.current().generation == 1
+    assert store.upline(3) == [2, 1]
+
+    path = write_snapshot(directory, 2, HIERARCHY, STATS)
+    assert store.current().generation == 2
+
+    # CURRENT apontando para um arquivo corrompido: continua servindo o anterior
+    with open(os.path.join(directory, CURRENT_FILE), 'w') as f:
+        f.write('hierarchy-000000000003.snap\n')
+    with open(os.path.join(directory, 'hierarchy-000000000003.snap'), 'wb') as f:
+        with open(path, 'rb') as source:
+            data = bytearray(source.read())
+        data[-1] ^= 0xFF
+        f.write(data)
+    assert store.current().generation == 2